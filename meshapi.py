@@ -2,24 +2,85 @@
 # Meshtastic Serial Interface - Developed by Acidvegas in Python (https://git.acid.vegas)
 
 import argparse
+import asyncio
+import collections
 import logging
+import math
 import os
+import queue
+import random
+import struct
+import threading
 import time
 
 try:
 	import meshtastic
+	from meshtastic                  import config_pb2, mesh_pb2, portnums_pb2
+	from meshtastic.serial_interface import SerialInterface
+	from meshtastic.tcp_interface    import TCPInterface
+	from meshtastic.util             import findPorts
 except ImportError:
 	raise ImportError('meshtastic library not found (pip install meshtastic)')
 
+try:
+	from google.protobuf.message import DecodeError
+except ImportError:
+	raise ImportError('protobuf library not found (pip install protobuf)')
+
 try:
 	from pubsub import pub
 except ImportError:
 	raise ImportError('pubsub library not found (pip install pypubsub)')
 
+from meshdb      import NodeSnapshot, NodeStore
+from meshmetrics import Metrics, MetricsServer, Profiler, render
+from meshtext    import MAX_TEXT, Reassembler, encode, on_air
+
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s | %(levelname)9s | %(funcName)s | %(message)s', datefmt='%Y-%m-%d %I:%M:%S')
 
+# Seconds to wait before the first reconnect attempt and the most to wait between attempts
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
+
+# Stream protocol framing, every protobuf is sent as 0x94 0xC3 <16-bit big-endian length> <protobuf>
+START1     = 0x94
+START2     = 0xC3
+START      = bytes([START1])
+HEADER     = struct.Struct('>BBH')
+MAX_PACKET = 512  # Largest protobuf the radio sends or accepts
+TCP_PORT   = 4403 # Port of the radio's TCP API
+HEARTBEAT  = 300  # Seconds between heartbeats to keep the radio from dropping the connection
+BROADCAST  = 0xFFFFFFFF
+
+# Modem preset -> (bandwidth kHz, spreading factor, coding rate denominator 4/x)
+PRESETS = {
+	'SHORT_TURBO'    : (500,  7,  5),
+	'SHORT_FAST'     : (250,  7,  5),
+	'SHORT_SLOW'     : (250,  8,  5),
+	'MEDIUM_FAST'    : (250,  9,  5),
+	'MEDIUM_SLOW'    : (250,  10, 5),
+	'LONG_TURBO'     : (500,  11, 8),
+	'LONG_FAST'      : (250,  11, 5),
+	'LONG_MODERATE'  : (125,  11, 8),
+	'LONG_SLOW'      : (125,  12, 8),
+	'VERY_LONG_SLOW' : (62.5, 12, 8)
+}
+PREAMBLE = 16 # Preamble symbols sent by the firmware
+
+# Send priorities, lower is sent first
+PRIORITY_HIGH   = 0 # Sent even while the channel is busy
+PRIORITY_NORMAL = 1
+PRIORITY_LOW    = 2 # Merged with other pending low priority messages and dropped once stale
+PRIORITIES      = ('high', 'normal', 'low')
+
+LOW_LIMIT           = 100 # Most low priority messages waiting before the oldest is dropped
+LOW_TTL             = 300 # Seconds a low priority message may wait before it is dropped
+UTILIZATION_RECHECK = 60  # Seconds between checks while the channel is busy (a new report from the radio is checked right away)
+UTILIZATION_TTL     = 600 # Seconds a utilization report is trusted, after that only the duty cycle limits sending
+SEPARATOR           = ' | '
+
 
 def now():
 	'''Returns the current date and time in a formatted string'''
@@ -27,96 +88,505 @@ def now():
 	return time.strftime('%Y-%m-%d %H:%M:%S')
 
 
+def backoff(attempt: int) -> float:
+	'''
+	Return the seconds to wait before a reconnect attempt, doubling each attempt with jitter so clients do not retry in lockstep
+
+	:param attempt: The number of failed attempts so far
+	'''
+
+	delay = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** attempt)
+
+	return delay / 2 + random.uniform(0, delay / 2)
+
+
+def airtime(size: int, preset: str = 'LONG_FAST') -> float:
+	'''
+	Return the seconds a LoRa packet is on the air (Semtech SX127x time-on-air formula, explicit header and CRC)
+
+	:param size:   The size of the LoRa payload in bytes (the 16 byte header included)
+	:param preset: The modem preset name
+	'''
+
+	bandwidth, spreading, coding = PRESETS.get(preset, PRESETS['LONG_FAST'])
+	symbol                       = 2 ** spreading / (bandwidth * 1000)
+	optimize                     = 1 if symbol > 0.016 else 0 # Low data rate optimization above 16ms symbols
+	payload                      = 8 + max(math.ceil((8 * size - 4 * spreading + 28 + 16) / (4 * (spreading - 2 * optimize))) * coding, 0)
+
+	return (PREAMBLE + 4.25) * symbol + payload * symbol
+
+
+class AirtimeScheduler(object):
+	def __init__(self, send, preset: str = 'LONG_FAST', duty_cycle: float = 10.0, window: int = 3600, utilization_limit: float = 25.0, metrics: Metrics = None):
+		'''
+		Initialize the scheduler pacing outgoing text messages by the airtime they use
+
+		:param send:              Function sending a message, called with (text, destination, channel, compressed)
+		:param preset:            The modem preset the radio uses
+		:param duty_cycle:        The percentage of each window we may transmit on a channel
+		:param window:            The seconds the duty cycle is measured over
+		:param utilization_limit: The channel utilization percentage above which only high priority messages are sent
+		:param metrics:           The metrics to record queue wait times and airtime to
+		'''
+
+		self.send              = send
+		self.preset            = preset
+		self.duty_cycle        = duty_cycle
+		self.window            = window
+		self.utilization_limit = utilization_limit
+		self.utilization       = 0.0  # Latest channel utilization reported by our radio
+		self.utilization_time  = None # Monotonic time of the latest utilization report
+		self.metrics           = metrics or Metrics()
+		self.pending           = []  # [priority, sequence, time queued, destination, channel, text, airtime, compressed] of each waiting message
+		self.history           = {}  # Channel index -> deque of (time sent, airtime) within the window
+		self.used              = {}  # Channel index -> airtime seconds used within the window
+		self.sequence          = 0
+		self.condition         = threading.Condition()
+		self.stopping          = False
+		self.thread            = threading.Thread(target=self.run, name='meshapi-scheduler', daemon=True)
+
+		self.metrics.gauge('send_queue',          lambda: len(self.pending))
+		self.metrics.gauge('airtime_window',      lambda: sum(self.used.values()))
+		self.metrics.gauge('channel_utilization', lambda: self.utilization)
+
+
+	def cost(self, text: str, compressed: bool = False) -> float:
+		'''
+		Return the airtime of a text message (every packet it is split into)
+
+		:param text:       The message text
+		:param compressed: Whether the message is sent compressed
+		'''
+
+		return sum(airtime(on_air(portnum, payload), self.preset) for portnum, payload in encode(text, compressed))
+
+
+	def submit(self, text: str, destination: int = BROADCAST, channel: int = 0, priority: int = PRIORITY_NORMAL, compressed: bool = False):
+		'''
+		Queue a text message
+
+		:param text:        The message to send
+		:param destination: The node number to send to
+		:param channel:     The channel index to send on
+		:param priority:    PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+		:param compressed:  Send the message compressed when that is shorter (only clients running meshtext can read it)
+		'''
+
+		with self.condition:
+			# Low priority messages to the same place are merged while they fit in one packet, one preamble and header instead of several
+			if priority == PRIORITY_LOW:
+				for entry in self.pending:
+					if entry[0] == PRIORITY_LOW and entry[3] == destination and entry[4] == channel and entry[7] == compressed and len(encode(merged := entry[5] + SEPARATOR + text, compressed)) == 1:
+						entry[5] = merged
+						entry[6] = self.cost(merged, compressed)
+						self.metrics.count('merged')
+						return
+
+				# Past the limit the oldest low priority message makes room
+				if sum(1 for entry in self.pending if entry[0] == PRIORITY_LOW) >= LOW_LIMIT:
+					self.pending.remove(min((entry for entry in self.pending if entry[0] == PRIORITY_LOW), key=lambda entry: entry[1]))
+					self.metrics.count('send_dropped')
+
+			self.sequence += 1
+			self.pending.append([priority, self.sequence, time.monotonic(), destination, channel, text, self.cost(text, compressed), compressed])
+			self.pending.sort()
+			self.condition.notify()
+
+
+	def update_utilization(self, utilization: float):
+		'''
+		Record the channel utilization reported by the radio
+
+		:param utilization: The channel utilization percentage
+		'''
+
+		with self.condition:
+			self.utilization      = utilization
+			self.utilization_time = time.monotonic()
+			self.condition.notify()
+
+
+	def delay(self, entry: list, now: float) -> float:
+		'''
+		Return the seconds until a message fits the duty cycle budget and the channel utilization (0 to send it now)
+
+		:param entry: The pending message
+		:param now:   The current monotonic time
+		'''
+
+		# A busy channel holds all but high priority messages until the radio reports a lower utilization or the report goes stale
+		if self.utilization >= self.utilization_limit and entry[0] != PRIORITY_HIGH and (stale := self.utilization_time + UTILIZATION_TTL - now) > 0:
+			return min(UTILIZATION_RECHECK, stale)
+
+		history = self.history.get(entry[4])
+		excess  = self.used.get(entry[4], 0.0) + entry[6] - self.window * self.duty_cycle / 100
+
+		# A message larger than the whole budget still goes out once the channel had no traffic from us for a window
+		if excess <= 0 or not history:
+			return 0.0
+
+		# Wait for enough of the oldest transmissions to leave the window
+		for sent, seconds in history:
+			if (excess := excess - seconds) <= 0:
+				return max(sent + self.window - now, 0.0)
+
+		# The message alone is larger than the budget, wait for the channel to be clear of us
+		return max(history[-1][0] + self.window - now, 0.0)
+
+
+	def expire(self, now: float):
+		'''
+		Forget transmissions that left the window
+
+		:param now: The current monotonic time
+		'''
+
+		for channel, history in self.history.items():
+			while history and history[0][0] + self.window <= now:
+				self.used[channel] -= history.popleft()[1]
+
+
+	def run(self):
+		'''Scheduler thread sending the highest priority message that fits its channel's budget'''
+
+		while True:
+			with self.condition:
+				if self.stopping:
+					break
+
+				now = time.monotonic()
+				self.expire(now)
+
+				# Stale low priority messages are not worth the airtime any more
+				for entry in [entry for entry in self.pending if entry[0] == PRIORITY_LOW and now - entry[2] > LOW_TTL]:
+					self.pending.remove(entry)
+					self.metrics.count('send_dropped')
+
+				chosen = None
+				wait   = None
+
+				for entry in self.pending:
+					if (delay := self.delay(entry, now)) <= 0:
+						chosen = entry
+						break
+					wait = delay if wait is None else min(wait, delay)
+
+				if not chosen:
+					self.condition.wait(wait)
+					continue
+
+				self.pending.remove(chosen)
+				self.history.setdefault(chosen[4], collections.deque()).append((now, chosen[6]))
+				self.used[chosen[4]] = self.used.get(chosen[4], 0.0) + chosen[6]
+
+			priority, _, queued, destination, channel, text, seconds, compressed = chosen
+
+			self.metrics.observe(f'send_wait_{PRIORITIES[priority]}', now - queued)
+			self.metrics.count('airtime_seconds', seconds, channel=channel)
+
+			try:
+				self.send(text, destination, channel, compressed)
+			except Exception as e:
+				self.metrics.count('errors')
+				logging.error(f'Failed to send message: {e}')
+
+
+	def start(self):
+		'''Start the scheduler thread'''
+
+		self.thread.start()
+
+
+	def close(self):
+		'''Stop the scheduler thread, pending messages are discarded'''
+
+		with self.condition:
+			self.stopping = True
+			self.condition.notify()
+
+
 class MeshtasticClient(object):
-	def __init__(self, option: str, value: str):
+	def __init__(self, option: str, value: str, queue_size: int = 10000, duty_cycle: float = 10.0, snapshot: str = None):
+		'''
+		Initialize the Meshtastic client
+
+		:param option:     The interface option to connect to (serial or tcp)
+		:param value:      The value of the interface option (the serial port or the hostname)
+		:param queue_size: The maximum number of events waiting for the dispatcher before new ones are dropped
+		:param duty_cycle: The percentage of each hour we may transmit on a channel
+		:param snapshot:   The file to keep the nodes in between runs (None to start empty)
+		'''
+
 		self.interface = None
 		self.me        = {}
-		self.nodes     = {}
+		self.nodes     = NodeStore()
+		self.metrics   = Metrics()
+		self.events    = queue.Queue(queue_size) # (topic name, message arguments, time queued) of each event waiting for the dispatcher
+		self.handlers  = {}                      # Topic name -> handler, sub-topics are handled by the handler of their parent
+		self.routes    = {}                      # Topic name -> handlers, cached from the handlers
+		self.reconnect = threading.Event()       # Set when the connection is lost
+		self.stopping  = threading.Event()       # Set when the client is closed
+		self.scheduler = AirtimeScheduler(self.transmit, duty_cycle=duty_cycle, metrics=self.metrics)
+		self.texts     = Reassembler()
+		self.snapshot  = NodeSnapshot(snapshot) if snapshot else None
 
 		self.interface_option = option
 		self.interface_value  = value
 
+		# Pubsub callbacks run on the meshtastic library's publishing thread, which delivers every packet,
+		# so handlers run on a dispatcher and reconnects on a supervisor to keep it from stalling
+		self.dispatcher = threading.Thread(target=self.dispatch,  name='meshapi-dispatcher', daemon=True)
+		self.supervisor = threading.Thread(target=self.supervise, name='meshapi-supervisor', daemon=True)
+
+		self.metrics.gauge('nodes',       lambda: len(self.nodes.nodes))
+		self.metrics.gauge('queue_depth', lambda: self.events.qsize())
+
+		# Nodes from the last run are usable right away, the radio's node database then updates them as it arrives
+		if self.snapshot:
+			started = time.perf_counter()
+			loaded  = self.snapshot.load(self.nodes)
+			elapsed = time.perf_counter() - started
+			self.metrics.observe('snapshot_load', elapsed)
+			logging.info(f'Loaded {loaded:,} nodes from {snapshot} in {elapsed * 1000:.1f}ms')
+
+
+	def start(self):
+		'''Start the event dispatcher and the reconnect supervisor'''
+
+		self.dispatcher.start()
+		self.supervisor.start()
+		self.scheduler.start()
+
+		if self.snapshot:
+			self.snapshot.start(self.nodes)
+
+
+	def open(self):
+		'''Open the Meshtastic interface (blocks until the radio has sent its configuration)'''
+
 		if self.interface_option == 'serial':
-			from meshtastic.serial_interface import SerialInterface as MeshInterface
-			from meshtastic.util import findPorts
+			if devices := findPorts():
+				if not os.path.exists(self.interface_value) or not self.interface_value in devices:
+					raise Exception(f'Invalid serial port specified: {self.interface_value} (Available: {devices})')
+			else:
+				raise Exception('No serial devices found')
+			return SerialInterface(self.interface_value)
+
 		elif self.interface_option == 'tcp':
-			from meshtastic.tcp_interface import TCPInterface as MeshInterface
+			return TCPInterface(self.interface_value)
 
+		else:
+			raise SystemExit('Invalid interface option')
 
-	def connect(self, option: str, value: str):
-		'''
-  		Connect to the Meshtastic interface
-    
-    	:param option: The interface option to connect to
-		:param value:  The value of the interface option
-     	'''
-  
-		while True:
-			try:
-				if option == 'serial':
-					if devices := findPorts():
-						if not os.path.exists(args.serial) or not args.serial in devices:
-							raise Exception(f'Invalid serial port specified: {args.serial} (Available: {devices})')
-					else:
-						raise Exception('No serial devices found')
-					self.interface = SerialInterface(value)
-		
-				elif option == 'tcp':
-					self.interface = TCPInterface(value)
 
-				else:
-					raise SystemExit('Invalid interface option')
+	def connect(self) -> bool:
+		'''Connect to the Meshtastic interface, retrying with exponential backoff until connected or closed'''
+
+		attempt = 0
+
+		while not self.stopping.is_set():
+			try:
+				self.interface = self.open()
 
 			except Exception as e:
+				delay    = backoff(attempt)
+				attempt += 1
+
+				self.metrics.count('connect_failures')
+
 				logging.error(f'Failed to connect to the radio: {e}')
-				logging.error('Retrying in 15 seconds...')
-				time.sleep(15)
+				logging.error(f'Retrying in {delay:.1f} seconds...')
+
+				self.stopping.wait(delay)
 
 			else:
 				self.me = self.interface.getMyNodeInfo()
+
+				# Airtime is computed for the preset the radio actually uses
+				try:
+					lora = self.interface.localNode.localConfig.lora
+					if lora.use_preset:
+						self.scheduler.preset = config_pb2.Config.LoRaConfig.ModemPreset.Name(lora.modem_preset)
+				except AttributeError:
+					pass
+
+				return True
+
+		return False
+
+
+	def supervise(self):
+		'''Supervisor thread that reconnects whenever the connection is lost'''
+
+		while True:
+			self.reconnect.wait()
+
+			if self.stopping.is_set():
 				break
 
+			self.reconnect.clear()
+
+			# The dead interface is closed here rather than from its own threads, which it would try to join
+			if self.interface:
+				try:
+					self.interface.close()
+				except Exception as e:
+					logging.debug(f'Failed to close the interface: {e}')
+
+			self.metrics.count('reconnects')
+
+			self.connect()
+
+
+	def close(self):
+		'''Stop the dispatcher and the supervisor and close the Meshtastic interface'''
+
+		self.stopping.set()
+		self.reconnect.set()
+		self.scheduler.close()
+
+		try:
+			self.events.put_nowait(None)
+		except queue.Full:
+			pass
+
+		if self.snapshot:
+			self.snapshot.close(self.nodes)
+
+		if self.interface:
+			self.interface.close()
+
 
-	def send(self, message: str):
+	def send(self, message: str, destination: int = BROADCAST, channel: int = 0, priority: int = PRIORITY_NORMAL, compressed: bool = False):
 		'''
-		Send a message to the Meshtastic interface
+		Queue a message for the Meshtastic interface, sent once it fits the airtime budget
 
-		:param message: The message to send
+		:param message:     The message to send
+		:param destination: The node number to send to
+		:param channel:     The channel index to send on
+		:param priority:    PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+		:param compressed:  Send the message compressed on PRIVATE_APP when that is shorter (stock firmware and apps can not read it)
 		'''
 
-		if len(message) > 255:
-			logging.warning('Message exceeds 255 characters')
-			message = message[:255]
+		if len(encoded := message.encode('utf-8')) > MAX_TEXT:
+			logging.warning(f'Message exceeds {MAX_TEXT} bytes')
+			message = encoded[:MAX_TEXT].decode('utf-8', 'ignore')
 
-		self.interface.sendText(message)
+		self.scheduler.submit(message, destination, channel, priority, compressed)
 
-		logging.info(f'Sent broadcast message: {message}')
+
+	def transmit(self, message: str, destination: int, channel: int, compressed: bool = False):
+		'''
+		Send a message to the Meshtastic interface right away (called by the scheduler)
+
+		:param message:     The message to send
+		:param destination: The node number to send to
+		:param channel:     The channel index to send on
+		:param compressed:  Send the message compressed when that is shorter
+		'''
+
+		for portnum, payload in encode(message, compressed):
+			self.interface.sendData(payload, destinationId=destination, portNum=portnum, channelIndex=channel)
+			self.metrics.count('sent')
+			self.metrics.count('sent_bytes', on_air(portnum, payload))
+
+		self.metrics.count('text_bytes', on_air(portnums_pb2.TEXT_MESSAGE_APP, message.encode('utf-8')))
+
+		logging.info(f'Sent message to !{destination:08x} on channel {channel}: {message}')
+
+
+	def prometheus(self) -> str:
+		'''Return the radio metrics in the Prometheus text format'''
+
+		return render([(self.metrics, {})], 'meshapi')
 
 
 	def listen(self):
 		'''Create the Meshtastic callback subscriptions'''
 
-		pub.subscribe(self.event_connect,    'meshtastic.connection.established')
-		pub.subscribe(self.event_data,       'meshtastic.receive.data.portnum')
-		pub.subscribe(self.event_disconnect, 'meshtastic.connection.lost')
-		pub.subscribe(self.event_node,       'meshtastic.node')
-		pub.subscribe(self.event_position,   'meshtastic.receive.position')
-		pub.subscribe(self.event_text,       'meshtastic.receive.text')
-		pub.subscribe(self.event_user,       'meshtastic.receive.user')
+		self.handlers = {
+			'meshtastic.connection.established'   : self.event_connect,
+			'meshtastic.receive.data'             : self.event_data,
+			'meshtastic.connection.lost'          : self.event_disconnect,
+			'meshtastic.node'                     : self.event_node,
+			'meshtastic.receive'                  : self.event_packet,
+			'meshtastic.receive.position'         : self.event_position,
+			'meshtastic.receive.text'             : self.event_text,
+			'meshtastic.receive.data.PRIVATE_APP' : self.event_compressed_text,
+			'meshtastic.receive.user'             : self.event_user
+		}
+		self.routes = {}
+
+		# A single subscription to the root topic queues every event, the dispatcher routes it to the handlers
+		pub.subscribe(self.enqueue, 'meshtastic')
 
 		logging.debug('Listening for Meshtastic events...')
-		
-		
-	def event_connect(self, interface, topic=pub.AUTO_TOPIC):
+
+
+	def route(self, name: str) -> list:
+		'''
+		Return the handlers of a topic, the handler of every parent topic included (like pubsub delivers them)
+
+		:param name: The topic name (meshtastic.receive.text)
+		'''
+
+		if (handlers := self.routes.get(name)) is None:
+			parts    = name.split('.')
+			handlers = self.routes[name] = [handler for depth in range(len(parts), 0, -1) if (handler := self.handlers.get('.'.join(parts[:depth])))]
+
+		return handlers
+
+
+	def enqueue(self, topic=pub.AUTO_TOPIC, **kwargs):
+		'''
+		Callback function for every Meshtastic event, queued for the dispatcher so the library is never blocked
+
+		:param topic:  PubSub topic
+		:param kwargs: The message arguments (packet, node, interface, ...)
+		'''
+
+		name = topic.getName()
+
+		if not self.route(name):
+			return
+
+		try:
+			self.events.put_nowait((name, kwargs, time.perf_counter()))
+		except queue.Full:
+			self.metrics.count('dropped')
+
+
+	def dispatch(self):
+		'''Dispatcher thread that runs the handlers of each queued event'''
+
+		while (item := self.events.get()) is not None:
+			name, kwargs, queued = item
+			started              = time.perf_counter()
+
+			self.metrics.observe('queue', started - queued)
+
+			for handler in self.route(name):
+				try:
+					handler(**kwargs)
+				except Exception as e:
+					self.metrics.count('errors')
+					logging.exception(f'Failed to handle {name}: {e}')
+
+			self.metrics.observe('dispatch', time.perf_counter() - started)
+
+
+	def event_connect(self, interface):
 		'''
 		Callback function for connection established
 
 		:param interface: Meshtastic interface
-		:param topic:     PubSub topic
 		'''
 
-		logging.info(f'Connected to the {self.me["user"]["longName"]} radio on {self.me["user"]["hwModel"]} hardware')
-		logging.info(f'Found a total of {len(self.nodes):,} nodes')
+		# The event can be handled before connect() has stored the node info
+		me = interface.getMyNodeInfo() or {}
+
+		logging.info(f'Connected to the {me.get("user", {}).get("longName")} radio on {me.get("user", {}).get("hwModel")} hardware')
+		logging.info(f'Found a total of {len(self.nodes.nodes):,} nodes')
 
 
 	def event_data(self, packet: dict, interface):
@@ -127,38 +597,61 @@ class MeshtasticClient(object):
 		:param interface: Meshtastic interface
 		'''
 
-		logging.info(f'Data update: {data}')
+		logging.info(f'Data update: {packet}')
 
 
-	def event_disconnect(self, interface, topic=pub.AUTO_TOPIC):
+	def event_disconnect(self, interface):
 		'''
 		Callback function for connection lost
 
 		:param interface: Meshtastic interface
-		:param topic:     PubSub topic
 		'''
 
 		logging.warning('Lost connection to radio!')
 
-		time.sleep(10)
+		self.metrics.count('disconnects')
 
-		 # TODO: Consider storing the interface option and value in a class variable since we don't want to reference the args object inside the class
-		self.connect('serial' if args.serial else 'tcp', args.serial if args.serial else args.tcp)
+		# The supervisor reconnects, a lost connection while closing is expected
+		if not self.stopping.is_set():
+			self.reconnect.set()
 
 	
-	def event_node(self, node):
+	def event_node(self, node, interface):
 		'''
 		Callback function for node updates
 
 		:param node: Node information
+		:param interface: Meshtastic interface
 		'''
 
-		# Node ID Formula = f'!{hex(node_num)[2:]}'
+		record = self.nodes.update_dict(node)
 
-		self.nodes[node['num']] = node
+		self.metrics.count('node_updates')
 
-		logging.info(f'Node found: {node["user"]["id"]} - {node["user"]["shortName"].ljust(4)} - {node["user"]["longName"]}')
-		print(node)
+		logging.info(f'Node found: {record.id} - {(record.short_name or "").ljust(4)} - {record.long_name}')
+		logging.debug(node)
+
+
+	def event_packet(self, packet: dict, interface):
+		'''
+		Callback function for every received packet (the receive.* topics are delivered to it as well)
+
+		:param packet: Packet received
+		:param interface: Meshtastic interface
+		'''
+
+		# Packets the radio could not decrypt arrive without a decoded payload
+		if (decoded := packet.get('decoded')):
+			self.metrics.count('packets', portnum=decoded.get('portnum', 'UNKNOWN_APP'))
+		else:
+			self.metrics.count('decrypt_failures', channel=packet.get('channel', 0))
+
+		self.metrics.count('channel_packets', channel=packet.get('channel', 0))
+
+		# Our radio's own telemetry tells how busy the channel is
+		if packet.get('from') == self.me.get('num') and (metrics := (decoded or {}).get('telemetry', {}).get('deviceMetrics')):
+			if 'channelUtilization' in metrics:
+				self.scheduler.update_utilization(metrics['channelUtilization'])
 
 
 	def event_position(self, packet: dict, interface):
@@ -170,9 +663,10 @@ class MeshtasticClient(object):
 		'''
 
 		sender    = packet['from']
+		node      = self.nodes.heard(sender, packet.get('rxTime'), snr=packet.get('rxSnr'))
 		msg       = packet['decoded']['payload'].hex()
-		id        = self.nodes[sender]['user']['id']       if sender in self.nodes else '!unk   '
-		name      = self.nodes[sender]['user']['longName'] if sender in self.nodes else 'UNK'
+		id        = node.id
+		name      = node.long_name or 'UNK'
 		longitude = packet['decoded']['position']['longitudeI'] / 1e7
 		latitude  = packet['decoded']['position']['latitudeI'] / 1e7
 		altitude  = packet['decoded']['position']['altitude']
@@ -190,14 +684,29 @@ class MeshtasticClient(object):
 		'''
 
 		sender = packet['from']
-		to     = packet['to'] 
+		to     = packet['to']
 		msg    = packet['decoded']['payload'].decode('utf-8')
-		id     = self.nodes[sender]['user']['id']       if sender in self.nodes else '!unk   '
-		name   = self.nodes[sender]['user']['longName'] if sender in self.nodes else 'UNK'
-		target = self.nodes[to]['user']['longName']     if to     in self.nodes else 'UNK'
+		node   = self.nodes.heard(sender, packet.get('rxTime'), snr=packet.get('rxSnr'))
+		id     = node.id
+		name   = node.long_name or 'UNK'
+		target = getattr(self.nodes.get(to), 'long_name', None) or 'UNK'
 
 		logging.info(f'{id} {name} -> {target}: {msg}')
-		print(packet)
+		logging.debug(packet)
+
+
+	def event_compressed_text(self, packet: dict, interface):
+		'''
+		Callback function for private application packets, meshtext compressed messages are handled as text once every chunk arrived
+
+		:param packet: Packet received
+		:param interface: Meshtastic interface
+		'''
+
+		if (text := self.texts.receive(packet['from'], packet['decoded']['payload'])) is None:
+			return
+
+		self.event_text({**packet, 'decoded': {**packet['decoded'], 'payload': text.encode('utf-8')}}, interface)
 
 
 	def event_user(self, packet: dict, interface):
@@ -239,25 +748,314 @@ class MeshtasticClient(object):
 		pass
 
 
+class AsyncMeshtasticClient(object):
+	def __init__(self, limit: int = 65536):
+		'''
+		Initialize the asyncio Meshtastic client, speaking the stream protocol to the radio directly (no threads or pubsub)
+
+		:param limit: The most bytes of debug output buffered while looking for the start of a frame
+		'''
+
+		self.reader     = None # StreamReader of the bytes from the radio
+		self.writer     = None # StreamWriter to the radio (TCP only)
+		self.fd         = None # File descriptor of the serial port (serial only)
+		self.limit      = limit
+		self.lock       = None # Lock keeping frames from interleaving on the serial port
+		self.my_info    = None # MyNodeInfo sent by the radio
+		self.config_id  = None # Nonce of the configuration request, echoed back once the radio sent its configuration
+		self.configured = None # Event set once the radio sent its configuration
+		self.heartbeat  = None # Task keeping the connection alive
+		self.metrics    = Metrics()
+
+
+	def __aiter__(self):
+		return self
+
+
+	async def __anext__(self):
+		'''Return the next FromRadio message'''
+
+		if (from_radio := await self.read()) is None:
+			raise StopAsyncIteration
+
+		return from_radio
+
+
+	async def connect(self, option: str, value: str, baudrate: int = 115200):
+		'''
+		Connect to the radio and request its configuration
+
+		:param option:   The interface option to connect to (serial or tcp)
+		:param value:    The serial port or the host[:port] of the radio
+		:param baudrate: The serial port speed
+		'''
+
+		self.lock       = asyncio.Lock()
+		self.configured = asyncio.Event()
+
+		if option == 'serial':
+			# Only available on unix, imported here so TCP works everywhere
+			import termios, tty
+
+			self.fd = os.open(value, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+
+			# Raw mode, the stream is binary and the firmware debug output is not line based
+			tty.setraw(self.fd)
+			attributes    = termios.tcgetattr(self.fd)
+			attributes[4] = attributes[5] = getattr(termios, f'B{baudrate}') # Input and output speed
+			termios.tcsetattr(self.fd, termios.TCSANOW, attributes)
+
+			self.reader = asyncio.StreamReader(self.limit)
+			asyncio.get_running_loop().add_reader(self.fd, self.readable)
+
+			# Wake the radio up from its debug console
+			await self.write(bytes([START2]) * 32)
+			await asyncio.sleep(0.1)
+
+		elif option == 'tcp':
+			host, _, port = value.partition(':')
+			self.reader, self.writer = await asyncio.open_connection(host, int(port or TCP_PORT), limit=self.limit)
+
+		else:
+			raise SystemExit('Invalid interface option')
+
+		self.config_id = random.randint(1, 0xFFFFFFFF)
+		await self.send(mesh_pb2.ToRadio(want_config_id=self.config_id))
+
+		self.heartbeat = asyncio.create_task(self.keepalive())
+
+
+	def readable(self):
+		'''Callback for the serial port being readable, feeds the bytes to the stream reader'''
+
+		try:
+			data = os.read(self.fd, 4096)
+		except BlockingIOError:
+			return
+		except OSError:
+			data = b'' # EIO once the device (or the other end of a pty) is gone
+
+		if data:
+			self.reader.feed_data(data)
+		else:
+			asyncio.get_running_loop().remove_reader(self.fd)
+			self.reader.feed_eof()
+
+
+	async def write(self, data: bytes):
+		'''
+		Write bytes to the radio, waiting while the serial port or socket buffer is full
+
+		:param data: The bytes to write
+		'''
+
+		if self.writer:
+			self.writer.write(data)
+			await self.writer.drain()
+			return
+
+		loop = asyncio.get_running_loop()
+		view = memoryview(data)
+
+		while view:
+			try:
+				view = view[os.write(self.fd, view):]
+			except BlockingIOError:
+				waiter = loop.create_future()
+				loop.add_writer(self.fd, lambda: waiter.done() or waiter.set_result(None))
+				try:
+					await waiter
+				finally:
+					loop.remove_writer(self.fd)
+
+
+	async def send(self, to_radio: mesh_pb2.ToRadio):
+		'''
+		Frame and send a message to the radio
+
+		:param to_radio: The ToRadio message to send
+		'''
+
+		payload = to_radio.SerializeToString()
+
+		if len(payload) > MAX_PACKET:
+			raise ValueError(f'ToRadio message is {len(payload)} bytes (the radio accepts {MAX_PACKET})')
+
+		async with self.lock:
+			await self.write(HEADER.pack(START1, START2, len(payload)) + payload)
+
+		self.metrics.count('sent')
+
+
+	async def send_text(self, text: str, destination: int = BROADCAST, channel: int = 0, want_ack: bool = False, compressed: bool = False) -> list:
+		'''
+		Send a text message, returning the id of every packet it was split into
+
+		:param text:        The message to send
+		:param destination: The node number to send to
+		:param channel:     The channel index to send on
+		:param want_ack:    Request an acknowledgement from the destination
+		:param compressed:  Send the message compressed on PRIVATE_APP when that is shorter (stock firmware and apps can not read it)
+		'''
+
+		ids = []
+
+		for portnum, payload in encode(text, compressed):
+			packet                 = mesh_pb2.MeshPacket(to=destination, channel=channel, id=random.randint(1, 0xFFFFFFFF), want_ack=want_ack)
+			packet.decoded.portnum = portnum
+			packet.decoded.payload = payload
+
+			await self.send(mesh_pb2.ToRadio(packet=packet))
+
+			ids.append(packet.id)
+
+		return ids
+
+
+	def prometheus(self) -> str:
+		'''Return the radio metrics in the Prometheus text format'''
+
+		return render([(self.metrics, {})], 'meshapi')
+
+
+	async def read(self) -> mesh_pb2.FromRadio:
+		'''Read the next FromRadio message, skipping the firmware debug output in between (None once the connection is closed)'''
+
+		reader = self.reader
+
+		while True:
+			try:
+				# Anything before the start byte is debug output from the firmware
+				try:
+					skipped = await reader.readuntil(START)
+				except asyncio.LimitOverrunError as e:
+					await reader.readexactly(e.consumed)
+					continue
+
+				if len(skipped) > 1:
+					logging.debug(f'Radio console: {skipped[:-1].decode("utf-8", "replace").rstrip()}')
+
+				header = await reader.readexactly(3)
+
+				# Only the start byte of a bad header is dropped, the real one may be among the bytes read after it
+				while (bad := header[0] != START2 or int.from_bytes(header[1:], 'big') > MAX_PACKET) and (position := header.find(START)) >= 0:
+					self.metrics.count('framing_errors')
+					header = header[position + 1:] + await reader.readexactly(position + 1)
+
+				if bad:
+					self.metrics.count('framing_errors')
+					continue
+
+				payload = await reader.readexactly(int.from_bytes(header[1:], 'big'))
+
+			except asyncio.IncompleteReadError:
+				return None
+
+			from_radio = mesh_pb2.FromRadio()
+
+			try:
+				from_radio.ParseFromString(payload)
+			except DecodeError as e:
+				self.metrics.count('parse_errors')
+				logging.debug(f'Failed to parse FromRadio: {e}')
+				continue
+
+			self.metrics.count('received')
+
+			if from_radio.HasField('my_info'):
+				self.my_info = from_radio.my_info
+			elif from_radio.HasField('config_complete_id') and from_radio.config_complete_id == self.config_id:
+				self.configured.set()
+
+			return from_radio
+
+
+	async def keepalive(self):
+		'''Send a heartbeat periodically, the radio drops API clients that stay quiet'''
+
+		while True:
+			await asyncio.sleep(HEARTBEAT)
+
+			try:
+				await self.send(mesh_pb2.ToRadio(heartbeat=mesh_pb2.Heartbeat()))
+			except (ConnectionError, OSError) as e:
+				logging.warning(f'Failed to send a heartbeat: {e}')
+				return
+
+
+	async def close(self):
+		'''Close the connection to the radio'''
+
+		if self.heartbeat:
+			self.heartbeat.cancel()
+
+		if self.writer:
+			self.writer.close()
+			try:
+				await self.writer.wait_closed()
+			except (ConnectionError, OSError):
+				pass
+
+		elif self.fd is not None:
+			asyncio.get_running_loop().remove_reader(self.fd)
+			os.close(self.fd)
+			self.fd = None
+			self.reader.feed_eof()
+
+
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Meshtastic Interfacing Tool')
 	parser.add_argument('--serial', help='Use serial interface') # Typically /dev/ttyUSB0 or /dev/ttyACM0
 	parser.add_argument('--tcp',    help='Use TCP interface')    # Can be an IP address or hostname (meshtastic.local)
+	parser.add_argument('--metrics', metavar='HOST:PORT', help='Serve Prometheus metrics on /metrics and a sampling profiler on /profile')
+	parser.add_argument('--duty-cycle', default=10.0, type=float, help='Percentage of each hour we may transmit on a channel')
+	parser.add_argument('--snapshot', metavar='FILE', help='Keep the nodes in this SQLite file so they are known before the radio resends them')
+	parser.add_argument('--asyncio', action='store_true', help='Talk to the radio on an asyncio event loop instead of the meshtastic library threads')
 	args = parser.parse_args()
  
 	# Ensure one interface is specified
 	if (not args.serial and not args.tcp) or (args.serial and args.tcp):
 		raise SystemExit('Must specify either --serial or --tcp interface')
+
+	if args.asyncio:
+		async def main():
+			radio = AsyncMeshtasticClient()
+
+			if args.metrics:
+				MetricsServer(args.metrics, radio.prometheus, Profiler()).start()
+
+			await radio.connect('serial' if args.serial else 'tcp', args.serial if args.serial else args.tcp)
+
+			async for from_radio in radio:
+				if from_radio.HasField('packet') and from_radio.packet.decoded.portnum == portnums_pb2.TEXT_MESSAGE_APP:
+					packet = from_radio.packet
+					logging.info(f'!{getattr(packet, "from"):08x} -> !{packet.to:08x}: {packet.decoded.payload.decode("utf-8", "replace")}')
+				else:
+					logging.debug(from_radio)
+
+			logging.info('Connection to radio lost')
+
+		try:
+			asyncio.run(main())
+		except KeyboardInterrupt:
+			pass
+
+		raise SystemExit(0)
 	
 	# Initialize the Meshtastic client
-	mesh = MeshtasticClient()
+	mesh = MeshtasticClient('serial' if args.serial else 'tcp', args.serial if args.serial else args.tcp, duty_cycle=args.duty_cycle, snapshot=args.snapshot)
+
+	# Serve the metrics endpoint
+	if args.metrics:
+		MetricsServer(args.metrics, mesh.prometheus, Profiler()).start()
 
 	# Listen for Meshtastic events
 	mesh.listen()
+	mesh.start()
 
 	# Connect to the Meshtastic interface
-	mesh.connect('serial' if args.serial else 'tcp', args.serial if args.serial else args.tcp)
+	mesh.connect()
 
 	# Keep-alive loop
 	try:
@@ -265,7 +1063,7 @@ if __name__ == '__main__':
 			time.sleep(60)
 	except KeyboardInterrupt:
 		try:
-			mesh.interface.close()
+			mesh.close()
 		except:
 			pass
 	finally:
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# Meshtastic MQTT Packet Archive - Developed by acidvegas in Python (https://acid.vegas/meshtastic)
+
+import argparse
+import base64
+import bisect
+import ipaddress
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+# Segment records are the envelope length and topic length, then the topic and the raw service envelope
+RECORD = struct.Struct('<IH')
+
+# Index records are (archive time, from node, port number, segment offset)
+INDEX = struct.Struct('<IIIQ')
+
+# pcap file header
+PCAP_HEADER = struct.Struct('<IHHiIII')
+
+
+def parse_node(node: str) -> int:
+	'''
+	Convert a node id (!33664b0c) or node number into a node number.
+
+	:param node: The node id or number
+	'''
+
+	return int(node[1:], 16) if node.startswith('!') else int(node)
+
+
+def parse_time(value: str) -> int:
+	'''
+	Convert a relative age (30m, 12h, 7d) or unix timestamp into a unix timestamp.
+
+	:param value: The age or timestamp
+	'''
+
+	units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+	if value[-1] in units:
+		return int(time.time() - float(value[:-1]) * units[value[-1]])
+
+	return int(value)
+
+
+def read_pcap(path: str):
+	'''
+	Yield (timestamp, topic, payload) for every MQTT PUBLISH found in a pcap capture.
+
+	:param path: The pcap file to read
+	'''
+
+	with open(path, 'rb') as pcap:
+		header = pcap.read(PCAP_HEADER.size)
+		magic  = struct.unpack('<I', header[:4])[0]
+
+		# The magic number tells us the byte order and timestamp resolution of the capture
+		if magic in (0xa1b2c3d4, 0xa1b23c4d):
+			endian = '<'
+		elif magic in (0xd4c3b2a1, 0x4d3cb2a1):
+			endian = '>'
+		else:
+			raise ValueError(f'{path} is not a pcap file (pcapng is not supported)')
+
+		resolution = 1e9 if magic in (0xa1b23c4d, 0x4d3cb2a1) else 1e6
+		linktype   = struct.unpack(endian + 'I', header[20:24])[0]
+		record     = struct.Struct(endian + 'IIII')
+		streams    = {} # (source, destination) -> [next expected sequence number, buffered stream bytes, MQTT protocol level]
+
+		while (record_header := pcap.read(record.size)) and len(record_header) == record.size:
+			seconds, fraction, captured, _ = record.unpack(record_header)
+			frame     = pcap.read(captured)
+			timestamp = seconds + fraction / resolution
+
+			if not (segment := parse_tcp(frame, linktype)):
+				continue
+
+			source, destination, sequence, payload = segment
+
+			if not payload:
+				continue
+
+			# A new stream starts at the protocol level its connection's CONNECT (in the other direction) already set
+			if not (stream := streams.get((source, destination))):
+				reverse = streams.get((destination, source))
+				stream  = streams[(source, destination)] = [sequence, b'', reverse[2] if reverse else 4]
+
+			# Drop retransmissions & out of order segments, we only follow the stream in order
+			if sequence != stream[0]:
+				continue
+
+			stream[0]  = (sequence + len(payload)) & 0xffffffff
+			stream[1] += payload
+
+			yield from parse_mqtt(stream, streams.get((destination, source)), timestamp)
+
+
+def parse_tcp(frame: bytes, linktype: int):
+	'''
+	Return (source, destination, sequence, payload) for a TCP segment in a captured frame (or None).
+
+	:param frame:    The captured frame
+	:param linktype: The pcap link type of the frame
+	'''
+
+	# Strip the link layer header (ethernet, linux cooked, loopback or raw IP)
+	if linktype == 1:
+		offset, ethertype = 14, struct.unpack('>H', frame[12:14])[0]
+		if ethertype == 0x8100:
+			offset, ethertype = 18, struct.unpack('>H', frame[16:18])[0]
+	elif linktype == 113:
+		offset, ethertype = 16, struct.unpack('>H', frame[14:16])[0]
+	elif linktype == 0:
+		offset, ethertype = 4, 0x86dd if frame[0] in (24, 28, 30) or frame[3] in (24, 28, 30) else 0x0800
+	elif linktype in (101, 228, 229):
+		offset, ethertype = 0, 0x86dd if frame[0] >> 4 == 6 else 0x0800
+	else:
+		return
+
+	if ethertype == 0x0800:
+		if frame[offset + 9] != 6:
+			return
+		source      = ipaddress.ip_address(frame[offset + 12:offset + 16])
+		destination = ipaddress.ip_address(frame[offset + 16:offset + 20])
+		end         = offset + struct.unpack('>H', frame[offset + 2:offset + 4])[0]
+		offset     += (frame[offset] & 0x0f) * 4
+	elif ethertype == 0x86dd:
+		if frame[offset + 6] != 6:
+			return
+		source      = ipaddress.ip_address(frame[offset + 8:offset + 24])
+		destination = ipaddress.ip_address(frame[offset + 24:offset + 40])
+		end         = offset + 40 + struct.unpack('>H', frame[offset + 4:offset + 6])[0]
+		offset     += 40
+	else:
+		return
+
+	source_port, destination_port, sequence = struct.unpack('>HHI', frame[offset:offset + 8])
+
+	flags   = frame[offset + 13]
+	payload = frame[offset + (frame[offset + 12] >> 4) * 4:end]
+
+	# A SYN consumes a sequence number, so the stream starts after it
+	if flags & 0x02:
+		sequence, payload = (sequence + 1) & 0xffffffff, b''
+
+	return (source, source_port), (destination, destination_port), sequence, payload
+
+
+def parse_mqtt(stream: list, reverse: list, timestamp: float):
+	'''
+	Yield (timestamp, topic, payload) for every complete MQTT PUBLISH buffered in a TCP stream.
+
+	:param stream:    The [next sequence number, buffered bytes, protocol level] of the stream
+	:param reverse:   The stream going the other way (its CONNECT tells us the protocol level)
+	:param timestamp: The time the buffered bytes were captured
+	'''
+
+	data   = stream[1]
+	offset = 0
+
+	while len(data) - offset >= 2:
+		# Decode the remaining length variable byte integer
+		length, multiplier, position = 0, 1, offset + 1
+		while position < len(data):
+			byte        = data[position]
+			length     += (byte & 0x7f) * multiplier
+			multiplier *= 128
+			position   += 1
+			if not byte & 0x80:
+				break
+		else:
+			break
+
+		if position + length > len(data):
+			break
+
+		packet_type = data[offset] >> 4
+		qos         = (data[offset] >> 1) & 0x03
+		body        = data[position:position + length]
+		offset      = position + length
+
+		# Remember the protocol level from CONNECT, MQTT 5 adds properties to PUBLISH
+		if packet_type == 1 and len(body) > 6:
+			level = body[2 + struct.unpack('>H', body[:2])[0]]
+			stream[2] = level
+			if reverse:
+				reverse[2] = level
+
+		elif packet_type == 3:
+			cursor = 2 + struct.unpack('>H', body[:2])[0]
+			topic  = body[2:cursor].decode('utf-8', errors='replace')
+
+			if qos:
+				cursor += 2
+
+			if stream[2] == 5:
+				properties, multiplier = 0, 1
+				while True:
+					byte        = body[cursor]
+					properties += (byte & 0x7f) * multiplier
+					multiplier *= 128
+					cursor     += 1
+					if not byte & 0x80:
+						break
+				cursor += properties
+
+			yield timestamp, topic, bytes(body[cursor:])
+
+	stream[1] = data[offset:]
+
+
+class IndexView(object):
+	def __init__(self, data):
+		'''
+		Initialize a sequence view over the time column of an mmap'd index, for bisecting
+
+		:param data: The index bytes
+		'''
+
+		self.data = data
+
+
+	def __len__(self):
+		return len(self.data) // INDEX.size
+
+
+	def __getitem__(self, position: int) -> int:
+		return INDEX.unpack_from(self.data, position * INDEX.size)[0]
+
+
+class Archive(object):
+	def __init__(self, directory: str, segment_size: int = 64 * 1024 * 1024, flush_interval: float = 1.0):
+		'''
+		Initialize the append-only packet archive
+
+		:param directory:      The directory to store segments and their indexes in
+		:param segment_size:   The size in bytes a segment is rotated at
+		:param flush_interval: The maximum number of seconds appended packets stay buffered
+		'''
+
+		self.directory      = directory
+		self.segment_size   = segment_size
+		self.flush_interval = flush_interval
+		self.lock           = threading.Lock()
+		self.segment        = None # The open segment file being appended to
+		self.index          = None # The open index file being appended to
+		self.offset         = 0    # The size of the open segment
+		self.flushed        = 0    # The last time the open files were flushed
+
+		os.makedirs(directory, exist_ok=True)
+
+
+	def segments(self) -> list:
+		'''Return the names of the segments in the archive, oldest first'''
+
+		return sorted(name[:-4] for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+
+	def rotate(self):
+		'''Close the open segment and start a new one'''
+
+		self.close()
+
+		# Segments are named after the time they were started so they sort chronologically
+		name = f'{time.time_ns():020d}'
+
+		self.segment = open(os.path.join(self.directory, name + '.seg'), 'ab')
+		self.index   = open(os.path.join(self.directory, name + '.idx'), 'ab')
+		self.offset  = 0
+
+
+	def append(self, envelope: bytes, node: int, portnum: int, timestamp: int = None, topic: str = ''):
+		'''
+		Append a raw service envelope to the archive.
+
+		:param envelope:  The raw service envelope payload
+		:param node:      The node number the packet is from
+		:param portnum:   The port number of the decoded packet (0 if it could not be decoded)
+		:param timestamp: The unix time the packet was received (defaults to now)
+		:param topic:     The MQTT topic the envelope was published on
+		'''
+
+		now   = time.time()
+		topic = topic.encode('utf-8')[:0xffff]
+
+		with self.lock:
+			if not self.segment or self.offset >= self.segment_size:
+				self.rotate()
+
+			self.segment.write(RECORD.pack(len(envelope), len(topic)) + topic + envelope)
+			self.index.write(INDEX.pack(int(timestamp or now), node, portnum, self.offset))
+
+			self.offset += RECORD.size + len(topic) + len(envelope)
+
+			if now - self.flushed >= self.flush_interval:
+				self.segment.flush()
+				self.index.flush()
+				self.flushed = now
+
+
+	def flush(self):
+		'''Write any buffered packets to disk'''
+
+		with self.lock:
+			if self.segment:
+				self.segment.flush()
+				self.index.flush()
+
+
+	def close(self):
+		'''Flush and close the open segment'''
+
+		if self.segment:
+			self.segment.close()
+			self.index.close()
+			self.segment = self.index = None
+
+
+	def query(self, start: int = None, end: int = None, node: int = None, portnum: int = None):
+		'''
+		Yield (timestamp, node, portnum, topic, envelope) for archived packets matching the filters, oldest first.
+
+		:param start:   The earliest unix time to include
+		:param end:     The latest unix time to include
+		:param node:    Only include packets from this node number
+		:param portnum: Only include packets with this port number
+		'''
+
+		self.flush()
+
+		segments = self.segments()
+
+		for position, name in enumerate(segments):
+			# Skip segments that were rotated out before the start time or started after the end time
+			if start and position + 1 < len(segments) and int(segments[position + 1]) // 1_000_000_000 < start:
+				continue
+			if end and int(name) // 1_000_000_000 > end:
+				break
+
+			yield from self.query_segment(name, start, end, node, portnum)
+
+
+	def replay(self, start: int = None, end: int = None):
+		'''
+		Yield (timestamp, topic, payload) for archived packets in the same form as read_pcap.
+
+		:param start: The earliest unix time to include
+		:param end:   The latest unix time to include
+		'''
+
+		for timestamp, _, _, topic, envelope in self.query(start, end):
+			yield timestamp, topic, envelope
+
+
+	def query_segment(self, name: str, start: int = None, end: int = None, node: int = None, portnum: int = None):
+		'''
+		Yield the packets in a single segment matching the filters.
+
+		:param name:    The segment name
+		:param start:   The earliest unix time to include
+		:param end:     The latest unix time to include
+		:param node:    Only include packets from this node number
+		:param portnum: Only include packets with this port number
+		'''
+
+		index_path   = os.path.join(self.directory, name + '.idx')
+		segment_path = os.path.join(self.directory, name + '.seg')
+
+		if not os.path.getsize(index_path) or not os.path.getsize(segment_path):
+			return
+
+		with open(index_path, 'rb') as index_file, open(segment_path, 'rb') as segment_file:
+			with mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ) as index, mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+				view = IndexView(index)
+
+				# Records are appended in time order, so the time range is found by bisecting the index
+				first = bisect.bisect_left(view, start) if start else 0
+				last  = bisect.bisect_right(view, end) if end else len(view)
+
+				for timestamp, from_node, port, offset in INDEX.iter_unpack(index[first * INDEX.size:last * INDEX.size]):
+					if (node is not None and from_node != node) or (portnum is not None and port != portnum):
+						continue
+
+					# The index can be ahead of the segment if we crashed between the two writes
+					if offset + RECORD.size > len(segment):
+						break
+
+					length, topic_length = RECORD.unpack_from(segment, offset)
+					cursor               = offset + RECORD.size + topic_length
+
+					yield timestamp, from_node, port, segment[offset + RECORD.size:cursor].decode('utf-8', errors='replace'), segment[cursor:cursor + length]
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Meshtastic MQTT Packet Archive')
+	parser.add_argument('directory', help='Archive directory')
+	parser.add_argument('--since', help='Earliest packet time (unix timestamp or age like 30m, 12h, 7d)')
+	parser.add_argument('--until', help='Latest packet time (unix timestamp or age like 30m, 12h, 7d)')
+	parser.add_argument('--node', help='Only show packets from this node (!33664b0c or node number)')
+	parser.add_argument('--portnum', type=int, help='Only show packets with this port number (67 for telemetry)')
+	args = parser.parse_args()
+
+	archive = Archive(args.directory)
+
+	start = parse_time(args.since) if args.since else None
+	end   = parse_time(args.until) if args.until else None
+	node  = parse_node(args.node)  if args.node  else None
+
+	for timestamp, from_node, portnum, topic, envelope in archive.query(start, end, node, args.portnum):
+		print(json.dumps({'time': timestamp, 'from': f'!{from_node:08x}', 'portnum': portnum, 'topic': topic, 'envelope': base64.b64encode(envelope).decode('ascii')}))
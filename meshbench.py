@@ -0,0 +1,663 @@
+#!/usr/bin/env python
+# Meshtastic MQTT Benchmark - Developed by acidvegas in Python (https://acid.vegas/meshtastic)
+
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+
+try:
+	from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+	raise SystemExit('missing the cryptography module (pip install cryptography)')
+
+try:
+	from google.protobuf.json_format import MessageToDict
+except ImportError:
+	raise SystemExit('missing the protobuf module (pip install protobuf)')
+
+try:
+	from meshtastic import admin_pb2, mesh_pb2, mqtt_pb2, paxcount_pb2, portnums_pb2, remote_hardware_pb2, storeforward_pb2, telemetry_pb2
+except ImportError:
+	raise SystemExit('missing the meshtastic module (pip install meshtastic)')
+
+from meshapi  import HEADER
+from meshdb   import NodeSnapshot, NodeStore
+from meshmqtt import BATCH_SIZE, NONCE, MeshtasticMQTT, Output, decode_key, topic_matches, xor_hash
+from meshtext import FORMAT_SINGLE, PORTNUM, Reassembler, compress, encode, on_air
+
+
+# Short names for the port numbers used in --mix
+PORTS = {
+	'text'            : portnums_pb2.TEXT_MESSAGE_APP,
+	'remote_hardware' : portnums_pb2.REMOTE_HARDWARE_APP,
+	'position'        : portnums_pb2.POSITION_APP,
+	'nodeinfo'        : portnums_pb2.NODEINFO_APP,
+	'routing'         : portnums_pb2.ROUTING_APP,
+	'admin'           : portnums_pb2.ADMIN_APP,
+	'compressed_text' : portnums_pb2.TEXT_MESSAGE_COMPRESSED_APP,
+	'waypoint'        : portnums_pb2.WAYPOINT_APP,
+	'audio'           : portnums_pb2.AUDIO_APP,
+	'detection'       : portnums_pb2.DETECTION_SENSOR_APP,
+	'reply'           : portnums_pb2.REPLY_APP,
+	'ip_tunnel'       : portnums_pb2.IP_TUNNEL_APP,
+	'paxcounter'      : portnums_pb2.PAXCOUNTER_APP,
+	'serial'          : portnums_pb2.SERIAL_APP,
+	'store_forward'   : portnums_pb2.STORE_FORWARD_APP,
+	'range_test'      : portnums_pb2.RANGE_TEST_APP,
+	'telemetry'       : portnums_pb2.TELEMETRY_APP,
+	'zps'             : portnums_pb2.ZPS_APP,
+	'simulator'       : portnums_pb2.SIMULATOR_APP,
+	'traceroute'      : portnums_pb2.TRACEROUTE_APP,
+	'neighborinfo'    : portnums_pb2.NEIGHBORINFO_APP,
+	'atak_plugin'     : portnums_pb2.ATAK_PLUGIN,
+	'map_report'      : portnums_pb2.MAP_REPORT_APP,
+	'private'         : portnums_pb2.PRIVATE_APP,
+	'atak_forwarder'  : portnums_pb2.ATAK_FORWARDER
+}
+
+# Serial link speed the radio sends its node database over, 10 bits on the wire per byte
+BAUD_RATE = 115200
+
+# Chat-like words for text payloads
+WORDS = 'hello anyone on the mesh testing from my roof new node here signal looks good copy that heading out back at home later thanks'.split()
+
+
+def parse_mix(mix: str) -> dict:
+	'''
+	Parse a traffic mix like telemetry=60,position=25,nodeinfo=10,text=5 (or "all" for an even mix of every port).
+
+	:param mix: The traffic mix
+	'''
+
+	if mix == 'all':
+		return {portnum: 1 for portnum in PORTS.values()}
+
+	weights = {}
+	for item in mix.split(','):
+		name, _, weight = item.partition('=')
+		if name not in PORTS:
+			raise SystemExit(f'Unknown port {name} in mix (choose from {", ".join(PORTS)})')
+		weights[PORTS[name]] = float(weight or 1)
+
+	return weights
+
+
+def generate_payload(portnum: int, rng: random.Random) -> bytes:
+	'''
+	Generate a realistic payload for a port number.
+
+	:param portnum: The port number
+	:param rng:     The random number generator
+	'''
+
+	if portnum in (portnums_pb2.TEXT_MESSAGE_APP, portnums_pb2.DETECTION_SENSOR_APP, portnums_pb2.REPLY_APP):
+		return ' '.join(rng.choices(WORDS, k=rng.randint(2, 20))).encode('utf-8')
+
+	if portnum == PORTNUM:
+		return bytes([FORMAT_SINGLE]) + compress(' '.join(rng.choices(WORDS, k=rng.randint(2, 20))))
+
+	if portnum == portnums_pb2.RANGE_TEST_APP:
+		return f'seq {rng.randint(1, 10000)}'.encode('utf-8')
+
+	if portnum == portnums_pb2.TELEMETRY_APP:
+		data = telemetry_pb2.Telemetry(time=int(time.time()))
+		if rng.random() < 0.8:
+			data.device_metrics.battery_level       = rng.randint(1, 101)
+			data.device_metrics.voltage             = rng.uniform(3.3, 4.2)
+			data.device_metrics.channel_utilization = rng.uniform(0, 40)
+			data.device_metrics.air_util_tx         = rng.uniform(0, 5)
+			data.device_metrics.uptime_seconds      = rng.randint(0, 10_000_000)
+		else:
+			data.environment_metrics.temperature         = rng.uniform(-10, 40)
+			data.environment_metrics.relative_humidity   = rng.uniform(0, 100)
+			data.environment_metrics.barometric_pressure = rng.uniform(950, 1050)
+
+	elif portnum == portnums_pb2.POSITION_APP:
+		data = mesh_pb2.Position(latitude_i=rng.randint(-900_000_000, 900_000_000), longitude_i=rng.randint(-1_800_000_000, 1_800_000_000), altitude=rng.randint(0, 3000), time=int(time.time()), sats_in_view=rng.randint(3, 20), precision_bits=32)
+
+	elif portnum == portnums_pb2.NODEINFO_APP:
+		node = rng.getrandbits(32)
+		data = mesh_pb2.User(id=f'!{node:08x}', long_name=f'Node {node:08x}', short_name=f'{node:04x}'[-4:], hw_model=rng.choice((mesh_pb2.HELTEC_V3, mesh_pb2.TBEAM, mesh_pb2.RAK4631, mesh_pb2.T_ECHO)))
+
+	elif portnum == portnums_pb2.ROUTING_APP:
+		data = mesh_pb2.Routing(error_reason=mesh_pb2.Routing.NONE)
+
+	elif portnum == portnums_pb2.ADMIN_APP:
+		data = admin_pb2.AdminMessage(get_owner_request=True)
+
+	elif portnum == portnums_pb2.REMOTE_HARDWARE_APP:
+		data = remote_hardware_pb2.HardwareMessage(type=remote_hardware_pb2.HardwareMessage.READ_GPIOS, gpio_mask=rng.getrandbits(16))
+
+	elif portnum == portnums_pb2.WAYPOINT_APP:
+		data = mesh_pb2.Waypoint(id=rng.getrandbits(31), latitude_i=rng.randint(-900_000_000, 900_000_000), longitude_i=rng.randint(-1_800_000_000, 1_800_000_000), name='camp', description='meet here')
+
+	elif portnum == portnums_pb2.PAXCOUNTER_APP:
+		data = paxcount_pb2.Paxcount(wifi=rng.randint(0, 200), ble=rng.randint(0, 200), uptime=rng.randint(0, 100000))
+
+	elif portnum == portnums_pb2.STORE_FORWARD_APP:
+		data = storeforward_pb2.StoreAndForward(rr=storeforward_pb2.StoreAndForward.ROUTER_HEARTBEAT)
+
+	elif portnum == portnums_pb2.TRACEROUTE_APP:
+		hops = rng.randint(1, 6)
+		data = mesh_pb2.RouteDiscovery(route=[rng.getrandbits(32) for _ in range(hops)], snr_towards=[rng.randint(-80, 40) for _ in range(hops + 1)])
+
+	elif portnum == portnums_pb2.NEIGHBORINFO_APP:
+		data = mesh_pb2.NeighborInfo(node_id=rng.getrandbits(32), node_broadcast_interval_secs=900)
+		for _ in range(rng.randint(1, 10)):
+			data.neighbors.add(node_id=rng.getrandbits(32), snr=rng.uniform(-20, 10))
+
+	elif portnum == portnums_pb2.MAP_REPORT_APP:
+		data = mqtt_pb2.MapReport(long_name='Map Node', short_name='MAP', firmware_version='2.5.0', latitude_i=rng.randint(-900_000_000, 900_000_000), longitude_i=rng.randint(-1_800_000_000, 1_800_000_000), num_online_local_nodes=rng.randint(1, 100))
+
+	# The remaining ports carry opaque bytes
+	else:
+		return rng.randbytes(rng.randint(8, 180))
+
+	return data.SerializeToString()
+
+
+def generate_envelope(portnum: int, rng: random.Random, key: bytes, packet_id: int, channel: str = 'LongFast', gateway: str = None) -> bytes:
+	'''
+	Generate a serialized service envelope like a gateway would uplink (map reports are unencrypted).
+
+	:param portnum:   The port number
+	:param rng:       The random number generator
+	:param key:       The raw AES key to encrypt with
+	:param packet_id: The packet id
+	:param channel:   The channel name
+	:param gateway:   The gateway node id (random if not given)
+	'''
+
+	node = rng.getrandbits(32)
+	data = mesh_pb2.Data(portnum=portnum, payload=generate_payload(portnum, rng))
+
+	packet = mesh_pb2.MeshPacket(id=packet_id, to=0xffffffff, channel=xor_hash(channel.encode('utf-8')) ^ xor_hash(key), hop_limit=3, hop_start=3, rx_time=int(time.time()))
+	setattr(packet, 'from', node)
+
+	if portnum == portnums_pb2.MAP_REPORT_APP:
+		packet.decoded.CopyFrom(data)
+	else:
+		encryptor        = Cipher(algorithms.AES(key), modes.CTR(NONCE.pack(packet_id, node))).encryptor()
+		packet.encrypted = encryptor.update(data.SerializeToString()) + encryptor.finalize()
+
+	return mqtt_pb2.ServiceEnvelope(packet=packet, channel_id=channel, gateway_id=gateway or f'!{rng.getrandbits(32):08x}').SerializeToString()
+
+
+def generate(count: int, mix: dict, key: str = 'AQ==', seed: int = 1) -> list:
+	'''
+	Generate (topic, payload) messages with port numbers drawn from a traffic mix.
+
+	:param count: The number of messages to generate
+	:param mix:   Port number -> relative weight
+	:param key:   The encryption key
+	:param seed:  The random seed, so runs are reproducible
+	'''
+
+	rng       = random.Random(seed)
+	key_bytes = decode_key(key)
+	ports     = rng.choices(list(mix), weights=list(mix.values()), k=count)
+	gateways  = [f'!{rng.getrandbits(32):08x}' for _ in range(64)]
+	messages  = []
+
+	# Gateways uplink under their own id, so topics repeat like they do on a real broker
+	for packet_id, portnum in enumerate(ports):
+		gateway = rng.choice(gateways)
+		messages.append((f'msh/US/2/e/LongFast/{gateway}', generate_envelope(portnum, rng, key_bytes, packet_id + 1, 'LongFast', gateway)))
+
+	return messages
+
+
+def bench_stages(messages: list, key: str, format: str) -> dict:
+	'''
+	Time each stage of the decode hot path separately.
+
+	:param messages: The (topic, payload) messages
+	:param key:      The encryption key
+	:param format:   The structured output format to time the format & emit stages with
+	'''
+
+	client = MeshtasticMQTT(workers=0, dedup_size=0)
+	client.set_key(key)
+
+	output = Output(io.BytesIO(), format)
+	stages = {'parse_envelope': 0.0, 'decrypt': 0.0, 'parse_payload': 0.0, 'format': 0.0, 'emit': 0.0}
+
+	for topic, payload in messages:
+		started = time.perf_counter()
+
+		service_envelope = mqtt_pb2.ServiceEnvelope()
+		service_envelope.ParseFromString(payload)
+		message_packet = service_envelope.packet
+
+		parsed = time.perf_counter()
+
+		if message_packet.HasField('encrypted'):
+			client.decrypt_message_packet(message_packet, service_envelope.channel_id)
+
+		decrypted = time.perf_counter()
+
+		message_class, _ = client.handlers[message_packet.decoded.portnum]
+		if message_class:
+			data = message_class()
+			data.ParseFromString(message_packet.decoded.payload)
+		else:
+			data = message_packet.decoded.payload
+
+		payload_parsed = time.perf_counter()
+
+		record = client.record(service_envelope, data)
+
+		formatted = time.perf_counter()
+
+		output.emit(record)
+
+		emitted = time.perf_counter()
+
+		stages['parse_envelope'] += parsed - started
+		stages['decrypt']        += decrypted - parsed
+		stages['parse_payload']  += payload_parsed - decrypted
+		stages['format']         += formatted - payload_parsed
+		stages['emit']           += emitted - formatted
+
+	total = sum(stages.values())
+
+	return {
+		'messages_per_sec' : len(messages) / total,
+		'stages_us'        : {stage: seconds / len(messages) * 1e6 for stage, seconds in stages.items()},
+		'output_bytes'     : output.stream.tell()
+	}
+
+
+def bench_decrypt(messages: list, key: str, batch_size: int) -> dict:
+	'''
+	Compare decrypting packets one at a time with a fresh CTR cipher each (with and without deriving the key per packet) against the batched decrypt stage.
+
+	:param messages:   The (topic, payload) messages
+	:param key:        The encryption key
+	:param batch_size: The number of packets decrypted together
+	'''
+
+	client = MeshtasticMQTT(workers=0, dedup_size=0)
+	client.set_key(key)
+
+	def packets():
+		envelopes = [mqtt_pb2.ServiceEnvelope.FromString(payload) for _, payload in messages]
+		return [(service_envelope.packet, service_envelope.channel_id) for service_envelope in envelopes if service_envelope.packet.HasField('encrypted')]
+
+	# The key decoded and a new AES algorithm built for every packet, like before keys were cached
+	batch   = packets()
+	started = time.perf_counter()
+
+	for message_packet, _ in batch:
+		decryptor = Cipher(algorithms.AES(decode_key(key)), modes.CTR(NONCE.pack(message_packet.id, getattr(message_packet, 'from')))).decryptor()
+		data      = mesh_pb2.Data()
+		data.ParseFromString(decryptor.update(message_packet.encrypted) + decryptor.finalize())
+		message_packet.decoded.CopyFrom(data)
+
+	derived = time.perf_counter() - started
+
+	# One Cipher and decryptor per packet around the cached key, parsed into a new Data and copied into the packet
+	algorithm = algorithms.AES(decode_key(key))
+	batch     = packets()
+	started   = time.perf_counter()
+
+	for message_packet, _ in batch:
+		decryptor = Cipher(algorithm, modes.CTR(NONCE.pack(message_packet.id, getattr(message_packet, 'from')))).decryptor()
+		data      = mesh_pb2.Data()
+		data.ParseFromString(decryptor.update(message_packet.encrypted) + decryptor.finalize())
+		message_packet.decoded.CopyFrom(data)
+
+	per_packet = time.perf_counter() - started
+	batch      = packets()
+	started    = time.perf_counter()
+
+	for position in range(0, len(batch), batch_size):
+		client.decrypt_packets(batch[position:position + batch_size])
+
+	batched = time.perf_counter() - started
+
+	return {'packets': len(batch), 'batch_size': batch_size, 'derived_key_per_sec': len(batch) / derived, 'per_packet_per_sec': len(batch) / per_packet, 'batched_per_sec': len(batch) / batched}
+
+
+def bench_pipeline(messages: list, key: str, batch_size: int = 1) -> dict:
+	'''
+	Time the full decode pipeline inline (decode only, nothing is logged or emitted).
+
+	:param messages:   The (topic, payload) messages
+	:param key:        The encryption key
+	:param batch_size: The number of messages decoded together (like a worker draining its queue)
+	'''
+
+	client = MeshtasticMQTT(workers=0, dedup_size=0)
+	client.set_key(key)
+
+	started = time.perf_counter()
+
+	for position in range(0, len(messages), batch_size):
+		client.process_messages([(topic, payload, None, None) for topic, payload in messages[position:position + batch_size]])
+
+	elapsed = time.perf_counter() - started
+
+	return {'batch_size': batch_size, 'messages_per_sec': len(messages) / elapsed, 'stats': client.stats()}
+
+
+class Broker(object):
+	def __init__(self):
+		'''Initialize a minimal MQTT 3.1.1 stand-in broker (QoS 0 only) for end-to-end benchmarks'''
+
+		self.subscriptions = {} # Writer -> topic filters
+
+
+	@staticmethod
+	def packet(header: int, body: bytes) -> bytes:
+		'''
+		Build an MQTT packet.
+
+		:param header: The fixed header byte
+		:param body:   The variable header & payload
+		'''
+
+		data, length = bytearray([header]), len(body)
+
+		while True:
+			byte, length = length % 128, length // 128
+			data.append(byte | (0x80 if length else 0))
+			if not length:
+				break
+
+		return bytes(data) + body
+
+
+	@staticmethod
+	def publish(topic: str, payload: bytes) -> bytes:
+		'''
+		Build an MQTT PUBLISH packet.
+
+		:param topic:   The topic
+		:param payload: The payload
+		'''
+
+		topic = topic.encode('utf-8')
+
+		return Broker.packet(0x30, struct.pack('>H', len(topic)) + topic + payload)
+
+
+	async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		'''
+		Handle a client connection.
+
+		:param reader: The client stream reader
+		:param writer: The client stream writer
+		'''
+
+		try:
+			while True:
+				header = (await reader.readexactly(1))[0]
+
+				length, multiplier = 0, 1
+				while True:
+					byte        = (await reader.readexactly(1))[0]
+					length     += (byte & 0x7f) * multiplier
+					multiplier *= 128
+					if not byte & 0x80:
+						break
+
+				body        = await reader.readexactly(length)
+				packet_type = header >> 4
+
+				if packet_type == 1: # CONNECT
+					writer.write(b'\x20\x02\x00\x00')
+
+				elif packet_type == 8: # SUBSCRIBE
+					position, codes = 2, b''
+					while position < len(body):
+						size      = struct.unpack('>H', body[position:position + 2])[0]
+						position += 2
+						self.subscriptions.setdefault(writer, []).append(body[position:position + size].decode('utf-8'))
+						position += size + 1
+						codes    += b'\x00'
+					writer.write(self.packet(0x90, body[:2] + codes))
+
+				elif packet_type == 3: # PUBLISH
+					size  = struct.unpack('>H', body[:2])[0]
+					topic = body[2:2 + size].decode('utf-8')
+					for subscriber, patterns in list(self.subscriptions.items()):
+						if any(topic_matches(pattern, topic) for pattern in patterns):
+							subscriber.write(self.packet(0x30, body))
+							await subscriber.drain()
+
+				elif packet_type == 12: # PINGREQ
+					writer.write(b'\xd0\x00')
+
+				elif packet_type == 14: # DISCONNECT
+					break
+
+				await writer.drain()
+
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+
+		finally:
+			self.subscriptions.pop(writer, None)
+			writer.close()
+
+
+def generate_nodes(count: int, seed: int = 1) -> list:
+	'''
+	Generate the NodeInfo messages of a radio's node database.
+
+	:param count: The number of nodes
+	:param seed:  The random seed, so runs are reproducible
+	'''
+
+	rng   = random.Random(seed)
+	nodes = []
+
+	for _ in range(count):
+		num  = rng.getrandbits(32)
+		node = mesh_pb2.NodeInfo(num=num, snr=rng.uniform(-20, 10), last_heard=int(time.time()) - rng.randint(0, 86400), hops_away=rng.randint(0, 7))
+
+		node.user.CopyFrom(mesh_pb2.User(id=f'!{num:08x}', long_name=f'Node {num:08x}', short_name=f'{num:04x}'[-4:], hw_model=rng.choice((mesh_pb2.HELTEC_V3, mesh_pb2.TBEAM, mesh_pb2.RAK4631, mesh_pb2.T_ECHO))))
+
+		if rng.random() < 0.7:
+			node.position.CopyFrom(mesh_pb2.Position(latitude_i=rng.randint(-900_000_000, 900_000_000), longitude_i=rng.randint(-1_800_000_000, 1_800_000_000), altitude=rng.randint(0, 3000)))
+
+		if rng.random() < 0.8:
+			node.device_metrics.CopyFrom(telemetry_pb2.DeviceMetrics(battery_level=rng.randint(1, 101), voltage=rng.uniform(3.3, 4.2), channel_utilization=rng.uniform(0, 40), air_util_tx=rng.uniform(0, 5), uptime_seconds=rng.randint(0, 10_000_000)))
+
+		nodes.append(node)
+
+	return nodes
+
+
+def bench_snapshot(counts: list, seed: int = 1) -> dict:
+	'''
+	Compare waiting for the radio to send its node database against a warm start from a node snapshot.
+
+	:param counts: The node database sizes to measure
+	:param seed:   The random seed
+	'''
+
+	results = {}
+
+	for count in counts:
+		nodes = generate_nodes(count, seed)
+		size  = sum(HEADER.size + len(mesh_pb2.FromRadio(node_info=node).SerializeToString()) for node in nodes)
+
+		with tempfile.TemporaryDirectory() as directory:
+			path = os.path.join(directory, 'nodes.db')
+
+			# The snapshot is written from the dictionaries the meshtastic library publishes, like meshapi does
+			store = NodeStore()
+			for node in nodes:
+				store.update_dict(MessageToDict(node))
+
+			snapshot = NodeSnapshot(path)
+			snapshot.close(store)
+
+			# A cold start opens the snapshot, loads it and looks up a sender
+			started  = time.perf_counter()
+			store    = NodeStore()
+			snapshot = NodeSnapshot(path)
+			loaded   = snapshot.load(store)
+			found    = store.get(nodes[-1].num) is not None
+			elapsed  = time.perf_counter() - started
+
+			snapshot.close()
+
+		results[count] = {'download_bytes': size, 'download_sec': size * 10 / BAUD_RATE, 'loaded': loaded, 'found': found, 'load_ms': elapsed * 1000}
+
+	return results
+
+
+def docs_corpus(directory: str) -> list:
+	'''
+	Return the prose lines of the markdown files in a directory, a corpus written independently of the compression dictionary.
+
+	:param directory: The directory of markdown files
+	'''
+
+	texts = []
+
+	for name in sorted(os.listdir(directory)):
+		if not name.endswith('.md'):
+			continue
+
+		with open(os.path.join(directory, name), encoding='utf-8') as document:
+			for line in document:
+				# Headings, tables, images and code are not like anything sent as a message
+				if line.startswith(('#', '|', '!', '```', '    ', '\t')):
+					continue
+
+				if 10 <= len(text := line.strip().lstrip('-*> ').strip()) <= 200:
+					texts.append(text)
+
+	return texts
+
+
+def bench_compression(texts: list) -> dict:
+	'''
+	Measure the on-air bytes saved by sending text compressed, and the time to compress and decompress it.
+
+	:param texts: The text messages
+	'''
+
+	started = time.perf_counter()
+	packets = [encode(text, True) for text in texts]
+	encoded = time.perf_counter() - started
+
+	plain      = sum(on_air(portnums_pb2.TEXT_MESSAGE_APP, text.encode('utf-8')) for text in texts)
+	compressed = sum(on_air(portnum, payload) for packet in packets for portnum, payload in packet)
+	texts_in   = Reassembler()
+
+	started = time.perf_counter()
+	for packet in packets:
+		for portnum, payload in packet:
+			if portnum == PORTNUM:
+				texts_in.receive(1, payload)
+	decoded = time.perf_counter() - started
+
+	return {
+		'messages'      : len(texts),
+		'compressed'    : sum(1 for packet in packets if packet[0][0] == PORTNUM),
+		'on_air_plain'  : plain,
+		'on_air_sent'   : compressed,
+		'saved_percent' : (1 - compressed / plain) * 100 if plain else 0.0,
+		'encode_us'     : encoded / len(texts) * 1e6 if texts else 0.0,
+		'decode_us'     : decoded / len(texts) * 1e6 if texts else 0.0
+	}
+
+
+def bench_broker(messages: list, key: str, workers: int) -> dict:
+	'''
+	Time the full client loop end to end through a local stand-in broker.
+
+	:param messages: The (topic, payload) messages
+	:param key:      The encryption key
+	:param workers:  The number of client worker threads
+	'''
+
+	loop   = asyncio.new_event_loop()
+	broker = Broker()
+	server = loop.run_until_complete(asyncio.start_server(broker.handle, '127.0.0.1', 0))
+	port   = server.sockets[0].getsockname()[1]
+
+	threading.Thread(target=loop.run_forever, daemon=True).start()
+
+	client = MeshtasticMQTT(workers=workers, queue_size=len(messages), dedup_size=0)
+	threading.Thread(target=client.connect, args=('127.0.0.1', port, 'msh/#', False, None, None, key), daemon=True).start()
+
+	# Wait for the client to subscribe
+	while not broker.subscriptions:
+		time.sleep(0.01)
+
+	async def publish():
+		reader, writer = await asyncio.open_connection('127.0.0.1', port)
+		writer.write(Broker.packet(0x10, b'\x00\x04MQTT\x04\x02\x00\x3c\x00\x00'))
+		await reader.readexactly(4)
+		for topic, payload in messages:
+			writer.write(Broker.publish(topic, payload))
+			await writer.drain()
+		writer.close()
+
+	started = time.perf_counter()
+
+	asyncio.run_coroutine_threadsafe(publish(), loop).result()
+
+	while (stats := client.stats()).get('processed', 0) + stats.get('dropped', 0) < len(messages):
+		time.sleep(0.001)
+
+	elapsed = time.perf_counter() - started
+
+	return {'messages_per_sec': len(messages) / elapsed, 'stats': client.stats()}
+
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Meshtastic MQTT Benchmark')
+	parser.add_argument('--count', default=50000, type=int, help='Number of messages to generate')
+	parser.add_argument('--mix', default='telemetry=60,position=25,nodeinfo=10,text=5', help='Traffic mix of port=weight pairs (or "all" for every port)')
+	parser.add_argument('--key', default='AQ==', help='Encryption key')
+	parser.add_argument('--seed', default=1, type=int, help='Random seed')
+	parser.add_argument('--format', default='json', choices=('json', 'msgpack'), help='Output format for the format & emit stages')
+	parser.add_argument('--broker', action='store_true', help='Also benchmark the full client loop through a local stand-in broker')
+	parser.add_argument('--workers', default=1, type=int, help='Client worker threads for the broker benchmark')
+	parser.add_argument('--batch-size', default=BATCH_SIZE, type=int, help='Messages decoded together for the decrypt and batched pipeline benchmarks')
+	parser.add_argument('--nodes', default='250,1000,5000', help='Node database sizes for the snapshot warm start benchmark')
+	parser.add_argument('--corpus', help='File of text messages (one per line) to measure compression on instead of the prose in docs/')
+	args = parser.parse_args()
+
+	# Only warnings and errors, the benchmark is about decoding not logging
+	logging.getLogger().setLevel(logging.WARNING)
+
+	messages = generate(args.count, parse_mix(args.mix), args.key, args.seed)
+	results  = {
+		'count'            : args.count,
+		'mix'              : args.mix,
+		'stages'           : bench_stages(messages, args.key, args.format),
+		'decrypt'          : bench_decrypt(messages, args.key, args.batch_size),
+		'pipeline'         : bench_pipeline(messages, args.key),
+		'pipeline_batched' : bench_pipeline(messages, args.key, args.batch_size),
+		'snapshot'         : bench_snapshot([int(count) for count in args.nodes.split(',')], args.seed)
+	}
+
+	if args.corpus:
+		with open(args.corpus, encoding='utf-8') as corpus:
+			texts = [line.rstrip('\n') for line in corpus if line.strip()]
+	else:
+		texts = docs_corpus(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'docs'))
+
+	results['compression'] = bench_compression(texts)
+
+	if args.broker:
+		results['broker'] = bench_broker(messages, args.key, args.workers)
+
+	print(json.dumps(results, indent=4))
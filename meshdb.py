@@ -0,0 +1,1264 @@
+#!/usr/bin/env python
+# Meshtastic Node Database - Developed by acidvegas in Python (https://acid.vegas/meshtastic)
+
+import heapq
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+try:
+	from meshtastic import mesh_pb2, mqtt_pb2, portnums_pb2, telemetry_pb2
+except ImportError:
+	raise SystemExit('missing the meshtastic module (pip install meshtastic)')
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+# Width in seconds of the buckets nodes are grouped into by the time they were last heard
+BUCKET = 60
+
+# Width in degrees of the grid cells positions are indexed into (~11km of latitude)
+CELL = 0.1
+
+# Widths in degrees of the coarser cells the grid is grouped under for nearest neighbour searches
+LEVELS = (30, 10, 2, 0.5)
+
+# Telemetry variants kept in ring buffers and the number of samples kept per node
+TELEMETRY = ('device_metrics', 'environment_metrics')
+WINDOW    = 128
+
+# Seconds after which a link between nodes that has not been reported again is dropped
+LINK_TTL = 3 * 60 * 60
+
+# Node number used for broadcasts and for hops a traceroute could not identify
+BROADCAST = 0xFFFFFFFF
+
+# Mean radius of the earth in kilometers
+EARTH_RADIUS = 6371.0088
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+	'''
+	Return the great-circle distance in kilometers between two points.
+
+	:param lat1: The latitude of the first point in degrees
+	:param lon1: The longitude of the first point in degrees
+	:param lat2: The latitude of the second point in degrees
+	:param lon2: The longitude of the second point in degrees
+	'''
+
+	lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+
+	a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+
+	return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class Node(object):
+	__slots__ = ('num', 'id', 'long_name', 'short_name', 'hw_model', 'role', 'latitude_i', 'longitude_i', 'altitude', 'battery_level', 'voltage', 'channel_utilization', 'air_util_tx', 'uptime_seconds', 'last_heard', 'hops_away', 'snr')
+
+	def __init__(self, num: int):
+		'''
+		Initialize a node record
+
+		:param num: The node number
+		'''
+
+		self.num = num
+		self.id  = f'!{num:08x}'
+
+		for field in self.__slots__[2:]:
+			setattr(self, field, None)
+
+
+	def __repr__(self):
+		return f'<Node {self.id} {self.long_name!r}>'
+
+
+	def to_dict(self) -> dict:
+		'''Return the fields of the node that are set'''
+
+		return {field: value for field in self.__slots__ if (value := getattr(self, field)) is not None}
+
+
+class SpatialIndex(object):
+	def __init__(self, cell: float = CELL):
+		'''
+		Initialize a grid index of node positions
+
+		:param cell: The width in degrees of a grid cell
+		'''
+
+		self.cell      = cell
+		self.columns   = math.ceil(360 / cell) # Longitude cells wrap around the antimeridian
+		self.sizes     = tuple(size for size in LEVELS if size > cell) + (cell,)
+		self.positions = {} # Node number -> (latitude, longitude)
+		self.cells     = {} # (row, column) -> node numbers in that cell
+		self.tree      = [{} for _ in self.sizes[1:]] # Per coarse level, (row, column) -> {child cell: node count}
+
+
+	def __len__(self):
+		return len(self.positions)
+
+
+	def locate(self, latitude: float, longitude: float) -> tuple:
+		'''
+		Return the grid cell a position falls in.
+
+		:param latitude:  The latitude in degrees
+		:param longitude: The longitude in degrees
+		'''
+
+		return int((latitude + 90) // self.cell), int((longitude + 180) // self.cell) % self.columns
+
+
+	def path(self, latitude: float, longitude: float) -> tuple:
+		'''
+		Return the cells a position falls in at every level, coarsest first.
+
+		:param latitude:  The latitude in degrees
+		:param longitude: The longitude in degrees
+		'''
+
+		return tuple((int((latitude + 90) // size), int((longitude + 180) // size) % math.ceil(360 / size)) for size in self.sizes)
+
+
+	def link(self, path: tuple, amount: int):
+		'''
+		Add to (or subtract from) the node counts along a path of cells.
+
+		:param path:   The cells at every level, coarsest first
+		:param amount: The count to add
+		'''
+
+		for level, children in enumerate(self.tree):
+			counts = children.setdefault(path[level], {})
+			counts[path[level + 1]] = counts.get(path[level + 1], 0) + amount
+
+			if not counts[path[level + 1]]:
+				del counts[path[level + 1]]
+				if not counts:
+					del children[path[level]]
+
+
+	def update(self, num: int, latitude: float, longitude: float):
+		'''
+		Add or move a node in the index.
+
+		:param num:       The node number
+		:param latitude:  The latitude in degrees
+		:param longitude: The longitude in degrees
+		'''
+
+		path = self.path(latitude, longitude)
+
+		if (previous := self.positions.get(num)):
+			old = self.path(*previous)
+			if old == path:
+				self.positions[num] = (latitude, longitude)
+				return
+			self.remove(num)
+
+		self.positions[num] = (latitude, longitude)
+		self.cells.setdefault(path[-1], set()).add(num)
+		self.link(path, 1)
+
+
+	def remove(self, num: int):
+		'''
+		Remove a node from the index.
+
+		:param num: The node number
+		'''
+
+		if (previous := self.positions.pop(num, None)):
+			path = self.path(*previous)
+			self.cells[path[-1]].discard(num)
+			if not self.cells[path[-1]]:
+				del self.cells[path[-1]]
+			self.link(path, -1)
+
+
+	def scan(self, rows: range, columns: list):
+		'''
+		Yield the node numbers in a block of grid cells.
+
+		:param rows:    The cell rows
+		:param columns: The cell columns
+		'''
+
+		# Walk the block of cells (or the populated cells, whichever is fewer)
+		if len(rows) * len(columns) <= len(self.cells):
+			for row in rows:
+				for column in columns:
+					if (nums := self.cells.get((row, column))):
+						yield from nums
+		else:
+			columns = set(columns)
+			for (row, column), nums in self.cells.items():
+				if row in rows and column in columns:
+					yield from nums
+
+
+	def block(self, south: float, west: float, north: float, east: float) -> tuple:
+		'''
+		Return the rows and columns of grid cells covering a bounding box.
+
+		:param south: The southern latitude in degrees
+		:param west:  The western longitude in degrees
+		:param north: The northern latitude in degrees
+		:param east:  The eastern longitude in degrees (less than west when the box crosses the antimeridian)
+		'''
+
+		first_row, first_column = self.locate(max(south, -90), west)
+		last_row,  last_column  = self.locate(min(north, 90), east)
+
+		if east - west >= 360:
+			columns = list(range(self.columns))
+		elif last_column >= first_column and east >= west:
+			columns = list(range(first_column, last_column + 1))
+		else:
+			columns = list(range(first_column, self.columns)) + list(range(0, last_column + 1))
+
+		return range(first_row, last_row + 1), columns
+
+
+	def bbox(self, south: float, west: float, north: float, east: float) -> list:
+		'''
+		Return the node numbers inside a bounding box.
+
+		:param south: The southern latitude in degrees
+		:param west:  The western longitude in degrees
+		:param north: The northern latitude in degrees
+		:param east:  The eastern longitude in degrees (less than west when the box crosses the antimeridian)
+		'''
+
+		positions = self.positions
+		crosses   = east < west
+		results   = []
+
+		for num in self.scan(*self.block(south, west, north, east)):
+			latitude, longitude = positions[num]
+			if south <= latitude <= north and ((west <= longitude or longitude <= east) if crosses else (west <= longitude <= east)):
+				results.append(num)
+
+		return results
+
+
+	def radius(self, latitude: float, longitude: float, kilometers: float) -> list:
+		'''
+		Return (distance, node number) pairs within a distance of a point, nearest first.
+
+		:param latitude:   The latitude in degrees
+		:param longitude:  The longitude in degrees
+		:param kilometers: The distance in kilometers
+		'''
+
+		delta_latitude = math.degrees(kilometers / EARTH_RADIUS)
+		south, north   = latitude - delta_latitude, latitude + delta_latitude
+
+		# Near the poles the circle covers every longitude
+		if south <= -90 or north >= 90:
+			west, east = -180, 180
+		else:
+			delta_longitude = math.degrees(kilometers / (EARTH_RADIUS * math.cos(math.radians(max(abs(south), abs(north))))))
+			west, east      = (-180, 180) if delta_longitude >= 180 else ((longitude - delta_longitude + 180) % 360 - 180, (longitude + delta_longitude + 180) % 360 - 180)
+
+		results = []
+
+		for num in self.scan(*self.block(south, west, north, east)):
+			if (distance := haversine(latitude, longitude, *self.positions[num])) <= kilometers:
+				results.append((distance, num))
+
+		return sorted(results)
+
+
+	def bound(self, latitude: float, longitude: float, cosine: float, level: int, cell: tuple) -> float:
+		'''
+		Return a lower bound in kilometers on the distance from a point to anything inside a cell.
+
+		:param latitude:  The latitude in degrees
+		:param longitude: The longitude in degrees
+		:param cosine:    The cosine of the latitude
+		:param level:     The level of the cell
+		:param cell:      The (row, column) of the cell
+		'''
+
+		size  = self.sizes[level]
+		south = cell[0] * size - 90
+		east  = (longitude - (cell[1] * size - 180)) % 360 # Degrees east of the western edge of the cell
+
+		delta_latitude = max(0, south - latitude, latitude - south - size)
+
+		# Longitude only bounds the distance by how far the point is from the nearest meridian of the cell, using the
+		# sine of that distance since it never exceeds the distance itself
+		if east <= size:
+			return EARTH_RADIUS * math.radians(delta_latitude)
+
+		across = cosine * math.sin(math.radians(min(east - size, 360 - east, 90)))
+
+		return EARTH_RADIUS * max(math.radians(delta_latitude), across)
+
+
+	def nearest(self, latitude: float, longitude: float, count: int = 1) -> list:
+		'''
+		Return the (distance, node number) pairs of the nearest nodes to a point, nearest first.
+
+		:param latitude:  The latitude in degrees
+		:param longitude: The longitude in degrees
+		:param count:     The number of nodes to return
+		'''
+
+		if count <= 0:
+			return []
+
+		nodes   = len(self.sizes)
+		cosine  = math.cos(math.radians(latitude))
+		top     = self.tree[0] if self.tree else self.cells
+		heap    = [(self.bound(latitude, longitude, cosine, 0, cell), 0, cell) for cell in top]
+		best    = [] # Negated distances of the closest nodes pushed so far
+		results = []
+
+		heapq.heapify(heap)
+
+		# Best-first search down the cell levels, a node popped off the heap is closer than anything left on it
+		while heap and len(results) < count:
+			distance, level, item = heapq.heappop(heap)
+
+			if level == nodes:
+				results.append((distance, item))
+
+			elif level == nodes - 1:
+				for num in self.cells[item]:
+					distance = haversine(latitude, longitude, *self.positions[num])
+					if len(best) < count:
+						heapq.heappush(best, -distance)
+					elif distance < -best[0]:
+						heapq.heapreplace(best, -distance)
+					else:
+						continue
+					heapq.heappush(heap, (distance, nodes, num))
+
+			else:
+				# Cells further than the count closest nodes seen so far can never hold a result
+				limit = -best[0] if len(best) == count else math.inf
+				for child in self.tree[level][item]:
+					if (distance := self.bound(latitude, longitude, cosine, level + 1, child)) <= limit:
+						heapq.heappush(heap, (distance, level + 1, child))
+
+		return results
+
+
+class NodeStore(object):
+	def __init__(self):
+		'''Initialize the node store'''
+
+		self.lock    = threading.RLock()
+		self.nodes   = {} # Node number -> Node
+		self.buckets = {} # Last heard time // BUCKET -> node numbers heard in that window
+		self.spatial = SpatialIndex()
+		self.changed = set() # Node numbers updated since the last snapshot flush
+
+
+	def __len__(self):
+		return len(self.nodes)
+
+
+	def __contains__(self, num: int):
+		return num in self.nodes
+
+
+	def __iter__(self):
+		return iter(list(self.nodes.values()))
+
+
+	def get(self, num: int) -> Node:
+		'''
+		Return the node record for a node number (or None if we have never heard it).
+
+		:param num: The node number
+		'''
+
+		return self.nodes.get(num)
+
+
+	def node(self, num: int) -> Node:
+		'''
+		Return the node record for a node number, creating it if needed.
+
+		:param num: The node number
+		'''
+
+		if not (node := self.nodes.get(num)):
+			node = self.nodes[num] = Node(num)
+
+		# Every update goes through here, so the snapshot only rewrites the nodes that changed
+		self.changed.add(num)
+
+		return node
+
+
+	def heard(self, num: int, timestamp: float = None, hops_away: int = None, snr: float = None) -> Node:
+		'''
+		Record that a node was heard, moving it to the right last heard bucket.
+
+		:param num:       The node number
+		:param timestamp: The unix time the node was heard (defaults to now)
+		:param hops_away: The number of hops the packet took
+		:param snr:       The SNR the packet was received with
+		'''
+
+		timestamp = timestamp or time.time()
+
+		with self.lock:
+			return self.move(self.node(num), timestamp, hops_away, snr)
+
+
+	def move(self, node: Node, timestamp: float, hops_away: int = None, snr: float = None) -> Node:
+		'''
+		Update when a node was last heard and the bucket it is indexed in (the lock must be held).
+
+		:param node:      The node record
+		:param timestamp: The unix time the node was heard
+		:param hops_away: The number of hops the packet took
+		:param snr:       The SNR the packet was received with
+		'''
+
+		num = node.num
+
+		# Only move forward in time, older reports (like a radio's node database) don't make a node less recent
+		if node.last_heard is None or timestamp > node.last_heard:
+			if node.last_heard is not None:
+				bucket = self.buckets[int(node.last_heard // BUCKET)]
+				bucket.discard(num)
+				if not bucket:
+					del self.buckets[int(node.last_heard // BUCKET)]
+
+			self.buckets.setdefault(int(timestamp // BUCKET), set()).add(num)
+			node.last_heard = timestamp
+
+		if hops_away is not None:
+			node.hops_away = hops_away
+		if snr is not None:
+			node.snr = snr
+
+		return node
+
+
+	def locate(self, node: Node, latitude_i: int, longitude_i: int, altitude: int = None):
+		'''
+		Update the position of a node and move it in the spatial index (the lock must be held).
+
+		:param node:        The node record
+		:param latitude_i:  The latitude in 1e-7 degrees
+		:param longitude_i: The longitude in 1e-7 degrees
+		:param altitude:    The altitude in meters
+		'''
+
+		node.latitude_i  = latitude_i
+		node.longitude_i = longitude_i
+		node.altitude    = altitude
+
+		self.spatial.update(node.num, latitude_i / 1e7, longitude_i / 1e7)
+
+
+	def bbox(self, south: float, west: float, north: float, east: float) -> list:
+		'''
+		Return the nodes inside a bounding box.
+
+		:param south: The southern latitude in degrees
+		:param west:  The western longitude in degrees
+		:param north: The northern latitude in degrees
+		:param east:  The eastern longitude in degrees (less than west when the box crosses the antimeridian)
+		'''
+
+		with self.lock:
+			return [self.nodes[num] for num in self.spatial.bbox(south, west, north, east)]
+
+
+	def radius(self, latitude: float, longitude: float, kilometers: float) -> list:
+		'''
+		Return (distance in kilometers, node) pairs within a distance of a point, nearest first.
+
+		:param latitude:   The latitude in degrees
+		:param longitude:  The longitude in degrees
+		:param kilometers: The distance in kilometers
+		'''
+
+		with self.lock:
+			return [(distance, self.nodes[num]) for distance, num in self.spatial.radius(latitude, longitude, kilometers)]
+
+
+	def nearest(self, latitude: float, longitude: float, count: int = 1) -> list:
+		'''
+		Return (distance in kilometers, node) pairs for the nearest nodes to a point, nearest first.
+
+		:param latitude:  The latitude in degrees
+		:param longitude: The longitude in degrees
+		:param count:     The number of nodes to return
+		'''
+
+		with self.lock:
+			return [(distance, self.nodes[num]) for distance, num in self.spatial.nearest(latitude, longitude, count)]
+
+
+	def recent(self, seconds: float, now: float = None) -> list:
+		'''
+		Return the nodes heard within a number of seconds, without scanning every node.
+
+		:param seconds: How far back to look
+		:param now:     The current unix time (defaults to now)
+		'''
+
+		cutoff = (now or time.time()) - seconds
+		first  = int(cutoff // BUCKET)
+		last   = int((now or time.time()) // BUCKET)
+
+		with self.lock:
+			# Walk the buckets in the window (or the populated buckets, whichever is fewer)
+			if last - first < len(self.buckets):
+				buckets = (self.buckets.get(position, ()) for position in range(first, last + 1))
+			else:
+				buckets = (nums for position, nums in self.buckets.items() if position >= first)
+
+			return [self.nodes[num] for nums in buckets for num in nums if self.nodes[num].last_heard >= cutoff]
+
+
+	def update_packet(self, message_packet, data=None) -> Node:
+		'''
+		Update the store from a decoded MQTT mesh packet and its parsed payload.
+
+		:param message_packet: The decoded mesh packet
+		:param data:           The parsed payload for the packet's port number
+		'''
+
+		num     = getattr(message_packet, 'from')
+		portnum = message_packet.decoded.portnum
+		hops    = message_packet.hop_start - message_packet.hop_limit if message_packet.hop_start else None
+
+		with self.lock:
+			node = self.heard(num, None, hops, message_packet.rx_snr or None)
+
+			if portnum == portnums_pb2.NODEINFO_APP and isinstance(data, mesh_pb2.User):
+				node.long_name  = data.long_name
+				node.short_name = data.short_name
+				node.hw_model   = data.hw_model
+				node.role       = data.role
+
+			elif portnum == portnums_pb2.POSITION_APP and isinstance(data, mesh_pb2.Position):
+				if data.latitude_i or data.longitude_i:
+					self.locate(node, data.latitude_i, data.longitude_i, data.altitude)
+
+			elif portnum == portnums_pb2.MAP_REPORT_APP and isinstance(data, mqtt_pb2.MapReport):
+				node.long_name  = data.long_name
+				node.short_name = data.short_name
+				node.hw_model   = data.hw_model
+				node.role       = data.role
+				if data.latitude_i or data.longitude_i:
+					self.locate(node, data.latitude_i, data.longitude_i, data.altitude)
+
+			elif portnum == portnums_pb2.TELEMETRY_APP and isinstance(data, telemetry_pb2.Telemetry) and data.HasField('device_metrics'):
+				metrics = data.device_metrics
+				node.battery_level       = metrics.battery_level
+				node.voltage             = metrics.voltage
+				node.channel_utilization = metrics.channel_utilization
+				node.air_util_tx         = metrics.air_util_tx
+				node.uptime_seconds      = metrics.uptime_seconds
+
+		return node
+
+
+	def update_dict(self, info: dict) -> Node:
+		'''
+		Update the store from a node dictionary as published by the meshtastic library (meshtastic.node events).
+
+		:param info: The node dictionary
+		'''
+
+		with self.lock:
+			node = self.node(info['num'])
+
+			# Nodes from the radio's database that were never heard keep an empty last heard time
+			if info.get('lastHeard'):
+				self.move(node, info['lastHeard'], info.get('hopsAway'), info.get('snr'))
+
+			if (user := info.get('user')):
+				node.long_name  = user.get('longName')
+				node.short_name = user.get('shortName')
+				node.hw_model   = user.get('hwModel')
+				node.role       = user.get('role')
+
+			if (position := info.get('position')) and ('latitudeI' in position or 'longitudeI' in position):
+				self.locate(node, position.get('latitudeI', 0), position.get('longitudeI', 0), position.get('altitude'))
+
+			if (metrics := info.get('deviceMetrics')):
+				node.battery_level       = metrics.get('batteryLevel')
+				node.voltage             = metrics.get('voltage')
+				node.channel_utilization = metrics.get('channelUtilization')
+				node.air_util_tx         = metrics.get('airUtilTx')
+				node.uptime_seconds      = metrics.get('uptimeSeconds')
+
+		return node
+
+
+class NodeSnapshot(object):
+	def __init__(self, path: str, flush_interval: float = 5.0):
+		'''
+		Initialize an on-disk snapshot of a node store, so a restart has the nodes before the radio resends them
+
+		:param path:           The SQLite database file
+		:param flush_interval: Seconds between writes of the changed nodes
+		'''
+
+		self.path           = path
+		self.flush_interval = flush_interval
+		self.fields         = Node.__slots__[2:] # The node number is the key and the id is derived from it
+		self.lock           = threading.Lock()
+		self.stopping       = threading.Event()
+		self.thread         = None # The flushing thread while running
+		self.database       = sqlite3.connect(path, check_same_thread=False)
+
+		# Columns are untyped, the library gives enum names where MQTT gives numbers
+		self.database.execute('PRAGMA journal_mode=WAL')
+		self.database.execute('PRAGMA synchronous=NORMAL')
+		self.database.execute(f'CREATE TABLE IF NOT EXISTS nodes (num INTEGER PRIMARY KEY, {", ".join(self.fields)})')
+		self.database.commit()
+
+		self.upsert = f'INSERT OR REPLACE INTO nodes (num, {", ".join(self.fields)}) VALUES ({", ".join("?" * (len(self.fields) + 1))})'
+
+
+	def load(self, store: NodeStore) -> int:
+		'''
+		Load the snapshot into a node store, returning the number of nodes loaded.
+
+		:param store: The node store to load into
+		'''
+
+		with self.lock:
+			rows = self.database.execute(f'SELECT num, {", ".join(self.fields)} FROM nodes').fetchall()
+
+		with store.lock:
+			for num, *values in rows:
+				node   = store.nodes.get(num) or store.nodes.setdefault(num, Node(num))
+				values = dict(zip(self.fields, values))
+
+				# Fields the store already has (from a radio that answered first) are newer than the snapshot
+				for field in self.fields:
+					if field not in ('latitude_i', 'longitude_i', 'altitude', 'last_heard') and getattr(node, field) is None:
+						setattr(node, field, values[field])
+
+				if values['last_heard'] is not None:
+					store.move(node, values['last_heard'])
+
+				if values['latitude_i'] is not None and node.latitude_i is None:
+					store.locate(node, values['latitude_i'], values['longitude_i'], values['altitude'])
+
+		return len(rows)
+
+
+	def flush(self, store: NodeStore) -> int:
+		'''
+		Write the nodes changed since the last flush, returning the number written.
+
+		:param store: The node store to snapshot
+		'''
+
+		with store.lock:
+			changed, store.changed = store.changed, set()
+			rows = [(num, *(getattr(node, field) for field in self.fields)) for num in changed if (node := store.nodes.get(num))]
+
+		if rows:
+			with self.lock:
+				with self.database:
+					self.database.executemany(self.upsert, rows)
+
+		return len(rows)
+
+
+	def run(self, store: NodeStore):
+		'''
+		Flushing thread that writes the changed nodes every flush interval
+
+		:param store: The node store to snapshot
+		'''
+
+		while not self.stopping.wait(self.flush_interval):
+			try:
+				self.flush(store)
+			except sqlite3.Error as e:
+				logging.error(f'Failed to write the node snapshot: {e}')
+
+
+	def start(self, store: NodeStore):
+		'''
+		Start writing the changed nodes in a background thread
+
+		:param store: The node store to snapshot
+		'''
+
+		self.thread = threading.Thread(target=self.run, args=(store,), name='meshdb-snapshot', daemon=True)
+		self.thread.start()
+
+
+	def close(self, store: NodeStore = None):
+		'''
+		Stop the flushing thread, write the last changes and close the database
+
+		:param store: The node store to write the last changes of
+		'''
+
+		self.stopping.set()
+
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+		if store:
+			self.flush(store)
+
+		with self.lock:
+			self.database.close()
+
+
+class Series(object):
+	def __init__(self, variant: str, fields: tuple, window: int = WINDOW, capacity: int = 64):
+		'''
+		Initialize fixed-size ring buffers of one telemetry variant for every node
+
+		:param variant:  The telemetry variant (device_metrics, environment_metrics, ...)
+		:param fields:   The metric field names in the variant
+		:param window:   The number of samples kept per node
+		:param capacity: The number of nodes to allocate rows for up front (doubled as needed)
+		'''
+
+		self.variant = variant
+		self.fields  = {field: index for index, field in enumerate(fields)}
+		self.window  = window
+		self.rows    = {} # Node number -> row
+		self.nums    = numpy.zeros(capacity, dtype=numpy.uint32)                              # Row -> node number
+		self.heads   = numpy.zeros(capacity, dtype=numpy.int64)                               # Row -> next slot to write
+		self.times   = numpy.full((capacity, window), numpy.nan)                              # Row, slot -> unix time
+		self.values  = numpy.full((len(fields), capacity, window), numpy.nan, numpy.float32) # Field, row, slot -> value
+
+
+	def __len__(self):
+		return len(self.rows)
+
+
+	def row(self, num: int) -> int:
+		'''
+		Return the row of a node, allocating one (and growing the buffers) if needed.
+
+		:param num: The node number
+		'''
+
+		if (row := self.rows.get(num)) is not None:
+			return row
+
+		row = len(self.rows)
+
+		if row == len(self.nums):
+			grow        = len(self.nums)
+			self.nums   = numpy.concatenate((self.nums,   numpy.zeros(grow, dtype=numpy.uint32)))
+			self.heads  = numpy.concatenate((self.heads,  numpy.zeros(grow, dtype=numpy.int64)))
+			self.times  = numpy.concatenate((self.times,  numpy.full((grow, self.window), numpy.nan)))
+			self.values = numpy.concatenate((self.values, numpy.full((len(self.fields), grow, self.window), numpy.nan, numpy.float32)), axis=1)
+
+		self.rows[num] = row
+		self.nums[row] = num
+
+		return row
+
+
+	def append(self, num: int, timestamp: float, values: dict):
+		'''
+		Write a sample over the oldest slot of a node's ring buffer.
+
+		:param num:       The node number
+		:param timestamp: The unix time of the sample
+		:param values:    Metric field name -> value (missing fields are stored as NaN)
+		'''
+
+		row  = self.row(num)
+		slot = self.heads[row]
+
+		self.times[row, slot]     = timestamp
+		self.values[:, row, slot] = numpy.nan
+		self.heads[row]           = (slot + 1) % self.window
+
+		for field, value in values.items():
+			if (index := self.fields.get(field)) is not None:
+				self.values[index, row, slot] = value
+
+
+	def select(self, field: str, seconds: float = None, now: float = None):
+		'''
+		Return the node numbers and a (nodes, window) array of a metric, with samples outside the time window as NaN.
+
+		:param field:   The metric field name
+		:param seconds: How far back to look (None for every sample kept)
+		:param now:     The current unix time (defaults to now)
+		'''
+
+		count  = len(self.rows)
+		values = self.values[self.fields[field], :count]
+
+		if seconds is not None:
+			with numpy.errstate(invalid='ignore'):
+				values = numpy.where(self.times[:count] >= (now or time.time()) - seconds, values, numpy.nan)
+
+		return self.nums[:count], values
+
+
+class TelemetryStore(object):
+	def __init__(self, window: int = WINDOW, variants: tuple = TELEMETRY):
+		'''
+		Initialize per node, per metric telemetry ring buffers
+
+		:param window:   The number of samples kept per node and variant
+		:param variants: The telemetry variants to keep
+		'''
+
+		if not numpy:
+			raise SystemExit('missing the numpy module (pip install numpy)')
+
+		self.lock    = threading.Lock()
+		self.series  = {} # Variant -> Series
+		self.metrics = {} # Metric name -> (Series, field name)
+
+		for variant in variants:
+			fields = tuple(field.name for field in telemetry_pb2.Telemetry.DESCRIPTOR.fields_by_name[variant].message_type.fields)
+			series = self.series[variant] = Series(variant, fields, window)
+
+			# Metrics are named after their field, prefixed by the variant when an earlier variant has the same field
+			for field in fields:
+				name = field if field not in self.metrics else f'{variant.removesuffix("_metrics")}_{field}'
+				self.metrics[name] = (series, field)
+
+
+	def update_packet(self, message_packet, data=None):
+		'''
+		Append the metrics of a decoded telemetry packet.
+
+		:param message_packet: The decoded mesh packet
+		:param data:           The parsed telemetry_pb2.Telemetry payload
+		'''
+
+		if message_packet.decoded.portnum != portnums_pb2.TELEMETRY_APP or not isinstance(data, telemetry_pb2.Telemetry):
+			return
+
+		if (series := self.series.get(data.WhichOneof('variant'))) is None:
+			return
+
+		values = {field.name: value for field, value in getattr(data, series.variant).ListFields()}
+
+		with self.lock:
+			series.append(getattr(message_packet, 'from'), message_packet.rx_time or time.time(), values)
+
+
+	def history(self, num: int, metric: str) -> tuple:
+		'''
+		Return the (times, values) arrays of a metric for a node, oldest first.
+
+		:param num:    The node number
+		:param metric: The metric name
+		'''
+
+		series, field = self.metrics[metric]
+
+		with self.lock:
+			if (row := series.rows.get(num)) is None:
+				return numpy.empty(0), numpy.empty(0, numpy.float32)
+
+			order  = numpy.roll(numpy.arange(series.window), -series.heads[row])
+			times  = series.times[row, order]
+			values = series.values[series.fields[field], row, order]
+
+		keep = ~numpy.isnan(times) & ~numpy.isnan(values)
+
+		return times[keep], values[keep]
+
+
+	def summary(self, metric: str, seconds: float = None, now: float = None) -> dict:
+		'''
+		Return the count, mean, minimum, maximum and latest value of a metric for every node at once.
+
+		:param metric:  The metric name
+		:param seconds: How far back to look (None for every sample kept)
+		:param now:     The current unix time (defaults to now)
+		'''
+
+		series, field = self.metrics[metric]
+
+		with self.lock:
+			nums, values = series.select(field, seconds, now)
+			nums, values = nums.copy(), values.copy()
+			latest       = (series.heads[:len(nums)] - 1) % series.window
+			times        = series.times[:len(nums)].copy()
+
+		valid = ~numpy.isnan(values)
+		count = valid.sum(axis=1)
+
+		# Only the latest sample of each node that falls in the window counts as its latest value
+		last = values[numpy.arange(len(nums)), latest]
+
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			return {
+				'num'    : nums,
+				'count'  : count,
+				'mean'   : numpy.where(count > 0, numpy.where(valid, values, 0).sum(axis=1) / count, numpy.nan),
+				'min'    : numpy.fmin.reduce(values, axis=1),
+				'max'    : numpy.fmax.reduce(values, axis=1),
+				'latest' : last,
+				'time'   : times[numpy.arange(len(nums)), latest]
+			}
+
+
+	def downsample(self, metric: str, interval: float, seconds: float, now: float = None) -> tuple:
+		'''
+		Average a metric into fixed time buckets for every node at once.
+
+		:param metric:   The metric name
+		:param interval: The width of a bucket in seconds
+		:param seconds:  How far back to look
+		:param now:      The current unix time (defaults to now)
+		'''
+
+		series, field = self.metrics[metric]
+		now           = now or time.time()
+		start         = now - seconds
+		buckets       = max(1, int(numpy.ceil(seconds / interval)))
+
+		with self.lock:
+			nums, values = series.select(field, seconds, now)
+			nums, values = nums.copy(), values.copy()
+			times        = series.times[:len(nums)].copy()
+
+		valid   = ~numpy.isnan(values) & (times <= now)
+		rows    = numpy.broadcast_to(numpy.arange(len(nums))[:, None], values.shape)[valid]
+		bucket  = numpy.minimum(((times[valid] - start) // interval).astype(numpy.int64), buckets - 1)
+		index   = rows * buckets + bucket
+		sums    = numpy.bincount(index, weights=values[valid], minlength=len(nums) * buckets)
+		counts  = numpy.bincount(index, minlength=len(nums) * buckets)
+
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			means = (sums / counts).reshape(len(nums), buckets)
+
+		return nums, start + numpy.arange(buckets) * interval, means
+
+
+class Topology(object):
+	def __init__(self, ttl: int = LINK_TTL):
+		'''
+		Initialize a weighted graph of the links between nodes
+
+		:param ttl: The number of seconds after which a link that has not been reported again is dropped
+		'''
+
+		self.lock         = threading.RLock()
+		self.ttl          = ttl
+		self.links        = {}    # Node number -> {neighbor node number: [SNR, last seen]} (both directions share the list)
+		self.expiry       = []    # Heap of (last seen, node number, neighbor node number), one entry per link
+		self.parent       = {}    # Union-find forest of the connected components
+		self.dirty        = False # The union-find forest needs rebuilding after links were dropped
+		self.articulation = None  # Cached articulation points (None until the next query after a change)
+		self.version      = 0     # Bumped on every change to the shape of the graph
+
+
+	def __len__(self):
+		return len(self.links)
+
+
+	def weight(self, snr: float) -> float:
+		'''
+		Return the cost of a hop, one per hop plus a penalty for links below 0 dB SNR.
+
+		:param snr: The SNR of the link
+		'''
+
+		return 1 + max(0.0, -snr) / 10 if snr is not None else 1.5
+
+
+	def link(self, node: int, neighbor: int, snr: float = None, timestamp: float = None):
+		'''
+		Add or refresh a link between two nodes.
+
+		:param node:      The node number
+		:param neighbor:  The neighbor node number
+		:param snr:       The SNR of the link in dB
+		:param timestamp: The unix time the link was reported (defaults to now)
+		'''
+
+		if node == neighbor or BROADCAST in (node, neighbor) or not node or not neighbor:
+			return
+
+		timestamp = timestamp or time.time()
+
+		with self.lock:
+			if (edge := self.links.get(node, {}).get(neighbor)):
+				# Refreshing a link does not change the shape of the graph, the expiry entry is moved forward lazily
+				if timestamp >= edge[1]:
+					edge[1] = timestamp
+					if snr is not None:
+						edge[0] = snr
+				return
+
+			edge = [snr, timestamp]
+
+			self.links.setdefault(node, {})[neighbor] = edge
+			self.links.setdefault(neighbor, {})[node] = edge
+
+			heapq.heappush(self.expiry, (timestamp, node, neighbor))
+
+			if not self.dirty:
+				self.union(node, neighbor)
+
+			self.articulation  = None
+			self.version      += 1
+
+
+	def expire(self, now: float = None):
+		'''
+		Drop the links that have not been reported within the ttl.
+
+		:param now: The current unix time (defaults to now)
+		'''
+
+		cutoff = (now or time.time()) - self.ttl
+
+		with self.lock:
+			while self.expiry and self.expiry[0][0] < cutoff:
+				seen, node, neighbor = heapq.heappop(self.expiry)
+
+				if not (edge := self.links.get(node, {}).get(neighbor)):
+					continue
+
+				if edge[1] > seen:
+					heapq.heappush(self.expiry, (edge[1], node, neighbor))
+					continue
+
+				for a, b in ((node, neighbor), (neighbor, node)):
+					del self.links[a][b]
+					if not self.links[a]:
+						del self.links[a]
+
+				self.dirty         = True
+				self.articulation  = None
+				self.version      += 1
+
+
+	def update_packet(self, message_packet, data=None):
+		'''
+		Add the links reported by a decoded NEIGHBORINFO or TRACEROUTE packet.
+
+		:param message_packet: The decoded mesh packet
+		:param data:           The parsed payload for the packet's port number
+		'''
+
+		portnum   = message_packet.decoded.portnum
+		timestamp = message_packet.rx_time or time.time()
+
+		if portnum == portnums_pb2.NEIGHBORINFO_APP and isinstance(data, mesh_pb2.NeighborInfo):
+			node = data.node_id or getattr(message_packet, 'from')
+			with self.lock:
+				self.expire(timestamp)
+				for neighbor in data.neighbors:
+					self.link(node, neighbor.node_id, neighbor.snr, timestamp)
+
+		elif portnum == portnums_pb2.TRACEROUTE_APP and isinstance(data, mesh_pb2.RouteDiscovery):
+			source, destination = message_packet.to, getattr(message_packet, 'from')
+
+			# Replies carry the full route towards the destination, requests only the hops it took so far
+			if message_packet.decoded.request_id:
+				paths = (([source, *data.route, destination], data.snr_towards), ([destination, *data.route_back, source], data.snr_back))
+			else:
+				paths = (([destination, *data.route], data.snr_towards),)
+
+			with self.lock:
+				self.expire(timestamp)
+				for hops, snrs in paths:
+					for index in range(len(hops) - 1):
+						# SNR is reported in quarter dB, -128 when unknown
+						snr = snrs[index] / 4 if index < len(snrs) and snrs[index] != -128 else None
+						self.link(hops[index], hops[index + 1], snr, timestamp)
+
+
+	def find(self, node: int) -> int:
+		'''
+		Return the root of a node in the union-find forest.
+
+		:param node: The node number
+		'''
+
+		parent = self.parent
+
+		while (up := parent.setdefault(node, node)) != node:
+			parent[node] = parent.setdefault(up, up)
+			node         = parent[node]
+
+		return node
+
+
+	def union(self, a: int, b: int):
+		'''
+		Merge the components of two nodes.
+
+		:param a: The first node number
+		:param b: The second node number
+		'''
+
+		if (root_a := self.find(a)) != (root_b := self.find(b)):
+			self.parent[root_a] = root_b
+
+
+	def rebuild(self):
+		'''Rebuild the union-find forest after links were dropped (the lock must be held)'''
+
+		if not self.dirty:
+			return
+
+		self.parent = {}
+
+		for node, neighbors in self.links.items():
+			for neighbor in neighbors:
+				if node < neighbor:
+					self.union(node, neighbor)
+
+		self.dirty = False
+
+
+	def connected(self, a: int, b: int, now: float = None) -> bool:
+		'''
+		Return whether there is any path between two nodes.
+
+		:param a:   The first node number
+		:param b:   The second node number
+		:param now: The current unix time (defaults to now)
+		'''
+
+		with self.lock:
+			self.expire(now)
+			self.rebuild()
+
+			if a not in self.links or b not in self.links:
+				return a == b
+
+			return self.find(a) == self.find(b)
+
+
+	def components(self, now: float = None) -> list:
+		'''
+		Return the connected components as sets of node numbers, largest first.
+
+		:param now: The current unix time (defaults to now)
+		'''
+
+		with self.lock:
+			self.expire(now)
+			self.rebuild()
+
+			groups = {}
+			for node in self.links:
+				groups.setdefault(self.find(node), set()).add(node)
+
+		return sorted(groups.values(), key=len, reverse=True)
+
+
+	def shortest_path(self, source: int, target: int, now: float = None) -> tuple:
+		'''
+		Return the (cost, node numbers) of the cheapest path between two nodes, or None if they are not connected.
+
+		:param source: The source node number
+		:param target: The target node number
+		:param now:    The current unix time (defaults to now)
+		'''
+
+		with self.lock:
+			if not self.connected(source, target, now):
+				return None
+
+			costs    = {source: 0.0}
+			previous = {source: None}
+			heap     = [(0.0, source)]
+
+			while heap:
+				cost, node = heapq.heappop(heap)
+
+				if node == target:
+					break
+
+				if cost > costs[node]:
+					continue
+
+				for neighbor, (snr, _) in self.links[node].items():
+					if (total := cost + self.weight(snr)) < costs.get(neighbor, math.inf):
+						costs[neighbor]    = total
+						previous[neighbor] = node
+						heapq.heappush(heap, (total, neighbor))
+
+		path = [target]
+
+		while (node := previous[path[-1]]) is not None:
+			path.append(node)
+
+		return costs[target], path[::-1]
+
+
+	def articulation_points(self, now: float = None) -> set:
+		'''
+		Return the nodes whose loss would split their component, cached until the shape of the graph changes.
+
+		:param now: The current unix time (defaults to now)
+		'''
+
+		with self.lock:
+			self.expire(now)
+
+			if self.articulation is not None:
+				return self.articulation
+
+			depth  = {}
+			low    = {}
+			points = set()
+
+			# Iterative Tarjan, the public mesh is far too deep for recursion
+			for root in self.links:
+				if root in depth:
+					continue
+
+				depth[root] = low[root] = 0
+				children    = 0
+				stack       = [(root, None, iter(self.links[root]))]
+
+				while stack:
+					node, parent, neighbors = stack[-1]
+
+					for neighbor in neighbors:
+						if neighbor == parent:
+							continue
+						if neighbor in depth:
+							low[node] = min(low[node], depth[neighbor])
+						else:
+							depth[neighbor] = low[neighbor] = depth[node] + 1
+							stack.append((neighbor, node, iter(self.links[neighbor])))
+							break
+					else:
+						stack.pop()
+						if parent is not None:
+							low[parent] = min(low[parent], low[node])
+							if parent == root:
+								children += 1
+							elif low[node] >= depth[parent]:
+								points.add(parent)
+
+				if children > 1:
+					points.add(root)
+
+			self.articulation = points
+
+		return points
@@ -33,6 +33,26 @@ grey        = '14'
 light_grey  = '15'
 
 
+# Outbound Lanes (lower lanes are always sent first)
+LANE_CONTROL = 0 # Registration, PONG, JOIN & MODE, never stuck behind anything else
+LANE_CHAT    = 1 # Replies to users on IRC
+LANE_RELAY   = 2 # Mesh events relayed into IRC, coalesced per target
+
+# Flood Control (RFC 1459 style, a burst of lines then one line every 2 seconds)
+FLOOD_BURST = 5
+FLOOD_RATE  = 0.5 # Lines per second once the burst is spent
+
+MAX_LINE    = 510   # Longest line the server accepts, excluding the crlf
+MAX_INPUT   = 8704  # Longest line we accept from the server (8191 bytes of IRCv3 tags and a 512 byte message)
+READ_SIZE   = 65536 # Bytes read from the server at a time, the event loop gets a turn between reads
+HOSTMASK    = 64    # Room left for the :nick!user@host prefix the server adds when relaying our lines to others
+RELAY_LIMIT = 1000  # Most relayed messages waiting before relay() waits for room
+SEPARATOR   = ' | '
+
+# IRCv3 tag value escapes
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
 # Logging Configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(funcName)s - %(message)s')
 
@@ -49,12 +69,338 @@ def color(msg: str, foreground: str, background: str = None) -> str:
 	return f'\x03{foreground},{background}{msg}{reset}' if background else f'\x03{foreground}{msg}{reset}'
 
 
+def decode(data: bytes) -> str:
+	'''
+	Decode bytes from the IRC server, falling back to latin-1 for clients that do not send UTF-8.
+
+	:param data: The bytes to decode.
+	'''
+
+	try:
+		return data.decode('utf-8')
+	except UnicodeDecodeError:
+		return data.decode('latin-1')
+
+
+def unescape(value: str) -> str:
+	'''
+	Unescape an IRCv3 tag value, left to right so an escaped backslash is not read as the start of another escape.
+
+	:param value: The escaped tag value.
+	'''
+
+	if '\\' not in value:
+		return value
+
+	result   = []
+	position = 0
+
+	while (found := value.find('\\', position)) >= 0:
+		result.append(value[position:found])
+
+		# An unknown escape is the character itself, a lone backslash at the end is dropped
+		if found + 1 < len(value):
+			character = value[found + 1]
+			result.append(TAG_ESCAPES.get(character, character))
+
+		position = found + 2
+
+	result.append(value[position:])
+
+	return ''.join(result)
+
+
+def encode(line: str) -> bytes:
+	'''
+	Encode a line for the IRC server, truncated to MAX_LINE bytes without splitting a character.
+
+	:param line: The line to encode.
+	'''
+
+	return line.encode('utf-8')[:MAX_LINE].decode('utf-8', 'ignore').encode('utf-8') + b'\r\n'
+
+
+class Message():
+	__slots__ = ('tags_raw', 'source_raw', 'command', 'rest', 'params')
+
+	def __init__(self, line: bytes):
+		'''
+		Parse the tags, source and command of a raw IRC line, the parameters are only split when used.
+
+		:param line: The raw line without the line ending.
+		'''
+
+		self.tags_raw   = b''
+		self.source_raw = b''
+		self.params     = None # Split on first use
+
+		if line[:1] == b'@':
+			self.tags_raw, _, line = line[1:].partition(b' ')
+			line = line.lstrip(b' ')
+
+		if line[:1] == b':':
+			self.source_raw, _, line = line[1:].partition(b' ')
+			line = line.lstrip(b' ')
+
+		self.command, _, self.rest = line.partition(b' ')
+
+
+	@property
+	def source(self) -> str:
+		'''The nick!user@host or server the message is from.'''
+
+		return decode(self.source_raw) if self.source_raw else None
+
+
+	@property
+	def nick(self) -> str:
+		'''The nickname the message is from.'''
+
+		return decode(self.source_raw.partition(b'!')[0]) if self.source_raw else None
+
+
+	@property
+	def tags(self) -> dict:
+		'''The IRCv3 message tags.'''
+
+		tags = {}
+
+		if not self.tags_raw:
+			return tags
+
+		for tag in decode(self.tags_raw).split(';'):
+			key, _, value = tag.partition('=')
+			tags[key]     = unescape(value)
+
+		return tags
+
+
+	def split(self) -> list:
+		'''Split the parameters, the trailing parameter (after " :") is kept whole.'''
+
+		rest = self.rest.lstrip(b' ')
+
+		if rest[:1] == b':':
+			self.params = [rest[1:]]
+		else:
+			middle, separator, trailing = rest.partition(b' :')
+			self.params = middle.split(b' ')
+			self.params = [param for param in self.params if param] + ([trailing] if separator else [])
+
+		return self.params
+
+
+	def __len__(self) -> int:
+		return len(self.params if self.params is not None else self.split())
+
+
+	def param(self, index: int) -> bytes:
+		'''
+		Return a parameter as bytes.
+
+		:param index: The parameter index.
+		'''
+
+		return (self.params if self.params is not None else self.split())[index]
+
+
+	def text(self, index: int) -> str:
+		'''
+		Return a parameter decoded.
+
+		:param index: The parameter index.
+		'''
+
+		return decode(self.param(index))
+
+
+class Outbound():
+	def __init__(self, burst: int = FLOOD_BURST, rate: float = FLOOD_RATE):
+		'''
+		Initialize the outbound queue with a token bucket flood controller.
+
+		:param burst: The number of lines that can be sent back to back.
+		:param rate: The number of lines per second once the burst is spent.
+		'''
+
+		self.burst   = burst
+		self.rate    = rate
+		self.tokens  = burst
+		self.updated = time.monotonic()
+		self.lanes   = ([], []) # Pending lines of the control and chat lanes
+		self.relay   = {}       # Target -> pending messages, targets are served round robin
+		self.pending = 0        # Number of pending relay messages
+		self.writer  = None
+		self.task    = None
+		self.ready   = asyncio.Event() # Set while anything is pending
+		self.room    = asyncio.Event() # Set while the relay lane has room
+
+
+	def attach(self, writer: asyncio.StreamWriter):
+		'''
+		Start sending to a new connection, dropping control and chat lines meant for the previous one.
+
+		:param writer: The stream writer of the connection.
+		'''
+
+		self.detach()
+
+		for lane in self.lanes:
+			lane.clear()
+
+		self.writer  = writer
+		self.tokens  = self.burst
+		self.updated = time.monotonic()
+		self.task    = asyncio.create_task(self.run())
+
+		self.task.add_done_callback(self.finished)
+
+		if self.pending:
+			self.ready.set()
+
+
+	def detach(self):
+		'''Stop sending, relayed messages stay queued for the next connection.'''
+
+		if self.task:
+			self.task.cancel()
+			self.task = None
+
+		self.writer = None
+
+
+	def finished(self, task: asyncio.Task):
+		'''
+		Log an error that ended the send task and close its connection so the connection loop reconnects.
+
+		:param task: The finished send task.
+		'''
+
+		if task.cancelled() or not (error := task.exception()):
+			return
+
+		logging.error(f'outbound task failed ({error})')
+
+		# A task from a connection that was already replaced leaves the new one alone
+		if task is self.task:
+			self.writer.close()
+
+
+	def put(self, line: str, lane: int = LANE_CONTROL):
+		'''
+		Queue a raw line.
+
+		:param line: The raw line to send.
+		:param lane: The lane to send the line in. (LANE_CONTROL or LANE_CHAT)
+		'''
+
+		self.lanes[lane].append(line)
+		self.ready.set()
+
+
+	async def put_relay(self, target: str, msg: str):
+		'''
+		Queue a message to be relayed to a target, waiting while the relay lane is full.
+
+		:param target: The target to send the message to. (channel or user)
+		:param msg: The message to send to the target.
+		'''
+
+		while self.pending >= RELAY_LIMIT:
+			self.room.clear()
+			await self.room.wait()
+
+		self.relay.setdefault(target, []).append(msg)
+		self.pending += 1
+		self.ready.set()
+
+
+	def next(self) -> str:
+		'''Return the next line to send, coalescing the pending relay messages of a target into one PRIVMSG.'''
+
+		for lane in self.lanes:
+			if lane:
+				return lane.pop(0)
+
+		if not self.relay:
+			return None
+
+		target   = next(iter(self.relay))
+		messages = self.relay.pop(target)
+		header   = f'PRIVMSG {target} :'
+		budget   = MAX_LINE - HOSTMASK - len(header.encode('utf-8'))
+		size     = len(messages[0].encode('utf-8'))
+		count    = 1
+
+		# Take as many messages as fit (an oversized first message is sent alone and truncated)
+		while count < len(messages) and size + len(SEPARATOR) + len(messages[count].encode('utf-8')) <= budget:
+			size  += len(SEPARATOR) + len(messages[count].encode('utf-8'))
+			count += 1
+
+		# The rest go back at the end so other targets get their turn
+		if count < len(messages):
+			self.relay[target] = messages[count:]
+
+		self.pending -= count
+		self.room.set()
+
+		return header + SEPARATOR.join(messages[:count])
+
+
+	async def take(self):
+		'''Wait for a token from the bucket.'''
+
+		while True:
+			now          = time.monotonic()
+			self.tokens  = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+
+			if self.tokens >= 1:
+				self.tokens -= 1
+				return
+
+			await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+	async def run(self):
+		'''Send the queued lines as fast as the flood controller and the socket allow.'''
+
+		while True:
+			await self.ready.wait()
+			await self.take()
+
+			# The line is picked after waiting for the token so a PONG queued in the meantime goes first
+			if (line := self.next()) is None:
+				self.ready.clear()
+				self.tokens += 1 # Nothing was sent, give the token back
+				continue
+
+			try:
+				self.writer.write(encode(line))
+				await self.writer.drain() # Backpressure when the socket buffer is full
+			except (ConnectionError, OSError) as ex:
+				logging.error(f'failed to send to the server ({ex})')
+				self.writer.close() # The reader sees the end of the connection and the connection loop reconnects
+				return
+
+
 class Bot():
 	def __init__(self):
 		self.nickname = 'MESHTASTIC'
 		self.reader   = None
 		self.writer   = None
 		self.last     = time.time()
+		self.outbound = Outbound()
+		self.slow     = False
+		self.tasks    = set() # Background tasks started by handlers, referenced here so they are not garbage collected
+		self.handlers = {
+			b'PING'    : self.eventPING,
+			b'001'     : self.event001, # RPL_WELCOME
+			b'433'     : self.event433, # ERR_NICKNAMEINUSE
+			b'INVITE'  : self.eventINVITE,
+			b'KICK'    : self.eventKICK,
+			b'PRIVMSG' : self.eventPRIVMSG
+		}
 
 
 	async def action(self, chan: str, msg: str):
@@ -68,14 +414,15 @@ class Bot():
 		await self.sendmsg(chan, f'\x01ACTION {msg}\x01')
 
 
-	async def raw(self, data: str):
+	async def raw(self, data: str, lane: int = LANE_CONTROL):
 		'''
-		Send raw data to the IRC server.
+		Queue raw data for the IRC server.
 
 		:param data: The raw data to send to the IRC server. (512 bytes max including crlf)
+		:param lane: The outbound lane to send the data in.
 		'''
 
-		await self.writer.write(data[:510].encode('utf-8') + b'\r\n')
+		self.outbound.put(data, lane)
 
 
 	async def sendmsg(self, target: str, msg: str):
@@ -86,7 +433,18 @@ class Bot():
 		:param msg: The message to send to the target.
 		'''
 
-		await self.raw(f'PRIVMSG {target} :{msg}')
+		await self.raw(f'PRIVMSG {target} :{msg}', LANE_CHAT)
+
+
+	async def relay(self, target: str, msg: str):
+		'''
+		Relay a mesh event to the IRC server, coalesced with other pending events for the same target.
+
+		:param target: The target to send the event to. (channel or user)
+		:param msg: The event to send to the target.
+		'''
+
+		await self.outbound.put_relay(target, msg)
 
 
 	async def connect(self):
@@ -97,7 +455,7 @@ class Bot():
 				options = {
 					'host'       : args.server,
 					'port'       : args.port,
-					'limit'      : 1024,
+					'limit'      : MAX_INPUT,
 					'ssl'        : ssl._create_unverified_context() if args.ssl else None, # TODO: Do not use the args variable here
 					'family'     : 2, # AF_INET = 2, AF_INET6 = 10
 					'local_addr' : None
@@ -105,95 +463,193 @@ class Bot():
 
 				self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(**options), 15)
 
+				self.outbound.attach(self.writer)
+
 				await self.raw(f'USER MESHT 0 * :git.acid.vegas/meshtastic') # Static for now
 				await self.raw('NICK ' + self.nickname)
 
-				while not self.reader.at_eof():
-					data = await asyncio.wait_for(self.reader.readuntil(b'\r\n'), 300)
-					await self.handle(data.decode('utf-8').strip())
+				buffer = b''
+
+				while True:
+					async with asyncio.timeout(300):
+						if not (data := await self.reader.read(READ_SIZE)):
+							break
+
+					lines  = (buffer + data).split(b'\n')
+					buffer = lines.pop()
+
+					if len(buffer) > MAX_INPUT:
+						logging.warning(f'dropping a {len(buffer)} byte line without a line ending')
+						buffer = b''
+
+					for line in lines:
+						await self.handle(line.rstrip(b'\r'))
+
+					# A burst (NAMES, WHO or a busy channel) arrives faster than one read, let the mesh side run between reads
+					await asyncio.sleep(0)
 
 			except Exception as ex:
 				logging.error(f'failed to connect to {args.server} ({str(ex)})')
 
 			finally:
+				self.outbound.detach()
+
+				# Delayed joins belong to the lost connection
+				for task in list(self.tasks):
+					task.cancel()
 				await asyncio.sleep(15)
 
 
-	async def eventPRIVMSG(self, data: str):
+	async def eventPRIVMSG(self, message: Message):
 		'''
 		Handle the PRIVMSG event.
 
-		:param data: The data received from the IRC server.
+		:param message: The message received from the IRC server.
 		'''
 
-		parts  = data.split()
+		if len(message) < 2:
+			return
+
+		# Only commands in our channel are decoded
+		if message.param(1)[:1] != b'!' or (target := message.text(0)) != args.channel: # TODO: Don't use the args variable here
+			return
 
-		ident  = parts[0][1:]
-		nick   = parts[0].split('!')[0][1:]
-		target = parts[2]
-		msg	   = ' '.join(parts[3:])[1:]
+		msg = message.text(1)
 
-		if target == args.channel: # TODO: Don't use the args variable here
-			if msg.startswith('!'):
-				if time.time() - self.last < 3:
-					if not self.slow:
-						self.slow = True
-						await self.sendmsg(target, color('Slow down nerd!', red))
-				else:
-					self.slow = False
-					parts = msg.split()
-					if parts[0] == '!meshage' and len(parts) > 1:
-						message = ' '.join(parts[1:])
-						if len(message) > 255:
-							await self.sendmsg(target, color('Message exceeds 255 bytes nerd!', red))
-						# TODO: Send a meshtastic message (We have to ensure our outbounds from IRC don't loop back into IRC)
+		if time.time() - self.last < 3:
+			if not self.slow:
+				self.slow = True
+				await self.sendmsg(target, color('Slow down nerd!', red))
+		else:
+			self.slow = False
+			parts = msg.split()
+			if parts[0] == '!meshage' and len(parts) > 1:
+				text = ' '.join(parts[1:])
+				if len(text) > 255:
+					await self.sendmsg(target, color('Message exceeds 255 bytes nerd!', red))
+				# TODO: Send a meshtastic message (We have to ensure our outbounds from IRC don't loop back into IRC)
 
-					self.last = time.time() # Update the last command time if it starts with ! character to prevent command flooding
+			self.last = time.time() # Update the last command time if it starts with ! character to prevent command flooding
 
 
-	async def handle(self, data: str):
+	async def eventPING(self, message: Message):
 		'''
-		Handle the data received from the IRC server.
+		Handle the PING event.
 
-		:param data: The data received from the IRC server.
+		:param message: The message received from the IRC server.
 		'''
 
-		logging.info(data)
+		await self.raw('PONG :' + message.text(0))
 
-		try:
-			parts = data.split()
 
-			if parts[0] == 'PING':
-				await self.raw('PONG ' + parts[1])
+	async def event001(self, message: Message):
+		'''
+		Handle the RPL_WELCOME event.
+
+		:param message: The message received from the IRC server.
+		'''
 
-			elif parts[1] == '001': # RPL_WELCOME
-				await self.raw(f'MODE {self.nickname} +B')
-				await self.sendmsg('NickServ', f'IDENTIFY {self.nickname} simps0nsfan420')
-				await asyncio.sleep(10) # Wait for NickServ to identify or any channel join delays
-				await self.raw(f'JOIN {args.channel} {args.key if args.key else ""}')
+		await self.raw(f'MODE {self.nickname} +B')
+		await self.sendmsg('NickServ', f'IDENTIFY {self.nickname} simps0nsfan420')
 
-			elif parts[1] == '433': # ERR_NICKNAMEINUSE
-				self.nickname += '_' # revamp this to be more unique
-				await self.raw('NICK ' + self.nickname)
+		# Wait for NickServ to identify or any channel join delays without holding up the reader
+		self.background(self.join(10))
 
-			elif parts[1] == 'INVITE':
-				target = parts[2]
-				chan   = parts[3][1:]
-				if target == self.nickname and chan == args.channel:
-					await self.raw(f'JOIN {chan}')
 
-			elif parts[1] == 'KICK':
-				chan   = parts[2]
-				kicked = parts[3]
-				if kicked == self.nickname and chan == args.channel:
-					await asyncio.sleep(3)
-					await self.raw(f'JOIN {args.channel} {args.key if args.key else ""}')
+	async def event433(self, message: Message):
+		'''
+		Handle the ERR_NICKNAMEINUSE event.
+
+		:param message: The message received from the IRC server.
+		'''
+
+		self.nickname += '_' # revamp this to be more unique
+		await self.raw('NICK ' + self.nickname)
+
+
+	async def eventINVITE(self, message: Message):
+		'''
+		Handle the INVITE event.
+
+		:param message: The message received from the IRC server.
+		'''
+
+		target = message.text(0)
+		chan   = message.text(1)
+
+		if target == self.nickname and chan == args.channel:
+			await self.raw(f'JOIN {chan}')
+
+
+	async def eventKICK(self, message: Message):
+		'''
+		Handle the KICK event.
+
+		:param message: The message received from the IRC server.
+		'''
+
+		chan   = message.text(0)
+		kicked = message.text(1)
+
+		if kicked == self.nickname and chan == args.channel:
+			self.background(self.join(3))
+
+
+	def background(self, coroutine):
+		'''
+		Run a coroutine as a task without holding up the reader.
 
-			elif parts[1] == 'PRIVMSG':
-				await self.eventPRIVMSG(data) # We put this in a separate function since it will likely be the most used/handled event
+		:param coroutine: The coroutine to run.
+		'''
+
+		task = asyncio.create_task(coroutine)
+		self.tasks.add(task)
+		task.add_done_callback(self.finished)
+
+
+	def finished(self, task: asyncio.Task):
+		'''
+		Forget a finished background task and log its error.
+
+		:param task: The finished task.
+		'''
+
+		self.tasks.discard(task)
+
+		if not task.cancelled() and (error := task.exception()):
+			logging.error(f'background task failed ({error})')
+
+
+	async def join(self, delay: int):
+		'''
+		Join the channel after a delay.
+
+		:param delay: The number of seconds to wait before joining.
+		'''
+
+		await asyncio.sleep(delay)
+		await self.raw(f'JOIN {args.channel} {args.key if args.key else ""}')
+
+
+	async def handle(self, line: bytes):
+		'''
+		Handle a line received from the IRC server.
+
+		:param line: The raw line received from the IRC server, without the line ending.
+		'''
+
+		if logging.root.isEnabledFor(logging.DEBUG):
+			logging.debug(decode(line))
+
+		if not line:
+			return
+
+		try:
+			message = Message(line)
 
-		except (UnicodeDecodeError, UnicodeEncodeError):
-			pass
+			# Everything without a handler (NAMES, WHO, MOTD, ...) is skipped before its parameters are split or decoded
+			if (handler := self.handlers.get(message.command)):
+				await handler(message)
 
 		except Exception as ex:
 			logging.exception(f'Unknown error has occured! ({ex})')
@@ -217,7 +673,7 @@ if __name__ == '__main__':
 	elif args.port < 1 or args.port > 65535:
 		raise ValueError('Port must be between 1 and 65535.')
 
-	print(f'Connecting to {args.server}:{args.port} (SSL: {args.ssl}) and joining {args.channel} (Key: {args.key or 'None'})')
+	print(f'Connecting to {args.server}:{args.port} (SSL: {args.ssl}) and joining {args.channel} (Key: {args.key or "None"})')
 
 	bot = Bot()
 
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# Meshtastic Metrics - Developed by acidvegas in Python (https://acid.vegas/meshtastic)
+
+import http.server
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Metrics(object):
+	def __init__(self):
+		'''Initialize the thread-safe counters, per-stage latency histograms and gauges'''
+
+		self.lock      = threading.Lock()
+		self.counters  = {} # Counter name -> count
+		self.labelled  = {} # (counter name, ((label, value), ...)) -> count
+		self.latencies = {} # Stage name -> [count, total seconds, max seconds, per bucket counts]
+		self.gauges    = {} # Gauge name -> function returning the current value
+
+
+	def count(self, name: str, amount: int = 1, **labels):
+		'''
+		Increment a counter.
+
+		:param name:   The counter name
+		:param amount: The amount to increment by
+		:param labels: Labels splitting the counter (portnum, gateway, channel, ...)
+		'''
+
+		with self.lock:
+			if labels:
+				key = (name, tuple(labels.items()))
+				self.labelled[key] = self.labelled.get(key, 0) + amount
+			else:
+				self.counters[name] = self.counters.get(name, 0) + amount
+
+
+	def observe(self, stage: str, seconds: float):
+		'''
+		Record the time spent in a processing stage.
+
+		:param stage:   The stage name
+		:param seconds: The time spent in the stage
+		'''
+
+		with self.lock:
+			if not (latency := self.latencies.get(stage)):
+				latency = self.latencies[stage] = [0, 0.0, 0.0, [0] * len(BUCKETS)]
+
+			latency[0] += 1
+			latency[1] += seconds
+			latency[2]  = max(latency[2], seconds)
+
+			# Only the first bucket the time fits in is counted, the cumulative counts are built when rendering
+			for index, bound in enumerate(BUCKETS):
+				if seconds <= bound:
+					latency[3][index] += 1
+					break
+
+
+	def gauge(self, name: str, function):
+		'''
+		Register a gauge that is read when the metrics are rendered.
+
+		:param name:     The gauge name
+		:param function: A function returning the current value
+		'''
+
+		self.gauges[name] = function
+
+
+	def snapshot(self) -> dict:
+		'''Return a copy of the counters and the average/max latency of each stage in milliseconds'''
+
+		with self.lock:
+			latencies = {stage: {'avg_ms': total / count * 1000, 'max_ms': peak * 1000} for stage, (count, total, peak, _) in self.latencies.items()}
+			return {**self.counters, 'latency': latencies}
+
+
+def escape(value) -> str:
+	'''
+	Escape a label value for the Prometheus text format.
+
+	:param value: The label value
+	'''
+
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(registries: list, prefix: str) -> str:
+	'''
+	Render metrics in the Prometheus text exposition format.
+
+	:param registries: The (Metrics, labels) pairs to render, the labels are added to every sample of that registry
+	:param prefix:     The prefix of every metric name (meshmqtt)
+	'''
+
+	families = {} # Metric name -> (type, sample lines)
+
+	def sample(name: str, kind: str, labels: tuple, value):
+		text = ','.join(f'{label}="{escape(item)}"' for label, item in labels)
+		families.setdefault(name, (kind, []))[1].append(f'{name}{{{text}}} {value}' if text else f'{name} {value}')
+
+	for metrics, labels in registries:
+		base = tuple(labels.items())
+
+		with metrics.lock:
+			counters  = list(metrics.counters.items())
+			labelled  = list(metrics.labelled.items())
+			latencies = [(stage, count, total, list(buckets)) for stage, (count, total, _, buckets) in metrics.latencies.items()]
+
+		for name, value in counters:
+			sample(f'{prefix}_{name}_total', 'counter', base, value)
+
+		for (name, extra), value in labelled:
+			sample(f'{prefix}_{name}_total', 'counter', base + extra, value)
+
+		for stage, count, total, buckets in latencies:
+			name       = f'{prefix}_{stage}_seconds'
+			cumulative = 0
+			for bound, amount in zip(BUCKETS, buckets):
+				cumulative += amount
+				sample(f'{name}_bucket', 'histogram', base + (('le', bound),), cumulative)
+			sample(f'{name}_bucket', 'histogram', base + (('le', '+Inf'),), count)
+			sample(f'{name}_sum',    'histogram', base, total)
+			sample(f'{name}_count',  'histogram', base, count)
+
+		for name, function in list(metrics.gauges.items()):
+			try:
+				sample(f'{prefix}_{name}', 'gauge', base, function())
+			except Exception as e:
+				logging.debug(f'Failed to read gauge {name}: {e}')
+
+	lines = []
+
+	for name, (kind, samples) in families.items():
+		# Histogram series share one TYPE line under the name without the _bucket/_sum/_count suffix
+		family = name.rsplit('_', 1)[0] if kind == 'histogram' else name
+		if kind != 'histogram' or name.endswith('_bucket'):
+			lines.append(f'# TYPE {family} {kind}')
+		lines.extend(samples)
+
+	return '\n'.join(lines) + '\n'
+
+
+class Profiler(object):
+	def __init__(self, interval: float = 0.005):
+		'''
+		Initialize a sampling profiler that can be started and stopped while running
+
+		:param interval: Seconds between stack samples
+		'''
+
+		self.interval = interval
+		self.lock     = threading.Lock()
+		self.stacks   = {}   # Collapsed stack (outermost first, ; separated) -> sample count
+		self.samples  = 0
+		self.thread   = None # The sampling thread while running
+		self.running  = threading.Event()
+
+
+	def start(self, interval: float = None):
+		'''
+		Start sampling every thread's stack (discarding any previous profile).
+
+		:param interval: Seconds between stack samples
+		'''
+
+		with self.lock:
+			if self.running.is_set():
+				return
+
+			self.interval = interval or self.interval
+			self.stacks   = {}
+			self.samples  = 0
+			self.running.set()
+			self.thread   = threading.Thread(target=self.sample, name='meshmetrics-profiler', daemon=True)
+			self.thread.start()
+
+
+	def stop(self):
+		'''Stop sampling, keeping the profile collected so far'''
+
+		self.running.clear()
+
+		if self.thread:
+			self.thread.join()
+			self.thread = None
+
+
+	def sample(self):
+		'''Sampling thread that counts the current stack of every other thread'''
+
+		me = threading.get_ident()
+
+		while self.running.is_set():
+			frames = sys._current_frames()
+
+			with self.lock:
+				for ident, frame in frames.items():
+					if ident == me:
+						continue
+
+					stack = []
+					while frame:
+						stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+						frame = frame.f_back
+
+					key              = ';'.join(reversed(stack))
+					self.stacks[key] = self.stacks.get(key, 0) + 1
+
+				self.samples += 1
+
+			time.sleep(self.interval)
+
+
+	def collapsed(self) -> str:
+		'''Return the profile as collapsed stacks (one "stack count" per line, the input of flamegraph.pl)'''
+
+		with self.lock:
+			return ''.join(f'{stack} {count}\n' for stack, count in sorted(self.stacks.items(), key=lambda item: item[1], reverse=True))
+
+
+class MetricsServer(object):
+	def __init__(self, address: str, render, profiler: Profiler = None):
+		'''
+		Initialize a local HTTP endpoint serving metrics (and the profiler)
+
+		:param address:  The host:port to listen on
+		:param render:   A function returning the metrics in the Prometheus text format
+		:param profiler: The sampling profiler to expose (None to disable)
+		'''
+
+		host, _, port = address.rpartition(':')
+
+		self.render   = render
+		self.profiler = profiler
+		self.server   = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), self.handler())
+		self.thread   = threading.Thread(target=self.server.serve_forever, name='meshmetrics-http', daemon=True)
+
+
+	def handler(self):
+		'''Build the request handler class bound to this server'''
+
+		server = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def reply(self, status: int, body: str, content_type: str = 'text/plain; charset=utf-8'):
+				data = body.encode('utf-8')
+				self.send_response(status)
+				self.send_header('Content-Type', content_type)
+				self.send_header('Content-Length', str(len(data)))
+				self.end_headers()
+				self.wfile.write(data)
+
+
+			def do_GET(self):
+				path = urllib.parse.urlsplit(self.path).path
+
+				if path == '/metrics':
+					self.reply(200, server.render(), 'text/plain; version=0.0.4; charset=utf-8')
+				elif path == '/profile' and server.profiler:
+					self.reply(200, server.profiler.collapsed())
+				else:
+					self.reply(404, 'not found\n')
+
+
+			def do_POST(self):
+				url   = urllib.parse.urlsplit(self.path)
+				query = urllib.parse.parse_qs(url.query)
+
+				if not server.profiler:
+					self.reply(404, 'not found\n')
+				elif url.path == '/profile/start':
+					server.profiler.start(float(query['interval'][0]) if 'interval' in query else None)
+					self.reply(200, f'profiling every {server.profiler.interval}s\n')
+				elif url.path == '/profile/stop':
+					server.profiler.stop()
+					self.reply(200, f'stopped after {server.profiler.samples} samples\n')
+				else:
+					self.reply(404, 'not found\n')
+
+
+			def log_message(self, format, *args):
+				logging.debug(f'{self.address_string()} {format % args}')
+
+		return Handler
+
+
+	def start(self):
+		'''Start serving in a background thread'''
+
+		self.thread.start()
+
+		logging.info(f'Serving metrics on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics')
+
+
+	def close(self):
+		'''Stop serving and stop the profiler'''
+
+		if self.profiler:
+			self.profiler.stop()
+
+		self.server.shutdown()
+		self.server.server_close()
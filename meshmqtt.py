@@ -2,8 +2,18 @@
 # Meshtastic MQTT Interface - Developed by acidvegas in Python (https://acid.vegas/meshtastic)
 
 import argparse
+import asyncio
 import base64
+import json
 import logging
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+import urllib.parse
 
 try:
 	from cryptography.hazmat.backends           import default_backend
@@ -12,398 +22,1433 @@ except ImportError:
 	raise SystemExit('missing the cryptography module (pip install cryptography)')
 
 try:
-	from meshtastic import mesh_pb2, mqtt_pb2, portnums_pb2, telemetry_pb2
+	from google.protobuf.json_format import MessageToDict
+	from google.protobuf.message     import DecodeError
+except ImportError:
+	raise SystemExit('missing the protobuf module (pip install protobuf)')
+
+try:
+	from meshtastic import admin_pb2, mesh_pb2, mqtt_pb2, paxcount_pb2, portnums_pb2, remote_hardware_pb2, storeforward_pb2, telemetry_pb2
 except ImportError:
 	raise SystemExit('missing the meshtastic module (pip install meshtastic)')
 
-try:
-	import paho.mqtt.client as mqtt
-except ImportError:
-	raise SystemExit('missing the paho-mqtt module (pip install paho-mqtt)')
+try:
+	import paho.mqtt.client as mqtt
+except ImportError:
+	raise SystemExit('missing the paho-mqtt module (pip install paho-mqtt)')
+
+try:
+	import msgpack
+except ImportError:
+	msgpack = None # Only needed for the msgpack output format
+
+from mesharchive import Archive, parse_node, read_pcap
+from meshdb      import NodeStore, TelemetryStore, Topology, numpy
+from meshmetrics import Metrics, MetricsServer, Profiler, render
+from meshtext    import Reassembler
+
+
+# Initialize the logging module
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %I:%M:%S')
+
+# AES-CTR nonce layout (64-bit packet id + 64-bit sender node number, little endian)
+NONCE = struct.Struct('<QQ')
+
+# Valid port numbers, used to reject packets decrypted with the wrong key
+PORTNUMS = frozenset(portnums_pb2.PortNum.values())
+
+# Port number -> name (TEXT_MESSAGE_APP), used as the metrics label
+PORTNUM_NAMES = {value: name for name, value in portnums_pb2.PortNum.items()}
+
+# CTR counter suffixes for the blocks of a packet, the nonce is (packet id, from) with from a 32-bit node number
+# so the last 4 bytes of the nonce are zero and the big-endian counter never carries past them
+COUNTERS = [block.to_bytes(4, 'big') for block in range(64)]
+
+# Most queued messages a worker decodes (and decrypts) together
+BATCH_SIZE = 64
+
+# Most topic levels between the root topic and the /2/e/ of a channel topic (msh/EU_868/DE/2/e/LongFast/!gateway)
+REGION_DEPTH = 4
+
+
+def clean_dict(dictionary: dict) -> dict:
+	'''
+	Remove empty fields from a dictionary.
+
+	:param dictionary: The dictionary to remove empty fields from
+	'''
+	
+	return {key: value for key, value in dictionary.items() if value}
+
+
+def decode_key(key: str) -> bytes:
+	'''
+	Decode a base64 encryption key into raw AES key bytes.
+
+	:param key: The base64 (or urlsafe base64) encryption key
+	'''
+
+	# The default key is padded to ensure it's the correct length for AES
+	if key == 'AQ==':
+		key = '1PG7OiApB1nwvP+rz05pAQ=='
+
+	# Ensure the key is formatted and padded correctly before turning it into bytes
+	padded_key = key.ljust(len(key) + ((4 - (len(key) % 4)) % 4), '=')
+	key        = padded_key.replace('-', '+').replace('_', '/')
+
+	return base64.b64decode(key.encode('ascii'))
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+	'''
+	Check if a topic matches a subscription pattern.
+
+	:param pattern: The topic pattern (with + and # wildcards)
+	:param topic:   The topic
+	'''
+
+	pattern, topic = pattern.split('/'), topic.split('/')
+
+	for position, part in enumerate(pattern):
+		if part == '#':
+			return True
+		if position >= len(topic) or part not in ('+', topic[position]):
+			return False
+
+	return len(pattern) == len(topic)
+
+
+def xor_hash(data: bytes) -> int:
+	'''
+	Compute the 8-bit XOR hash meshtastic uses to build channel hashes.
+
+	:param data: The bytes to hash
+	'''
+
+	result = 0
+	for byte in data:
+		result ^= byte
+
+	return result
+
+
+def parse_broker(url: str, port: int = 1883, root: str = '#', tls: bool = False, username: str = None, password: str = None) -> dict:
+	'''
+	Parse a broker given as a hostname or as mqtt[s]://[username:password@]host[:port][/topic[,topic]].
+
+	:param url:      The broker hostname or URL
+	:param port:     The default MQTT broker port
+	:param root:     The default root topic to subscribe to
+	:param tls:      The default TLS/SSL setting
+	:param username: The default MQTT username
+	:param password: The default MQTT password
+	'''
+
+	if '://' not in url:
+		return {'broker': url, 'port': port, 'topics': [root], 'tls': tls, 'username': username, 'password': password}
+
+	# Fragments are disabled so a # wildcard in the topic is kept
+	parts = urllib.parse.urlsplit(url, allow_fragments=False)
+	tls   = parts.scheme == 'mqtts'
+
+	return {
+		'broker'   : parts.hostname,
+		'port'     : parts.port or (8883 if tls else 1883),
+		'topics'   : parts.path[1:].split(',') if parts.path[1:] else [root],
+		'tls'      : tls,
+		'username' : urllib.parse.unquote(parts.username) if parts.username else username,
+		'password' : urllib.parse.unquote(parts.password) if parts.password else password
+	}
+
+
+class Output(object):
+	def __init__(self, stream, format: str = 'json'):
+		'''
+		Initialize a structured output sink that writes one record per packet
+
+		:param stream: The binary file-like object to write records to
+		:param format: The record format (json for newline-delimited JSON or msgpack)
+		'''
+
+		if format == 'msgpack' and not msgpack:
+			raise SystemExit('missing the msgpack module (pip install msgpack)')
+
+		self.stream = stream
+		self.format = format
+		self.lock   = threading.Lock()
+
+
+	@classmethod
+	def open(cls, format: str = 'json', path: str = None, address: str = None):
+		'''
+		Open an output sink on stdout, a file or a TCP socket
+
+		:param format:  The record format (json or msgpack)
+		:param path:    The file to append records to
+		:param address: The host:port to stream records to
+		'''
+
+		if path:
+			stream = open(path, 'ab')
+		elif address:
+			host, _, port = address.rpartition(':')
+			stream = socket.create_connection((host, int(port))).makefile('wb')
+		else:
+			stream = sys.stdout.buffer
+
+		return cls(stream, format)
+
+
+	def emit(self, record: dict):
+		'''
+		Serialize and write a record.
+
+		:param record: The record to write
+		'''
+
+		if self.format == 'msgpack':
+			data = msgpack.packb(record, use_bin_type=True)
+		else:
+			data = json.dumps(record, separators=(',', ':'), default=lambda value: base64.b64encode(value).decode('ascii')).encode('utf-8') + b'\n'
+
+		with self.lock:
+			self.stream.write(data)
+			self.stream.flush()
+
+
+	def close(self):
+		'''Close the output stream'''
+
+		if self.stream is not sys.stdout.buffer:
+			self.stream.close()
+
+
+class Keyring(object):
+	def __init__(self):
+		'''Initialize the keyring of channel encryption keys'''
+
+		self.default = None  # The default encryption key
+		self.keys    = {}    # Encryption key -> AES algorithm
+		self.hashes  = {}    # XOR hash of the key bytes -> tuple of encryption keys
+		self.named   = {}    # Channel name -> tuple of encryption keys
+		self.learned = {}    # (channel hash, node number) or (channel name, channel hash) -> encryption key that last worked
+		self.missing = set() # (channel name, channel hash) pairs that no key could decrypt
+		self.local   = threading.local() # Per thread AES-ECB encryptors (an encryptor is not thread safe)
+		self.lock    = threading.Lock()  # Serializes updates from the worker threads
+
+		# keys, hashes & named are copied on write, so candidates() can iterate them without the lock
+
+
+	def add(self, key: str, channel: str = None):
+		'''
+		Decode an encryption key once and add it to the keyring.
+
+		:param key:     The encryption key
+		:param channel: The channel name the key belongs to (None for any channel)
+		'''
+
+		key_bytes = decode_key(key)
+
+		with self.lock:
+			if key not in self.keys:
+				key_hash    = xor_hash(key_bytes)
+				self.keys   = {**self.keys, key: algorithms.AES(key_bytes)}
+				self.hashes = {**self.hashes, key_hash: self.hashes.get(key_hash, ()) + (key,)}
+
+			if channel:
+				self.named = {**self.named, channel: self.named.get(channel, ()) + (key,)}
+
+			if channel is None:
+				self.default = key
+
+			# A new key may be able to decrypt channels we previously gave up on
+			self.missing.clear()
+
+
+	def candidates(self, channel_hash: int, channel: str, node: int):
+		'''
+		Yield the encryption keys worth trying for a packet, most likely first.
+
+		:param channel_hash: The channel hash from the mesh packet
+		:param channel:      The channel name from the service envelope
+		:param node:         The node number the packet is from
+		'''
+
+		# Keys that last worked for this node or this channel
+		if (key := self.learned.get((channel_hash, node))):
+			yield key
+		if (key := self.learned.get((channel, channel_hash))):
+			yield key
+
+		# The channel hash is the XOR hash of the channel name and key, so the name gives us the key hash directly
+		if channel:
+			yield from self.hashes.get(channel_hash ^ xor_hash(channel.encode('utf-8')), ())
+			yield from self.named.get(channel, ())
+
+		# Trial decryption is only done once for channels we know nothing about
+		if (channel, channel_hash) not in self.missing:
+			yield from self.keys
+
+
+	def encryptor(self, key: str):
+		'''
+		Return this thread's AES-ECB encryptor for a key, created once and reused for every packet.
+
+		:param key: The encryption key
+		'''
+
+		if (encryptors := getattr(self.local, 'encryptors', None)) is None:
+			encryptors = self.local.encryptors = {}
+
+		if not (encryptor := encryptors.get(key)):
+			encryptor = encryptors[key] = Cipher(self.keys[key], modes.ECB(), backend=default_backend()).encryptor()
+
+		return encryptor
+
+
+	def decrypt(self, key: str, packets: list) -> list:
+		'''
+		Decrypt AES-CTR packets that share a key, computing the keystream for all of them in one call.
+
+		:param key:     The encryption key
+		:param packets: The (packet id, node number, encrypted bytes) of each packet
+		'''
+
+		blocks = []
+
+		# CTR mode is AES of the counter blocks XORed with the data, so build every counter block of the batch up front
+		for packet_id, node, encrypted in packets:
+			prefix = NONCE.pack(packet_id, node)[:12]
+			count  = (len(encrypted) + 15) // 16
+			blocks.extend(prefix + counter for counter in (COUNTERS[:count] if count <= len(COUNTERS) else (block.to_bytes(4, 'big') for block in range(count))))
+
+		keystream = self.encryptor(key).update(b''.join(blocks))
+		offset    = 0
+		decrypted = []
+
+		for _, _, encrypted in packets:
+			size = len(encrypted)
+			decrypted.append((int.from_bytes(encrypted, 'little') ^ int.from_bytes(keystream[offset:offset + size], 'little')).to_bytes(size, 'little'))
+			offset += (size + 15) // 16 * 16
+
+		return decrypted
+
+
+	def learn(self, channel_hash: int, channel: str, node: int, key: str):
+		'''
+		Remember which encryption key worked for a channel and node.
+
+		:param channel_hash: The channel hash from the mesh packet
+		:param channel:      The channel name from the service envelope
+		:param node:         The node number the packet is from
+		:param key:          The encryption key that worked
+		'''
+
+		with self.lock:
+			self.learned[(channel_hash, node)]    = key
+			self.learned[(channel, channel_hash)] = key
+
+
+	def give_up(self, channel_hash: int, channel: str):
+		'''
+		Remember that no key could decrypt a channel, so trial decryption is not repeated for it.
+
+		:param channel_hash: The channel hash from the mesh packet
+		:param channel:      The channel name from the service envelope
+		'''
+
+		with self.lock:
+			self.missing.add((channel, channel_hash))
+
+
+class SeenCache(object):
+	def __init__(self, size: int = 100000, ttl: int = 600):
+		'''
+		Initialize the bounded, TTL-evicting cache of packets already seen
+
+		:param size: The maximum number of packets to remember
+		:param ttl:  The number of seconds to remember a packet for
+		'''
+
+		self.size    = size
+		self.ttl     = ttl
+		self.lock    = threading.Lock()
+		self.packets = {} # (from, id) -> (first seen time, gateway ids that heard it), in the order they were first seen
+		self.hits    = 0
+		self.misses  = 0
+
+
+	def seen(self, key: tuple, gateway: str, now: float = None) -> float:
+		'''
+		Record a packet and return the time it was first seen (or None if this is the first copy).
+
+		:param key:     The (from, id) of the packet
+		:param gateway: The gateway id that uplinked this copy of the packet
+		:param now:     The time this copy was received (from time.perf_counter)
+		'''
+
+		now = now or time.perf_counter()
+
+		with self.lock:
+			# Evict expired packets from the oldest end, then the oldest packets if we are still full
+			while self.packets:
+				oldest = next(iter(self.packets))
+				if now - self.packets[oldest][0] < self.ttl and len(self.packets) < self.size:
+					break
+				del self.packets[oldest]
+
+			if (entry := self.packets.get(key)):
+				entry[1].add(gateway)
+				self.hits += 1
+				return entry[0]
+
+			self.packets[key] = (now, {gateway})
+			self.misses += 1
+
+
+	def gateways(self, key: tuple) -> set:
+		'''
+		Return the gateway ids that heard a packet.
+
+		:param key: The (from, id) of the packet
+		'''
+
+		with self.lock:
+			return set(entry[1]) if (entry := self.packets.get(key)) else set()
+
+
+	def stats(self) -> dict:
+		'''Return the size, hit ratio and approximate memory use of the cache'''
+
+		with self.lock:
+			total  = self.hits + self.misses
+			memory = sys.getsizeof(self.packets) + sum(sys.getsizeof(key) + sys.getsizeof(entry) + sys.getsizeof(entry[1]) for key, entry in self.packets.items())
+
+			return {'size': len(self.packets), 'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / total if total else 0.0, 'memory_bytes': memory}
+
+
+class PacketFilter(object):
+	def __init__(self, topics: list = None, gateways: list = None, channels: list = None, nodes: list = None, portnums: list = None):
+		'''
+		Initialize a declarative packet filter, every criteria given must match (any of its values)
+
+		:param topics:   MQTT topic patterns (with + and # wildcards)
+		:param gateways: Gateway node ids (!33664b0c)
+		:param channels: Channel names
+		:param nodes:    Node numbers the packet must be from
+		:param portnums: Port numbers of the packet payload
+		'''
+
+		self.topics   = list(topics or [])
+		self.gateways = frozenset(gateways or [])
+		self.channels = frozenset(channels or [])
+		self.nodes    = frozenset(nodes or [])
+		self.portnums = frozenset(portnums or [])
+		self.cache    = {} # Topic -> whether it passes the topic stage
+
+
+	def match_topic(self, topic: str) -> bool:
+		'''
+		First stage: check the topic string, with the channel and gateway taken from channel topics (.../2/e/CHANNEL/GATEWAY).
+
+		:param topic: The topic the message was published on
+		'''
+
+		if (result := self.cache.get(topic)) is not None:
+			return result
+
+		result = not self.topics or any(topic_matches(pattern, topic) for pattern in self.topics)
+
+		if result and (self.channels or self.gateways):
+			levels = topic.split('/')
+			for index in range(len(levels) - 3):
+				if levels[index] == '2' and levels[index + 1] == 'e':
+					channel, gateway = levels[index + 2], levels[index + 3]
+					result = (not self.channels or channel in self.channels) and (not self.gateways or gateway in self.gateways)
+					break
+
+		# Topics repeat for every packet a gateway uplinks, but never trust the cache to stay small
+		if len(self.cache) >= 100000:
+			self.cache.clear()
+
+		self.cache[topic] = result
+
+		return result
+
+
+	def match_header(self, service_envelope) -> bool:
+		'''
+		Second stage: check the unencrypted envelope header (and the port number of packets that were never encrypted).
+
+		:param service_envelope: The parsed service envelope
+		'''
+
+		if self.gateways and service_envelope.gateway_id not in self.gateways:
+			return False
+
+		if self.channels and service_envelope.channel_id not in self.channels:
+			return False
+
+		if self.nodes and getattr(service_envelope.packet, 'from') not in self.nodes:
+			return False
+
+		if self.portnums and service_envelope.packet.HasField('decoded'):
+			return service_envelope.packet.decoded.portnum in self.portnums
+
+		return True
+
+
+	def match_portnum(self, portnum: int) -> bool:
+		'''
+		Last stage: check the port number once the packet is decrypted.
+
+		:param portnum: The port number of the packet payload
+		'''
+
+		return not self.portnums or portnum in self.portnums
+
+
+	def subscriptions(self, topics: list) -> list:
+		'''
+		Narrow root topic subscriptions so the broker drops what the filter would.
+
+		:param topics: The root topics (msh/US/#)
+		'''
+
+		# Explicit topic patterns are subscribed to as is
+		if self.topics:
+			return list(self.topics)
+
+		if not self.channels and not self.gateways:
+			return list(topics)
+
+		narrowed = []
+
+		for topic in topics:
+			if not topic.endswith('#'):
+				narrowed.append(topic)
+				continue
+
+			# Wildcards only cover a fixed number of levels, so there is one subscription per region depth
+			for depth in range(REGION_DEPTH + 1):
+				for channel in self.channels or ['+']:
+					for gateway in self.gateways or ['+']:
+						narrowed.append(f'{topic[:-1]}{"+/" * depth}2/e/{channel}/{gateway}')
+
+		return narrowed
+
+
+class MeshtasticMQTT(object):
+	def __init__(self, workers: int = 1, queue_size: int = 10000, dedup_size: int = 100000, dedup_ttl: int = 600, output: Output = None, archive: Archive = None, packet_filter: PacketFilter = None):
+		'''
+		Initialize the Meshtastic MQTT client
+
+		:param workers:       The number of worker threads decoding messages (0 to decode on the network thread)
+		:param queue_size:    The maximum number of messages waiting for a worker before new ones are dropped
+		:param dedup_size:    The maximum number of packets remembered for duplicate suppression (0 to disable)
+		:param dedup_ttl:     The number of seconds a packet is remembered for duplicate suppression
+		:param output:        The structured output sink to emit a record per packet to
+		:param archive:       The archive to append every raw service envelope to
+		:param packet_filter: The filter packets must pass to be decoded
+		'''
+
+		self.broadcast_id = 4294967295 # Our channel ID
+		self.keyring      = Keyring()
+		self.metrics      = Metrics()
+		self.brokers      = {} # Broker name -> (Metrics, time the broker was added)
+		self.output       = output
+		self.archive      = archive
+		self.filter       = packet_filter
+		self.nodes        = NodeStore()
+		self.topology     = Topology()
+		self.telemetry    = TelemetryStore() if numpy else None # Telemetry ring buffers need numpy
+		self.seen         = SeenCache(dedup_size, dedup_ttl) if dedup_size else None
+		self.queue        = queue.Queue(queue_size) if workers else None
+		self.workers      = [threading.Thread(target=self.worker, name=f'meshmqtt-worker-{i}', daemon=True) for i in range(workers)]
+		self.batch_size   = BATCH_SIZE
+		self.handlers     = {} # Port number -> (protobuf class, handler)
+		self.texts        = Reassembler()
+
+		# Register the default handlers for each port number
+		for portnum, message_class, handler in (
+			(portnums_pb2.UNKNOWN_APP,                 None,                                self.on_unknown),
+			(portnums_pb2.TEXT_MESSAGE_APP,            None,                                self.on_text),
+			(portnums_pb2.REMOTE_HARDWARE_APP,         remote_hardware_pb2.HardwareMessage, self.on_data),
+			(portnums_pb2.POSITION_APP,                mesh_pb2.Position,                   self.on_position),
+			(portnums_pb2.NODEINFO_APP,                mesh_pb2.User,                       self.on_data),
+			(portnums_pb2.ROUTING_APP,                 mesh_pb2.Routing,                    self.on_data),
+			(portnums_pb2.ADMIN_APP,                   admin_pb2.AdminMessage,              self.on_data),
+			(portnums_pb2.TEXT_MESSAGE_COMPRESSED_APP, None,                                self.on_data),
+			(portnums_pb2.WAYPOINT_APP,                mesh_pb2.Waypoint,                   self.on_data),
+			(portnums_pb2.AUDIO_APP,                   None,                                self.on_data),
+			(portnums_pb2.DETECTION_SENSOR_APP,        None,                                self.on_data),
+			(portnums_pb2.REPLY_APP,                   None,                                self.on_data),
+			(portnums_pb2.IP_TUNNEL_APP,               None,                                self.on_data),
+			(portnums_pb2.PAXCOUNTER_APP,              paxcount_pb2.Paxcount,               self.on_data),
+			(portnums_pb2.SERIAL_APP,                  None,                                self.on_data),
+			(portnums_pb2.STORE_FORWARD_APP,           storeforward_pb2.StoreAndForward,    self.on_store_forward),
+			(portnums_pb2.RANGE_TEST_APP,              None,                                self.on_data),
+			(portnums_pb2.TELEMETRY_APP,               telemetry_pb2.Telemetry,             self.on_telemetry),
+			(portnums_pb2.ZPS_APP,                     None,                                self.on_data),
+			(portnums_pb2.SIMULATOR_APP,               None,                                self.on_data),
+			(portnums_pb2.TRACEROUTE_APP,              mesh_pb2.RouteDiscovery,             self.on_data),
+			(portnums_pb2.NEIGHBORINFO_APP,            mesh_pb2.NeighborInfo,               self.on_neighborinfo),
+			(portnums_pb2.ATAK_PLUGIN,                 None,                                self.on_data),
+			(portnums_pb2.MAP_REPORT_APP,              mqtt_pb2.MapReport,                  self.on_data),
+			(portnums_pb2.PRIVATE_APP,                 None,                                self.on_compressed_text),
+			(portnums_pb2.ATAK_FORWARDER,              None,                                self.on_data)
+		):
+			self.register(portnum, message_class, handler)
+
+		# Gauges are only read when the metrics are scraped
+		self.metrics.gauge('queue_depth',    lambda: self.queue.qsize() if self.queue else 0)
+		self.metrics.gauge('dedup_size',     lambda: len(self.seen.packets) if self.seen else 0)
+		self.metrics.gauge('nodes',          lambda: len(self.nodes.nodes))
+		self.metrics.gauge('topology_nodes', lambda: len(self.topology.links))
+
+
+	@property
+	def key(self) -> str:
+		'''The default encryption key'''
+
+		return self.keyring.default
+
+
+	@key.setter
+	def key(self, key: str):
+		self.set_key(key)
+
+
+	def set_key(self, key: str, channel: str = None):
+		'''
+		Decode an encryption key once and add it to the keyring.
+
+		:param key:     The encryption key
+		:param channel: The channel name the key belongs to (None for the default key)
+		'''
+
+		self.keyring.add(key, channel)
+
+
+	def connect(self, broker: str, port: int, root: str, tls: bool, username: str, password: str, key: str):
+		'''
+		Connect to the MQTT broker
+
+		:param broker:   The MQTT broker address
+		:param port:     The MQTT broker port
+		:param root:     The root topic to subscribe to
+		:param tls:      Enable TLS/SSL
+		:param username: The MQTT username
+		:param password: The MQTT password
+		:param key:      The encryption key
+		'''
+
+		# Decode the encryption key once so the packet hot path only has to build the nonce
+		self.set_key(key)
+
+		# Start the workers that decode messages off the network thread
+		self.start()
+
+		# Connect to the MQTT broker and subscribe to the root topic
+		client = self.add_broker(broker, port, [root], tls, username, password)
+
+		# Keep-alive loop
+		client.loop_forever()
+
+
+	def connect_brokers(self, brokers: list, key: str):
+		'''
+		Connect to several MQTT brokers and merge their messages into one pipeline
+
+		:param brokers: The brokers to connect to (dicts of add_broker arguments, see parse_broker)
+		:param key:     The encryption key
+		'''
+
+		self.set_key(key)
+		self.start()
+
+		# Each broker gets its own network thread, all feeding the same queue and duplicate cache
+		for broker in brokers:
+			self.add_broker(**broker).loop_start()
+
+		# Keep-alive loop
+		while True:
+			time.sleep(60)
+
+
+	def add_broker(self, broker: str, port: int, topics: list, tls: bool, username: str, password: str):
+		'''
+		Create an MQTT client for a broker that subscribes to its topics once connected
+
+		:param broker:   The MQTT broker address
+		:param port:     The MQTT broker port
+		:param topics:   The topics to subscribe to
+		:param tls:      Enable TLS/SSL
+		:param username: The MQTT username
+		:param password: The MQTT password
+		'''
+
+		name = f'{broker}:{port}'
+
+		self.brokers[name] = (Metrics(), time.monotonic())
+
+		# Let the broker do as much of the filtering as it can
+		if self.filter:
+			topics = self.filter.subscriptions(topics)
+
+		client = self.create_client(tls, username, password, {'name': name, 'topics': topics})
+		client.connect_async(broker, port, 60)
+
+		return client
+
+
+	def create_client(self, tls: bool, username: str, password: str, userdata: dict = None):
+		'''
+		Create an MQTT client with our callbacks set
+
+		:param tls:      Enable TLS/SSL
+		:param username: The MQTT username
+		:param password: The MQTT password
+		:param userdata: The broker name and topics passed to the callbacks
+		'''
+
+		# Initialize the MQTT client (these arguments were the only way to get it to work properly..)
+		client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id='', clean_session=True, userdata=userdata)
+
+		# Set the username and password for the MQTT broker
+		client.username_pw_set(username=username, password=password)
+
+		# Enable TLS/SSL if the user specified it
+		if tls:
+			client.tls_set()
+			#client.tls_insecure_set(False)
+
+		# Set the MQTT callbacks
+		client.on_connect     = self.on_connect
+		client.on_message     = self.on_message
+		client.on_subscribe   = self.on_subscribe
+		client.on_unsubscribe = self.on_unsubscribe
+
+		return client
+
+
+	def start(self):
+		'''Start the worker threads'''
+
+		for worker in self.workers:
+			if not worker.is_alive():
+				worker.start()
+
+
+	def stop(self):
+		'''Stop the worker threads once the queued messages have been processed'''
+
+		for _ in self.workers:
+			self.queue.put(None)
+
+		for worker in self.workers:
+			worker.join()
+
+
+	def stats(self) -> dict:
+		'''Return the processing metrics along with the current queue depth'''
+
+		stats = {**self.metrics.snapshot(), 'queue_depth': self.queue.qsize() if self.queue else 0}
+
+		if self.seen:
+			stats['dedup'] = self.seen.stats()
+
+		if self.brokers:
+			stats['brokers'] = {}
+			for name, (metrics, started) in self.brokers.items():
+				broker_stats = metrics.snapshot()
+				broker_stats['messages_per_sec'] = broker_stats.get('received', 0) / max(time.monotonic() - started, 1)
+				stats['brokers'][name] = broker_stats
+
+		return stats
+
+
+	def prometheus(self) -> str:
+		'''Return the processing metrics in the Prometheus text format'''
+
+		text = render([(self.metrics, {})], 'meshmqtt')
+
+		# Broker counters share names with the totals, so they get their own prefix
+		if self.brokers:
+			text += render([(metrics, {'broker': name}) for name, (metrics, _) in list(self.brokers.items())], 'meshmqtt_broker')
+
+		return text
+
+
+	def worker(self):
+		'''Worker thread that decodes queued messages in batches'''
+
+		running = True
+
+		while running and (item := self.queue.get()):
+			items = [item]
+
+			# Take whatever else is already waiting (up to a batch) so it is decrypted together
+			while len(items) < self.batch_size:
+				try:
+					item = self.queue.get_nowait()
+				except queue.Empty:
+					break
+				if item is None:
+					running = False
+					break
+				items.append(item)
+
+			now = time.perf_counter()
+
+			for received, _, _, _ in items:
+				self.metrics.observe('queue', now - received)
+
+			try:
+				self.process_messages([(topic, payload, broker, received) for received, broker, topic, payload in items])
+			except Exception as e:
+				self.metrics.count('errors')
+				logging.exception(f'Failed to process a batch of {len(items)} messages: {e}')
+
+
+	def decrypt_message_packet(self, message_packet, channel: str = None):
+		'''
+		Decrypt an encrypted message packet.
+		
+		:param message_packet: The message packet to decrypt
+		:param channel:        The channel name the packet was published on
+		'''
+
+		if self.decrypt_packets([(message_packet, channel)])[0]:
+			return message_packet
+
+
+	def decrypt_packets(self, packets: list) -> list:
+		'''
+		Decrypt a batch of encrypted message packets in place, returning whether each one was decrypted.
+
+		:param packets: The (message packet, channel name) of each packet
+		'''
+
+		encrypted  = [(packet.id, getattr(packet, 'from'), packet.encrypted) for packet, _ in packets]
+		candidates = [self.keyring.candidates(packet.channel, channel, node) for (packet, channel), (_, node, _) in zip(packets, encrypted)]
+		tried      = [None] * len(packets) # Keys already tried for each packet
+		results    = [False] * len(packets)
+		pending    = range(len(packets))
+
+		# Every round tries the next most likely key of each packet still pending, packets sharing a key are decrypted together
+		while pending:
+			groups = {}
+
+			for index in pending:
+				for key in candidates[index]:
+					if tried[index] is None:
+						tried[index] = {key}
+					elif key in tried[index]:
+						continue
+					else:
+						tried[index].add(key)
+					groups.setdefault(key, []).append(index)
+					break
+				else:
+					packet, channel = packets[index]
+					packet.encrypted = encrypted[index][2] # Put back the ciphertext a failed attempt cleared
+					self.keyring.give_up(packet.channel, channel)
+
+			pending = []
+
+			for key, indexes in groups.items():
+				for index, decrypted_bytes in zip(indexes, self.keyring.decrypt(key, [encrypted[index] for index in indexes])):
+					packet, channel = packets[index]
+					decoded         = packet.decoded
+
+					# Parse straight into the packet, a wrong key yields garbage that fails to parse or has no known (or registered) port number (UNKNOWN_APP, 0, is a known one)
+					try:
+						decoded.ParseFromString(decrypted_bytes)
+					except DecodeError:
+						pending.append(index)
+						continue
+
+					if decoded.portnum not in PORTNUMS and decoded.portnum not in self.handlers:
+						pending.append(index)
+						continue
+
+					self.keyring.learn(packet.channel, channel, encrypted[index][1], key)
+					results[index] = True
+
+		return results
+
+
+	def on_connect(self, client, userdata, flags, rc, properties):
+		'''
+		Callback for when the client receives a CONNACK response from the server.
+
+		:param client:     The client instance for this callback
+		:param userdata:   The private user data as set in Client() or user_data_set()
+		:param flags:      Response flags sent by the broker
+		:param rc:         The connection result
+		:param properties: The properties returned by the broker
+		'''
+
+		if rc == 0:
+			logging.info(f'Connected to MQTT broker {userdata["name"]}' if userdata else 'Connected to MQTT broker')
+
+			# Subscribe on every connect so the subscriptions survive reconnects
+			for topic in (userdata['topics'] if userdata else []):
+				client.subscribe(topic, 0)
+		else:
+			logging.error(f'Failed to connect to MQTT broker: {rc}')
+
+
+	def on_message(self, client, userdata, msg):
+		'''
+		Callback for when a message is received from the server.
+
+		:param client:   The client instance for this callback
+		:param userdata: The private user data as set in Client() or user_data_set()
+		:param msg:      An instance of MQTTMessage. This is a
+		'''
+
+		received = time.perf_counter()
+		broker   = userdata['name'] if userdata else None
+
+		self.metrics.count('received')
+
+		if broker:
+			self.brokers[broker][0].count('received')
+
+		# Decode on the network thread if there are no workers
+		if not self.queue:
+			return self.process_message(msg.topic, msg.payload, broker, received)
+
+		# Hand the message off to the workers so socket reads are never blocked by decoding
+		try:
+			self.queue.put_nowait((received, broker, msg.topic, msg.payload))
+		except queue.Full:
+			self.metrics.count('dropped')
+
+
+	def process_message(self, topic: str, payload: bytes, broker: str = None, received: float = None):
+		'''
+		Decrypt, parse and dispatch a message payload, returning the service envelope (or None if it was dropped).
+
+		:param topic:    The topic the message was published on
+		:param payload:  The raw service envelope payload
+		:param broker:   The name of the broker the message came from
+		:param received: The time the message was received (from time.perf_counter)
+		'''
+
+		if (envelopes := self.process_messages([(topic, payload, broker, received)])):
+			return envelopes[0]
+
+
+	def process_messages(self, messages: list) -> list:
+		'''
+		Decrypt, parse and dispatch a batch of message payloads, returning the service envelopes that were handled (not dropped or failed).
+
+		:param messages: The (topic, payload, broker, received) of each message, see process_message
+		'''
+
+		envelopes = self.decode_messages(messages)
+
+		delivered = []
+
+		for service_envelope in envelopes:
+			started = time.perf_counter()
+
+			# A handler failing on one packet must not cost the rest of the batch
+			try:
+				self.deliver(service_envelope)
+			except Exception as e:
+				self.metrics.count('errors')
+				logging.exception(f'Failed to handle a packet from !{getattr(service_envelope.packet, "from"):08x}: {e}')
+				continue
+
+			self.metrics.observe('dispatch', time.perf_counter() - started)
+			self.metrics.count('processed')
+
+			delivered.append(service_envelope)
+
+		return delivered
+
+
+	def replay(self, messages, speed: float = 0) -> dict:
+		'''
+		Feed captured messages through the decode pipeline and return throughput, latency and error statistics.
+
+		:param messages: An iterable of (timestamp, topic, payload), e.g. from read_pcap or Archive.replay
+		:param speed:    The playback speed relative to the capture (0 to replay as fast as possible)
+		'''
+
+		latencies = {} # Port name -> processing times in seconds
+		counts    = {'messages': 0, 'processed': 0, 'dropped': 0, 'errors': 0}
+		first     = None
+
+		started = time.perf_counter()
+
+		for timestamp, topic, payload in messages:
+			# Sleep until the message is due when replaying in (scaled) real time
+			if speed:
+				if first is None:
+					first = (timestamp, time.perf_counter())
+				if (delay := (timestamp - first[0]) / speed - (time.perf_counter() - first[1])) > 0:
+					time.sleep(delay)
+
+			counts['messages'] += 1
+			received = time.perf_counter()
+			errors   = self.metrics.counters.get('errors', 0)
+
+			try:
+				service_envelope = self.process_message(topic, payload, None, received)
+			except Exception as e:
+				counts['errors'] += 1
+				logging.debug(f'Failed to process message on {topic}: {e}')
+				continue
+
+			# Handler failures are caught (and counted) inside the pipeline
+			if self.metrics.counters.get('errors', 0) != errors:
+				counts['errors'] += 1
+				continue
+
+			if not service_envelope:
+				counts['dropped'] += 1
+				continue
+
+			counts['processed'] += 1
+
+			portnum = service_envelope.packet.decoded.portnum
+			name    = PORTNUM_NAMES.get(portnum, str(portnum))
+
+			latencies.setdefault(name, []).append(time.perf_counter() - received)
+
+		elapsed = time.perf_counter() - started
+		results = {**counts, 'seconds': elapsed, 'messages_per_sec': counts['messages'] / elapsed if elapsed else 0.0, 'latency': {}}
+
+		for name, times in sorted(latencies.items()):
+			times.sort()
+			results['latency'][name] = {
+				'count'  : len(times),
+				'p50_us' : times[len(times) // 2] * 1e6,
+				'p90_us' : times[int(len(times) * 0.9)] * 1e6,
+				'p99_us' : times[int(len(times) * 0.99)] * 1e6,
+				'max_us' : times[-1] * 1e6
+			}
+
+		return results
+
+
+	def deliver(self, service_envelope):
+		'''
+		Dispatch a decoded service envelope to its handler and emit it to the output sink.
+
+		:param service_envelope: The service envelope with a decoded packet
+		'''
+
+		data = self.dispatch(service_envelope.packet)
+
+		if data is not None:
+			self.nodes.update_packet(service_envelope.packet, data)
+			self.topology.update_packet(service_envelope.packet, data)
+			if self.telemetry is not None:
+				self.telemetry.update_packet(service_envelope.packet, data)
+
+		# Records are only built when there is somewhere to send them
+		if self.output and data is not None:
+			self.output.emit(self.record(service_envelope, data))
+
+
+	def record(self, service_envelope, data) -> dict:
+		'''
+		Build the structured record for a decoded packet.
+
+		:param service_envelope: The service envelope with a decoded packet
+		:param data:             The parsed payload (raw bytes for ports without a protobuf payload)
+		'''
+
+		message_packet = service_envelope.packet
+		portnum        = message_packet.decoded.portnum
+
+		if isinstance(data, str):
+			payload = data
+		elif not isinstance(data, bytes):
+			payload = MessageToDict(data, preserving_proto_field_name=True)
+		elif portnum in (portnums_pb2.TEXT_MESSAGE_APP, portnums_pb2.RANGE_TEST_APP, portnums_pb2.DETECTION_SENSOR_APP, portnums_pb2.REPLY_APP):
+			payload = data.decode('utf-8', errors='replace')
+		else:
+			payload = data
+
+		return clean_dict({
+			'time'      : message_packet.rx_time or int(time.time()),
+			'from'      : getattr(message_packet, 'from'),
+			'to'        : message_packet.to,
+			'id'        : message_packet.id,
+			'channel'   : service_envelope.channel_id,
+			'gateway'   : service_envelope.gateway_id,
+			'portnum'   : PORTNUM_NAMES.get(portnum, portnum),
+			'hop_limit' : message_packet.hop_limit,
+			'hop_start' : message_packet.hop_start,
+			'rx_snr'    : message_packet.rx_snr,
+			'rx_rssi'   : message_packet.rx_rssi,
+			'payload'   : payload
+		})
+
+
+	def decode_message(self, topic: str, payload: bytes, broker: str = None, received: float = None):
+		'''
+		Parse a message payload and decrypt its packet, returning the service envelope (or None if it was dropped).
+
+		:param topic:    The topic the message was published on
+		:param payload:  The raw service envelope payload
+		:param broker:   The name of the broker the message came from
+		:param received: The time the message was received (from time.perf_counter)
+		'''
+
+		if (envelopes := self.decode_messages([(topic, payload, broker, received)])):
+			return envelopes[0]
+
+
+	def decode_messages(self, messages: list) -> list:
+		'''
+		Parse a batch of message payloads and decrypt their packets together, returning the service envelopes that were not dropped.
+
+		:param messages: The (topic, payload, broker, received) of each message, see decode_message
+		'''
+
+		batch = [] # [service envelope, raw payload, keep, encrypted] of every envelope that parsed
+
+		for topic, payload, broker, received in messages:
+			# The topic is checked before anything is parsed
+			if self.filter and not self.filter.match_topic(topic):
+				self.metrics.count('filtered')
+				continue
+
+			started = time.perf_counter()
+
+			# Define the service envelope
+			service_envelope = mqtt_pb2.ServiceEnvelope()
+
+			try:
+				# Parse the message payload
+				service_envelope.ParseFromString(payload)
+
+				# Extract the message packet from the service envelope
+				message_packet = service_envelope.packet
+			except Exception as e:
+				logging.debug(f'Failed to parse message on {topic}: {str(e)}')
+				self.metrics.count('parse_errors')
+				continue
+
+			self.metrics.observe('parse', time.perf_counter() - started)
+
+			# Then the unencrypted header, before the duplicate cache and decryption (filtered packets are not archived)
+			if self.filter and not self.filter.match_header(service_envelope):
+				self.metrics.count('filtered')
+				continue
+
+			keep = True
 
+			# The same packet is uplinked once per gateway (and broker) that heard it, so skip copies before doing any decryption
+			if self.seen and (first_seen := self.seen.seen((getattr(message_packet, 'from'), message_packet.id), service_envelope.gateway_id, received)) is not None:
+				self.metrics.count('duplicates')
 
-# Initialize the logging module
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %I:%M:%S')
+				# How far this broker is behind the one that delivered the packet first
+				if broker:
+					self.brokers[broker][0].count('duplicates')
+					self.brokers[broker][0].observe('lag', max((received or time.perf_counter()) - first_seen, 0))
 
+				keep = False
 
-def clean_dict(dictionary: dict) -> dict:
-	'''
-	Remove empty fields from a dictionary.
+			elif broker:
+				self.brokers[broker][0].count('first')
 
-	:param dictionary: The dictionary to remove empty fields from
-	'''
-	
-	return {key: value for key, value in dictionary.items() if value}
+			batch.append([service_envelope, payload, keep, message_packet.HasField('encrypted') and not message_packet.HasField('decoded')])
 
+		# Decrypt the encrypted packets of the whole batch together
+		if (encrypted := [entry for entry in batch if entry[2] and entry[3]]):
+			started = time.perf_counter()
 
-class MeshtasticMQTT(object):
-	def __init__(self):
-		'''Initialize the Meshtastic MQTT client'''
+			for entry, decrypted in zip(encrypted, self.decrypt_packets([(entry[0].packet, entry[0].channel_id) for entry in encrypted])):
+				if not decrypted:
+					logging.debug(f'No key for channel {entry[0].channel_id} (hash {entry[0].packet.channel})')
+					self.metrics.count('decrypt_failures', channel=entry[0].channel_id)
+					entry[2] = False
 
-		self.broadcast_id = 4294967295 # Our channel ID
-		self.key = None
+			self.metrics.observe('decrypt', (time.perf_counter() - started) / len(encrypted))
 
+		envelopes = []
 
-	def connect(self, broker: str, port: int, root: str, tls: bool, username: str, password: str, key: str):
-		'''
-		Connect to the MQTT broker
+		for service_envelope, payload, keep, was_encrypted in batch:
+			message_packet = service_envelope.packet
 
-		:param broker:   The MQTT broker address
-		:param port:     The MQTT broker port
-		:param root:     The root topic to subscribe to
-		:param tls:      Enable TLS/SSL
-		:param username: The MQTT username
-		:param password: The MQTT password
-		:param key:      The encryption key
-		'''
+			if keep and was_encrypted:
+				# Only build the log line when someone will read it
+				if logging.root.isEnabledFor(logging.INFO):
+					text = {
+						'from'       : getattr(message_packet, 'from'),
+						'to'         : getattr(message_packet, 'to'),
+						'channel'    : getattr(message_packet, 'channel'),
+						'id'         : getattr(message_packet, 'id'),
+						'rx_time'    : getattr(message_packet, 'rx_time'),
+						'hop_limit'  : getattr(message_packet, 'hop_limit'),
+						'priority'   : getattr(message_packet, 'priority'),
+						'hop_start'  : getattr(message_packet, 'hop_start')
+					}
+					logging.info(text)
 
-		# Initialize the MQTT client (these arguments were the only way to get it to work properly..)
-		client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id='', clean_session=True, userdata=None)
+			# Unencrypted messages
+			elif keep and not was_encrypted and message_packet.decoded.portnum != portnums_pb2.MAP_REPORT_APP:
+				logging.warning('Received an unencrypted message')
 
-		# Set the username and password for the MQTT broker
-		client.username_pw_set(username=username, password=password)
+			# And the port number only once it is decrypted
+			if keep and self.filter and not self.filter.match_portnum(message_packet.decoded.portnum):
+				self.metrics.count('filtered')
+				keep = False
 
-		# Set the encryption key global in the client class (the default key is padded to ensure it's the correct length for AES)
-		self.key = '1PG7OiApB1nwvP+rz05pAQ==' if key == 'AQ==' else key
+			if keep:
+				envelopes.append(service_envelope)
 
-		# Enable TLS/SSL if the user specified it
-		if tls:
-			client.tls_set()
-			#client.tls_insecure_set(False)
+				# Separate families keep the number of series at gateways + channels + ports rather than their product
+				self.metrics.count('packets',         portnum=PORTNUM_NAMES.get(message_packet.decoded.portnum, message_packet.decoded.portnum))
+				self.metrics.count('gateway_packets', gateway=service_envelope.gateway_id)
+				self.metrics.count('channel_packets', channel=service_envelope.channel_id)
 
-		# Set the MQTT callbacks
-		client.on_connect     = self.on_connect
-		client.on_message     = self.on_message
-		client.on_subscribe   = self.on_subscribe
-		client.on_unsubscribe = self.on_unsubscribe
+			# Every envelope is archived, including duplicates and ones we have no key for
+			if self.archive:
+				self.archive.append(payload, getattr(message_packet, 'from'), message_packet.decoded.portnum, topic=topic)
 
-		# Connect to the MQTT broker and subscribe to the root topic
-		client.connect(broker, port, 60)
-		client.subscribe(root, 0)
+		return envelopes
 
-		# Keep-alive loop
-		client.loop_forever()
 
+	def register(self, portnum: int, message_class, handler):
+		'''
+		Register a handler for a port number.
 
-	def decrypt_message_packet(self, message_packet):
+		:param portnum:       The port number to handle (from portnums_pb2 or a custom port)
+		:param message_class: The protobuf class to parse the payload into (None to pass the raw payload)
+		:param handler:       The function to call with the message packet and parsed payload
 		'''
-		Decrypt an encrypted message packet.
-		
-		:param message_packet: The message packet to decrypt
+
+		self.handlers[portnum] = (message_class, handler)
+
+
+	def dispatch(self, message_packet):
+		'''
+		Parse the payload of a decoded message packet and pass it to the handler for its port number, returning the parsed payload.
+
+		:param message_packet: The decoded message packet
 		'''
 
-		# Ensure the key is formatted and padded correctly before turning it into bytes
-		padded_key = self.key.ljust(len(self.key) + ((4 - (len(self.key) % 4)) % 4), '=')
-		key        = padded_key.replace('-', '+').replace('_', '/')
-		key_bytes  = base64.b64decode(key.encode('ascii'))
+		portnum = message_packet.decoded.portnum
+
+		if portnum not in self.handlers:
+			logging.warning('Received an unknown message:')
+			logging.info(message_packet)
+			return
 
-		# Extract the nonce from the packet
-		nonce_packet_id = getattr(message_packet, 'id').to_bytes(8, 'little')
-		nonce_from_node = getattr(message_packet, 'from').to_bytes(8, 'little')
-		nonce           = nonce_packet_id + nonce_from_node
+		message_class, handler = self.handlers[portnum]
 
-		# Decrypt the message
-		cipher          = Cipher(algorithms.AES(key_bytes), modes.CTR(nonce), backend=default_backend())
-		decryptor       = cipher.decryptor()
-		decrypted_bytes = decryptor.update(getattr(message_packet, 'encrypted')) + decryptor.finalize()
+		if message_class:
+			data = message_class()
+			try:
+				data.ParseFromString(message_packet.decoded.payload)
+			except DecodeError as e:
+				logging.error(f'Failed to parse {PORTNUM_NAMES.get(portnum, str(portnum))} payload: {e}')
+				return
+		else:
+			data = message_packet.decoded.payload
 
-		# Parse the decrypted message
-		data = mesh_pb2.Data()
-		data.ParseFromString(decrypted_bytes)
-		message_packet.decoded.CopyFrom(data)
+		# A handler can return a replacement payload (the text of a compressed message)
+		if (result := handler(message_packet, data)) is not None:
+			data = result
 
-		return message_packet
+		return data
 
 
-	def on_connect(self, client, userdata, flags, rc, properties):
+	def on_data(self, message_packet, data):
 		'''
-		Callback for when the client receives a CONNACK response from the server.
+		Default handler that logs the payload of a message packet.
 
-		:param client:     The client instance for this callback
-		:param userdata:   The private user data as set in Client() or user_data_set()
-		:param flags:      Response flags sent by the broker
-		:param rc:         The connection result
-		:param properties: The properties returned by the broker
+		:param message_packet: The decoded message packet
+		:param data:           The parsed payload (raw bytes for ports without a protobuf payload)
 		'''
 
-		if rc == 0:
-			logging.info('Connected to MQTT broker')
-		else:
-			logging.error(f'Failed to connect to MQTT broker: {rc}')
+		# Custom and private port numbers registered with register() have no name in the enum
+		name = PORTNUM_NAMES.get(message_packet.decoded.portnum, str(message_packet.decoded.portnum)).removesuffix('_APP').lower().replace('_', ' ')
 
+		logging.info(f'Received {name}:')
+		logging.info(data)
 
-	def on_message(self, client, userdata, msg):
+
+	def on_unknown(self, message_packet, data):
 		'''
-		Callback for when a message is received from the server.
+		Handler for unknown app messages.
 
-		:param client:   The client instance for this callback
-		:param userdata: The private user data as set in Client() or user_data_set()
-		:param msg:      An instance of MQTTMessage. This is a
+		:param message_packet: The decoded message packet
+		:param data:           The raw payload
 		'''
 
-		# Define the service envelope
-		service_envelope = mqtt_pb2.ServiceEnvelope()
+		logging.warning('Received an unknown app message:')
+		logging.info(message_packet)
 
-		try:
-			# Parse the message payload
-			service_envelope.ParseFromString(msg.payload)
 
-			# Extract the message packet from the service envelope
-			message_packet = service_envelope.packet
-		except Exception as e:
-			#logging.error(f'Failed to parse message: {str(e)}')
-			return
+	def on_text(self, message_packet, data):
+		'''
+		Handler for text messages.
 
-		# Check if the message is encrypted before decrypting it
-		if message_packet.HasField('encrypted') and not message_packet.HasField('decoded'):
-			message_packet = self.decrypt_message_packet(message_packet)
+		:param message_packet: The decoded message packet
+		:param data:           The raw payload
+		'''
 
-			text = {
-				'from'       : getattr(message_packet, 'from'),
-				'to'         : getattr(message_packet, 'to'),
-				'channel'    : getattr(message_packet, 'channel'),
-				'id'         : getattr(message_packet, 'id'),
-				'rx_time'    : getattr(message_packet, 'rx_time'),
-				'hop_limit'  : getattr(message_packet, 'hop_limit'),
-				'priority'   : getattr(message_packet, 'priority'),
-				'hop_start'  : getattr(message_packet, 'hop_start')
-			}
-			logging.info(text)
-
-			if message_packet.decoded.portnum == portnums_pb2.UNKNOWN_APP:
-				logging.warning('Received an unknown app message:')
-				logging.info(message_packet)
-
-			elif message_packet.decoded.portnum == portnums_pb2.TEXT_MESSAGE_APP:
-				text_payload = message_packet.decoded.payload.decode('utf-8')
-				text = {
-					'message' : text_payload,
-					'from'    : getattr(message_packet, 'from'),
-					'id'      : getattr(message_packet, 'id'),
-					'to'      : getattr(message_packet, 'to')
-				}
-				logging.info('Received text message:')
-				logging.info(text)
+		if not logging.root.isEnabledFor(logging.INFO):
+			return
 
-			elif message_packet.decoded.portnum == portnums_pb2.REMOTE_HARDWARE_APP:
-				data = mesh_pb2.RemoteHardware()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received remote hardware:')
-				logging.info(data)
+		text = {
+			'message' : data.decode('utf-8', errors='replace'),
+			'from'    : getattr(message_packet, 'from'),
+			'id'      : getattr(message_packet, 'id'),
+			'to'      : getattr(message_packet, 'to')
+		}
+		logging.info('Received text message:')
+		logging.info(text)
 
-			elif message_packet.decoded.portnum == portnums_pb2.POSITION_APP:
-				data = mesh_pb2.Position()
-				data.ParseFromString(message_packet.decoded.payload)
 
-				data_dict = {key: value for key, value in data}
-				print(data_dict)
-
-				logging.info('Received position:')
-				loc = {
-					'lattitude'       : getattr(data, 'latitude_i') / 1e7,
-					'longitude'       : getattr(data, 'longitude_i') / 1e7,
-					'altitude'        : getattr(data, 'altitude') / 1000,
-					'location_source' : getattr(data, 'location_source'),
-					'altitude_source' : getattr(data, 'altitude_source'),
-					'pdop'            : getattr(data, 'PDOP'),
-					'hdop'            : getattr(data, 'HDOP'),
-					'vdop'            : getattr(data, 'VDOP'),
-					'gps_accuracy'    : getattr(data, 'gps_accuracy'),
-					'ground_speed'    : getattr(data, 'ground_speed'),
-					'ground_track'    : getattr(data, 'ground_track'),
-					'fix_quality'     : getattr(data, 'fix_quality'),
-					'fix_type'        : getattr(data, 'fix_type'),
-					'sats_in_view'    : getattr(data, 'sats_in_view'),
-					'sensor_id'       : getattr(data, 'sensor_id'),
-					'next_update'     : getattr(data, 'next_update'),
-					'seq_number'      : getattr(data, 'seq_number'),
-					'precision_bits'  : getattr(data, 'precision_bits')
-				}
-
-				if (loc := clean_dict(loc)):
-					logging.info(loc)
-
-			elif message_packet.decoded.portnum == portnums_pb2.NODEINFO_APP:
-				data = mesh_pb2.NodeInfo()
-				#data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received node info:')
-				logging.info(message_packet)
-
-			elif message_packet.decoded.portnum == portnums_pb2.ROUTING_APP:
-				data = mesh_pb2.Routing()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received routing:')
-				logging.info(data)
+	def on_compressed_text(self, message_packet, data) -> str:
+		'''
+		Handler for private application messages, returning the text of a meshtext compressed message once every chunk arrived.
 
-			elif message_packet.decoded.portnum == portnums_pb2.ADMIN_APP:
-				data = mesh_pb2.Admin()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received admin:')
-				logging.info(data)
+		:param message_packet: The decoded message packet
+		:param data:           The raw payload
+		'''
 
-			elif message_packet.decoded.portnum == portnums_pb2.TEXT_MESSAGE_COMPRESSED_APP:
-				data = mesh_pb2.TextMessageCompressed()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received compressed text message:')
-				logging.info(data)
+		# Other private applications share the port, anything we can not decode is logged as raw data
+		if (text := self.texts.receive(getattr(message_packet, 'from'), data)) is None:
+			self.on_data(message_packet, data)
+			return
 
-			elif message_packet.decoded.portnum == portnums_pb2.WAYPOINT_APP:
-				data = mesh_pb2.Waypoint()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received waypoint:')
-				logging.info(data)
+		self.on_text(message_packet, text.encode('utf-8'))
 
-			elif message_packet.decoded.portnum == portnums_pb2.AUDIO_APP:
-				data = mesh_pb2.Audio()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received audio:')
-				logging.info(data)
+		return text
 
-			elif message_packet.decoded.portnum == portnums_pb2.DETECTION_SENSOR_APP:
-				data = mesh_pb2.DetectionSensor()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received detection sensor:')
-				logging.info(data)
 
-			elif message_packet.decoded.portnum == portnums_pb2.REPLY_APP:
-				data = mesh_pb2.Reply()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received reply:')
-				logging.info(data)
+	def on_position(self, message_packet, data):
+		'''
+		Handler for position messages.
 
-			elif message_packet.decoded.portnum == portnums_pb2.IP_TUNNEL_APP:
-				data = mesh_pb2.IPTunnel()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received IP tunnel:')
-				logging.info(data)
+		:param message_packet: The decoded message packet
+		:param data:           The parsed mesh_pb2.Position payload
+		'''
 
-			elif message_packet.decoded.portnum == portnums_pb2.PAXCOUNTER_APP:
-				data = mesh_pb2.Paxcounter()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received paxcounter:')
-				logging.info(data)
+		if not logging.root.isEnabledFor(logging.INFO):
+			return
 
-			elif message_packet.decoded.portnum == portnums_pb2.SERIAL_APP:
-				data = mesh_pb2.Serial()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received serial:')
-				logging.info(data)
+		logging.info('Received position:')
+		loc = {
+			'lattitude'       : getattr(data, 'latitude_i') / 1e7,
+			'longitude'       : getattr(data, 'longitude_i') / 1e7,
+			'altitude'        : getattr(data, 'altitude') / 1000,
+			'location_source' : getattr(data, 'location_source'),
+			'altitude_source' : getattr(data, 'altitude_source'),
+			'pdop'            : getattr(data, 'PDOP'),
+			'hdop'            : getattr(data, 'HDOP'),
+			'vdop'            : getattr(data, 'VDOP'),
+			'gps_accuracy'    : getattr(data, 'gps_accuracy'),
+			'ground_speed'    : getattr(data, 'ground_speed'),
+			'ground_track'    : getattr(data, 'ground_track'),
+			'fix_quality'     : getattr(data, 'fix_quality'),
+			'fix_type'        : getattr(data, 'fix_type'),
+			'sats_in_view'    : getattr(data, 'sats_in_view'),
+			'sensor_id'       : getattr(data, 'sensor_id'),
+			'next_update'     : getattr(data, 'next_update'),
+			'seq_number'      : getattr(data, 'seq_number'),
+			'precision_bits'  : getattr(data, 'precision_bits')
+		}
+
+		if (loc := clean_dict(loc)):
+			logging.info(loc)
+
+
+	def on_store_forward(self, message_packet, data):
+		'''
+		Handler for store and forward messages.
 
-			elif message_packet.decoded.portnum == portnums_pb2.STORE_FORWARD_APP:
-				logging.info('Received store and forward:')
-				logging.info(message_packet)
-				logging.info(message_packet.decoded.payload)
+		:param message_packet: The decoded message packet
+		:param data:           The parsed storeforward_pb2.StoreAndForward payload
+		'''
 
-			elif message_packet.decoded.portnum == portnums_pb2.RANGE_TEST_APP:
-				data = mesh_pb2.RangeTest()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received range test:')
-				logging.info(data)
+		logging.info('Received store and forward:')
+		logging.info(message_packet)
+		logging.info(data)
 
-			elif message_packet.decoded.portnum == portnums_pb2.TELEMETRY_APP:
-				data = telemetry_pb2.Telemetry()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received telemetry:')
-
-				data_dict = {}
-				for field, value in data.ListFields():
-					if field.name == 'device_metrics':
-						text = clean_dict({item.name: getattr(value, item.name) for item in value.DESCRIPTOR.fields if hasattr(value, item.name)})
-						if text:
-							logging.info(text)
-					else:
-						data_dict[field.name] = value
-						
-				logging.info(data_dict)
-				
-				if getattr(data, 'device_metrics'):
-					text = {
-						'battery_level'       : getattr(data.device_metrics, 'battery_level'),
-						'voltage'             : getattr(data.device_metrics, 'voltage'),
-						'channel_utilization' : getattr(data.device_metrics, 'channel_utilization'),
-						'air_util_tx'         : getattr(data.device_metrics, 'air_util_tx'),
-						'uptime_seconds'      : getattr(data.device_metrics, 'uptime_seconds')
-					}
-					if (text := clean_dict(text)):
-						logging.info(text)
-
-				if getattr(data, 'environment_metrics'):
-					env_metrics = {
-						'barometric_pressure' : getattr(data.environment_metrics, 'barometric_pressure'),
-						'current'             : getattr(data.environment_metrics, 'current'),
-						'distance'            : getattr(data.environment_metrics, 'distance'),
-						'gas_resistance'      : getattr(data.environment_metrics, 'gas_resistance'),
-						'iaq'                 : getattr(data.environment_metrics, 'iaq'),
-						'relative_humidity'   : getattr(data.environment_metrics, 'relative_humidity'),
-						'temperature'         : getattr(data.environment_metrics, 'temperature'),
-						'voltage'             : getattr(data.environment_metrics, 'voltage')
-					}
-					if (env_metrics := clean_dict(env_metrics)):
-						logging.info(env_metrics)
 
-			elif message_packet.decoded.portnum == portnums_pb2.ZPS_APP:
-				data = mesh_pb2.Zps()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received ZPS:')
-				logging.info(data)
+	def on_telemetry(self, message_packet, data):
+		'''
+		Handler for telemetry messages.
 
-			elif message_packet.decoded.portnum == portnums_pb2.SIMULATOR_APP:
-				data = mesh_pb2.Simulator()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received simulator:')
-				logging.info(data)
-
-			elif message_packet.decoded.portnum == portnums_pb2.TRACEROUTE_APP:
-				routeDiscovery = mesh_pb2.RouteDiscovery()
-				routeDiscovery.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received traceroute:')
-				logging.info(routeDiscovery)
-
-			elif message_packet.decoded.portnum == portnums_pb2.NEIGHBORINFO_APP:
-				neighborInfo = mesh_pb2.NeighborInfo()
-				neighborInfo.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received neighbor info:')
-				info = {
-					'node_id'                      : getattr(neighborInfo, 'node_id'),
-					'last_sent_by_id'              : getattr(neighborInfo, 'last_sent_by_id'),
-					'node_broadcast_interval_secs' : getattr(neighborInfo, 'node_broadcast_interval_secs'),
-					'neighbors'                    : getattr(neighborInfo, 'neighbors')
-				}
-				logging.info(info)
-
-			elif message_packet.decoded.portnum == portnums_pb2.ATAK_PLUGIN:
-				data = mesh_pb2.AtakPlugin()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received ATAK plugin:')
-				logging.info(data)
+		:param message_packet: The decoded message packet
+		:param data:           The parsed telemetry_pb2.Telemetry payload
+		'''
 
-			elif message_packet.decoded.portnum == portnums_pb2.PRIVATE_APP:
-				data = mesh_pb2.Private()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received private:')
-				logging.info(data)
+		if not logging.root.isEnabledFor(logging.INFO):
+			return
 
-			elif message_packet.decoded.portnum == portnums_pb2.ATAK_FORWARDER:
-				data = mesh_pb2.AtakForwarder()
-				data.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received ATAK forwarder:')
-				logging.info(data)
+		logging.info('Received telemetry:')
 
+		data_dict = {}
+		for field, value in data.ListFields():
+			if field.name == 'device_metrics':
+				text = clean_dict({item.name: getattr(value, item.name) for item in value.DESCRIPTOR.fields if hasattr(value, item.name)})
+				if text:
+					logging.info(text)
 			else:
-				logging.warning('Received an unknown message:')
-				logging.info(message_packet)
+				data_dict[field.name] = value
 
-		# Unencrypted messages
-		else:
-			if message_packet.decoded.portnum == portnums_pb2.MAP_REPORT_APP:
-				pos = mesh_pb2.Position()
-				pos.ParseFromString(message_packet.decoded.payload)
-				logging.info('Received map report:')
-				logging.info(pos)
+		logging.info(data_dict)
 
-			else:
-				logging.warning('Received an unencrypted message')
-				logging.info(f'Payload: {message_packet}')
+		if data.HasField('device_metrics'):
+			text = {
+				'battery_level'       : getattr(data.device_metrics, 'battery_level'),
+				'voltage'             : getattr(data.device_metrics, 'voltage'),
+				'channel_utilization' : getattr(data.device_metrics, 'channel_utilization'),
+				'air_util_tx'         : getattr(data.device_metrics, 'air_util_tx'),
+				'uptime_seconds'      : getattr(data.device_metrics, 'uptime_seconds')
+			}
+			if (text := clean_dict(text)):
+				logging.info(text)
+
+		if data.HasField('environment_metrics'):
+			env_metrics = {
+				'barometric_pressure' : getattr(data.environment_metrics, 'barometric_pressure'),
+				'current'             : getattr(data.environment_metrics, 'current'),
+				'distance'            : getattr(data.environment_metrics, 'distance'),
+				'gas_resistance'      : getattr(data.environment_metrics, 'gas_resistance'),
+				'iaq'                 : getattr(data.environment_metrics, 'iaq'),
+				'relative_humidity'   : getattr(data.environment_metrics, 'relative_humidity'),
+				'temperature'         : getattr(data.environment_metrics, 'temperature'),
+				'voltage'             : getattr(data.environment_metrics, 'voltage')
+			}
+			if (env_metrics := clean_dict(env_metrics)):
+				logging.info(env_metrics)
+
+
+	def on_neighborinfo(self, message_packet, data):
+		'''
+		Handler for neighbor info messages.
+
+		:param message_packet: The decoded message packet
+		:param data:           The parsed mesh_pb2.NeighborInfo payload
+		'''
+
+		if not logging.root.isEnabledFor(logging.INFO):
+			return
+
+		logging.info('Received neighbor info:')
+		info = {
+			'node_id'                      : getattr(data, 'node_id'),
+			'last_sent_by_id'              : getattr(data, 'last_sent_by_id'),
+			'node_broadcast_interval_secs' : getattr(data, 'node_broadcast_interval_secs'),
+			'neighbors'                    : getattr(data, 'neighbors')
+		}
+		logging.info(info)
 
 
 	def on_subscribe(self, client, userdata, mid, reason_code_list, properties):
@@ -445,17 +1490,350 @@ class MeshtasticMQTT(object):
 		client.disconnect()
 
 
+class AsyncMeshtasticMQTT(MeshtasticMQTT):
+	def __init__(self, queue_size: int = 10000, dedup_size: int = 100000, dedup_ttl: int = 600, output: Output = None, archive: Archive = None, packet_filter: PacketFilter = None, seen: SeenCache = None):
+		'''
+		Initialize the asyncio Meshtastic MQTT client
+
+		:param queue_size:    The maximum number of decoded packets waiting to be iterated before new ones are dropped
+		:param dedup_size:    The maximum number of packets remembered for duplicate suppression (0 to disable)
+		:param dedup_ttl:     The number of seconds a packet is remembered for duplicate suppression
+		:param output:        The structured output sink to emit a record per packet to
+		:param archive:       The archive to append every raw service envelope to
+		:param packet_filter: The filter packets must pass to be decoded
+		:param seen:          A duplicate cache shared with the clients of other brokers on the same event loop (None for a cache of our own)
+		'''
+
+		super().__init__(0, queue_size, 0 if seen else dedup_size, dedup_ttl, output, archive, packet_filter)
+
+		if seen:
+			self.seen = seen
+
+		self.name      = None                      # host:port of the broker, its counters are kept in self.brokers
+		self.loop      = None
+		self.thread    = None                      # Ident of the thread running the event loop
+		self.client    = None
+		self.packets   = asyncio.Queue(queue_size) # Decoded service envelopes waiting to be iterated
+		self.connected = None                      # Future resolved when the broker acknowledges the connection
+		self.pending   = {}                        # Subscribe message id -> future resolved when the broker acknowledges it
+		self.misc      = None                      # Task running the MQTT keep-alive housekeeping
+
+
+	def __aiter__(self):
+		return self
+
+
+	async def __anext__(self):
+		'''Return the next decoded service envelope (its packet is already decrypted)'''
+
+		if (service_envelope := await self.packets.get()) is None:
+			raise StopAsyncIteration
+
+		return service_envelope
+
+
+	async def connect(self, broker: str, port: int, tls: bool, username: str, password: str, key: str = None):
+		'''
+		Connect to the MQTT broker and wait for it to acknowledge the connection
+
+		:param broker:   The MQTT broker address
+		:param port:     The MQTT broker port
+		:param tls:      Enable TLS/SSL
+		:param username: The MQTT username
+		:param password: The MQTT password
+		:param key:      The encryption key
+		'''
+
+		self.loop   = asyncio.get_running_loop()
+		self.thread = threading.get_ident()
+		self.name   = f'{broker}:{port}'
+
+		self.brokers[self.name] = (Metrics(), time.monotonic())
+
+		if key:
+			self.set_key(key)
+
+		self.client = self.create_client(tls, username, password)
+
+		# Drive the client from the event loop instead of a network thread
+		self.client.on_disconnect              = self.on_disconnect
+		self.client.on_socket_open             = self.on_socket_open
+		self.client.on_socket_close            = self.on_socket_close
+		self.client.on_socket_register_write   = self.on_socket_register_write
+		self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+		self.connected = self.loop.create_future()
+
+		# The TCP & TLS handshake is blocking, so it runs in the default executor
+		await self.loop.run_in_executor(None, self.client.connect, broker, port, 60)
+		await self.connected
+
+
+	async def subscribe(self, topic: str, qos: int = 0):
+		'''
+		Subscribe to a topic and wait for the broker to acknowledge it
+
+		:param topic: The topic to subscribe to
+		:param qos:   The quality of service level
+		'''
+
+		result, mid = self.client.subscribe(topic, qos)
+
+		if result != mqtt.MQTT_ERR_SUCCESS:
+			raise ConnectionError(f'Failed to subscribe to {topic}: {mqtt.error_string(result)}')
+
+		self.pending[mid] = self.loop.create_future()
+
+		await self.pending[mid]
+
+
+	async def disconnect(self):
+		'''Disconnect from the MQTT broker'''
+
+		self.client.disconnect()
+
+
+	async def misc_loop(self):
+		'''Run the MQTT keep-alive housekeeping while the socket is open'''
+
+		while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+			await asyncio.sleep(1)
+
+
+	def call(self, callback, *args):
+		'''
+		Run a callback on the event loop, since socket callbacks can fire from the executor during connect
+
+		:param callback: The function to call
+		:param args:     The arguments to call it with
+		'''
+
+		if threading.get_ident() == self.thread:
+			callback(*args)
+		else:
+			self.loop.call_soon_threadsafe(callback, *args)
+
+
+	def on_socket_open(self, client, userdata, sock):
+		self.call(self.loop.add_reader, sock, client.loop_read)
+		self.call(self.start_misc_loop)
+
+
+	def on_socket_close(self, client, userdata, sock):
+		self.call(self.loop.remove_reader, sock)
+
+		if self.misc:
+			self.call(self.misc.cancel)
+
+
+	def on_socket_register_write(self, client, userdata, sock):
+		self.call(self.loop.add_writer, sock, client.loop_write)
+
+
+	def on_socket_unregister_write(self, client, userdata, sock):
+		self.call(self.loop.remove_writer, sock)
+
+
+	def start_misc_loop(self):
+		self.misc = self.loop.create_task(self.misc_loop())
+
+
+	def on_connect(self, client, userdata, flags, rc, properties):
+		super().on_connect(client, userdata, flags, rc, properties)
+
+		if not self.connected.done():
+			if rc == 0:
+				self.connected.set_result(True)
+			else:
+				self.connected.set_exception(ConnectionError(f'Failed to connect to MQTT broker: {rc}'))
+
+
+	def on_disconnect(self, client, userdata, flags, rc, properties):
+		'''
+		Callback for when the client disconnects from the server, which ends the iteration of packets.
+
+		:param client:     The client instance for this callback
+		:param userdata:   The private user data as set in Client() or user_data_set()
+		:param flags:      Response flags sent by the broker
+		:param rc:         The disconnection reason
+		:param properties: The properties returned by the broker
+		'''
+
+		logging.warning(f'Disconnected from MQTT broker: {rc}')
+
+		if not self.connected.done():
+			self.connected.set_exception(ConnectionError(f'Disconnected from MQTT broker: {rc}'))
+
+		# Make room for the end of stream marker if the consumer fell behind
+		if self.packets.full():
+			self.packets.get_nowait()
+			self.metrics.count('dropped')
+
+		self.packets.put_nowait(None)
+
+
+	def on_message(self, client, userdata, msg):
+		received = time.perf_counter()
+
+		self.metrics.count('received')
+		self.brokers[self.name][0].count('received')
+
+		if not (service_envelope := self.decode_message(msg.topic, msg.payload, self.name, received)):
+			return
+
+		try:
+			self.packets.put_nowait(service_envelope)
+		except asyncio.QueueFull:
+			self.metrics.count('dropped')
+
+
+	def on_subscribe(self, client, userdata, mid, reason_code_list, properties):
+		super().on_subscribe(client, userdata, mid, reason_code_list, properties)
+
+		if (future := self.pending.pop(mid, None)) and not future.done():
+			if reason_code_list[0].is_failure:
+				future.set_exception(ConnectionError(f'Broker rejected the subscription: {reason_code_list[0]}'))
+			else:
+				future.set_result(reason_code_list[0].value)
+
+
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Meshtastic MQTT Interface')
-	parser.add_argument('--broker', default='mqtt.meshtastic.org', help='MQTT broker address')
+	parser.add_argument('--broker', action='append', help='MQTT broker address or mqtt[s]://user:pass@host:port/topic URL (can be repeated, default: mqtt.meshtastic.org)')
 	parser.add_argument('--port', default=1883, type=int, help='MQTT broker port')
 	parser.add_argument('--root', default='#', help='Root topic')
 	parser.add_argument('--tls', action='store_true', help='Enable TLS/SSL')
 	parser.add_argument('--username', default='meshdev', help='MQTT username')
 	parser.add_argument('--password', default='large4cats', help='MQTT password')
 	parser.add_argument('--key', default='AQ==', help='Encryption key')
+	parser.add_argument('--channel-key', action='append', default=[], metavar='CHANNEL=KEY', help='Additional encryption key for a channel (can be repeated)')
+	parser.add_argument('--workers', default=1, type=int, help='Worker threads decoding messages (0 to decode on the network thread)')
+	parser.add_argument('--queue-size', default=10000, type=int, help='Maximum messages waiting for a worker before dropping')
+	parser.add_argument('--stats', default=0, type=int, help='Log processing metrics every N seconds')
+	parser.add_argument('--dedup-size', default=100000, type=int, help='Packets remembered for duplicate suppression (0 to disable)')
+	parser.add_argument('--dedup-ttl', default=600, type=int, help='Seconds a packet is remembered for duplicate suppression')
+	parser.add_argument('--asyncio', action='store_true', help='Run the client on an asyncio event loop instead of a network thread (one client per --broker)')
+	parser.add_argument('--output', default='log', choices=('log', 'json', 'msgpack'), help='Log packets or emit one structured record per packet')
+	parser.add_argument('--output-file', help='Append structured records to a file instead of stdout')
+	parser.add_argument('--output-socket', metavar='HOST:PORT', help='Stream structured records to a TCP socket instead of stdout')
+	parser.add_argument('--archive', metavar='DIRECTORY', help='Archive every raw service envelope to a directory (query it with mesharchive.py)')
+	parser.add_argument('--replay', metavar='CAPTURE', help='Replay an archive directory or a pcap of MQTT traffic instead of connecting to a broker')
+	parser.add_argument('--replay-speed', default=0, type=float, help='Replay speed relative to the capture (0 for as fast as possible)')
+	parser.add_argument('--filter-topic', action='append', metavar='PATTERN', help='Only decode packets published on a topic pattern (can be repeated)')
+	parser.add_argument('--filter-gateway', action='append', metavar='!NODE', help='Only decode packets uplinked by a gateway (can be repeated)')
+	parser.add_argument('--filter-channel', action='append', metavar='CHANNEL', help='Only decode packets on a channel (can be repeated)')
+	parser.add_argument('--filter-node', action='append', metavar='!NODE', help='Only decode packets from a node (can be repeated)')
+	parser.add_argument('--filter-portnum', action='append', metavar='PORTNUM', help='Only decode packets for a port number, like TEXT_MESSAGE_APP or 1 (can be repeated)')
+	parser.add_argument('--metrics', metavar='HOST:PORT', help='Serve Prometheus metrics on /metrics and a sampling profiler on /profile (POST /profile/start and /profile/stop to toggle)')
 	args = parser.parse_args()
 
-	client = MeshtasticMQTT()
-	client.connect(args.broker, args.port, args.root, args.tls, args.username, args.password, args.key)
\ No newline at end of file
+	output        = None
+	archive       = Archive(args.archive) if args.archive else None
+	packet_filter = None
+
+	if args.filter_topic or args.filter_gateway or args.filter_channel or args.filter_node or args.filter_portnum:
+		packet_filter = PacketFilter(
+			args.filter_topic,
+			args.filter_gateway,
+			args.filter_channel,
+			[parse_node(node) for node in args.filter_node or []],
+			[int(portnum) if portnum.isdigit() else portnums_pb2.PortNum.Value(portnum.upper()) for portnum in args.filter_portnum or []]
+		)
+
+	# Structured output replaces the packet logging, so only warnings and errors are logged
+	if args.output != 'log':
+		output = Output.open(args.output, args.output_file, args.output_socket)
+		logging.getLogger().setLevel(logging.WARNING)
+
+	brokers = [parse_broker(broker, args.port, args.root, args.tls, args.username, args.password) for broker in args.broker or ['mqtt.meshtastic.org']]
+	names   = [f'{broker["broker"]}:{broker["port"]}' for broker in brokers]
+
+	if args.asyncio:
+		# One client per broker on the same event loop, the shared cache drops the copies of a packet heard on several brokers
+		seen    = SeenCache(args.dedup_size, args.dedup_ttl) if args.dedup_size else None
+		clients = [AsyncMeshtasticMQTT(args.queue_size, args.dedup_size, args.dedup_ttl, output, archive, packet_filter, seen) for _ in brokers]
+	else:
+		clients = [MeshtasticMQTT(0 if args.replay else args.workers, args.queue_size, args.dedup_size, args.dedup_ttl, output, archive, packet_filter)]
+
+	client = clients[0]
+
+	def stats() -> dict:
+		'''Return the metrics of the client, or of every asyncio client by broker'''
+
+		if len(clients) == 1:
+			return client.stats()
+
+		return {name: item.stats() for name, item in zip(names, clients)}
+
+	def prometheus() -> str:
+		'''Return the metrics of every client in the Prometheus text format'''
+
+		if len(clients) == 1:
+			return client.prometheus()
+
+		text  = render([(item.metrics, {'broker': name}) for name, item in zip(names, clients)], 'meshmqtt')
+		text += render([(metrics, {'broker': name}) for item in clients for name, (metrics, _) in list(item.brokers.items())], 'meshmqtt_broker')
+
+		return text
+
+	if args.stats:
+		# A logger of its own keeps reporting when structured output raises the root level, records still go to the root handler (stderr)
+		stats_logger = logging.getLogger('meshmqtt.stats')
+		stats_logger.setLevel(logging.INFO)
+
+		def report_stats():
+			while True:
+				time.sleep(args.stats)
+				stats_logger.info(stats())
+
+		threading.Thread(target=report_stats, daemon=True).start()
+
+	if args.metrics:
+		MetricsServer(args.metrics, prometheus, Profiler()).start()
+
+	for channel_key in args.channel_key:
+		channel, _, key = channel_key.partition('=')
+		for item in clients:
+			item.set_key(key, channel or None)
+
+	try:
+		if args.replay:
+			client.set_key(args.key)
+
+			messages = Archive(args.replay).replay() if os.path.isdir(args.replay) else read_pcap(args.replay)
+
+			print(json.dumps(client.replay(messages, args.replay_speed), indent=4))
+
+			raise SystemExit(0)
+
+		if args.asyncio:
+			async def run(client: AsyncMeshtasticMQTT, broker: dict):
+				try:
+					await client.connect(broker['broker'], broker['port'], broker['tls'], broker['username'], broker['password'], args.key)
+
+					for topic in (packet_filter.subscriptions(broker['topics']) if packet_filter else broker['topics']):
+						await client.subscribe(topic)
+
+					try:
+						async for service_envelope in client:
+							client.deliver(service_envelope)
+					finally:
+						await client.disconnect()
+				except (OSError, ConnectionError) as ex:
+					# A broker that can not be reached leaves the others running
+					logging.error(f'Broker {broker["broker"]}:{broker["port"]} failed: {ex}')
+
+			async def main():
+				await asyncio.gather(*(run(item, broker) for item, broker in zip(clients, brokers)))
+
+			asyncio.run(main())
+		else:
+			client.connect_brokers(brokers, args.key)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		# Flush the records still buffered, the lock keeps a broker thread from writing while the segment closes
+		if archive:
+			with archive.lock:
+				archive.close()
\ No newline at end of file
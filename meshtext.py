@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Meshtastic Compressed Text - Developed by acidvegas in Python (https://acid.vegas/meshtastic)
+
+import random
+import struct
+import threading
+import time
+import zlib
+
+try:
+	from meshtastic import mesh_pb2, portnums_pb2
+except ImportError:
+	raise SystemExit('missing the meshtastic module (pip install meshtastic)')
+
+
+# Shared static dictionary for raw deflate, primed with chat-like strings so short messages have something to reference
+# (deflate reaches back from the end, so the most common strings are last)
+DICTIONARY = (
+	'https://www. .com .org meshtastic.org github.com/meshtastic '
+	'firmware update version battery voltage temperature humidity pressure altitude position location '
+	'router repeater client gateway antenna solar panel enclosure heltec tbeam rak wisblock station g2 '
+	'frequency region preset channel LongFast MediumFast ShortFast LongSlow primary secondary '
+	'traceroute neighbor hops hop limit snr rssi dBm dB km miles meters feet mph north south east west '
+	'morning afternoon evening tonight tomorrow yesterday today weekend hours minutes seconds '
+	'Does anyone know how to Has anyone Is anyone else Can someone Can anyone I think I will I am '
+	'please thank you thanks thx lol haha yes no ok okay sure maybe sorry welcome nice great awesome cool '
+	'What is your Where are you How are you Who is this Is this What are you using '
+	'just set up my first node, new node online here, testing testing 123, '
+	'Can anyone hear me? Anyone hear this? Anyone on the mesh? Anybody out there? Copy that, '
+	'Good morning mesh! Good night everyone, Hello from the the and to of a in is it you that for on '
+	'with this have are be at from your my me we not can will just what so was get out up if '
+	'Test message, signal is good, reception, range test, hearing you loud and clear, '
+	'Hello mesh! Hello everyone, Hi all, hello anyone on the mesh? Test test '
+).encode('utf-8')
+
+# Our own format is sent on the private application port, TEXT_MESSAGE_COMPRESSED_APP is Unishox2 in the firmware and apps
+PORTNUM = portnums_pb2.PRIVATE_APP
+
+FORMAT_SINGLE = 0x01 # <format> <deflate data>
+FORMAT_CHUNK  = 0x02 # <format> <16-bit message id> <chunk index << 4 | chunk count - 1> <part of the deflate data>
+CHUNK         = struct.Struct('>BHB')
+
+HEADER_SIZE = 16   # Unencrypted packet header in front of the encrypted Data protobuf
+MAX_CHUNKS  = 16   # Most packets a compressed message is split into
+MAX_TEXT    = 2000 # Longest message sent, in bytes
+TTL         = 300  # Seconds to wait for the missing chunks of a message
+MAX_PENDING = 1000 # Most partially received messages remembered
+
+
+def on_air(portnum: int, payload: bytes) -> int:
+	'''
+	Return the LoRa payload size of a packet (header and Data protobuf)
+
+	:param portnum: The port number of the payload
+	:param payload: The payload
+	'''
+
+	return HEADER_SIZE + mesh_pb2.Data(portnum=portnum, payload=payload).ByteSize()
+
+
+def compress(text: str) -> bytes:
+	'''
+	Compress text with raw deflate primed with the shared dictionary
+
+	:param text: The text to compress
+	'''
+
+	compressor = zlib.compressobj(9, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+
+	return compressor.compress(text.encode('utf-8')) + compressor.flush()
+
+
+def decompress(data: bytes) -> str:
+	'''
+	Decompress text compressed with compress()
+
+	:param data: The compressed text
+	'''
+
+	decompressor = zlib.decompressobj(-15, DICTIONARY)
+
+	return (decompressor.decompress(data) + decompressor.flush()).decode('utf-8')
+
+
+def split(text: str, size: int) -> list:
+	'''
+	Split text into parts of at most size bytes without splitting a character
+
+	:param text: The text to split
+	:param size: The most bytes in a part
+	'''
+
+	data  = text.encode('utf-8')
+	parts = []
+
+	while data:
+		end = min(size, len(data))
+
+		# Back up to the start of a UTF-8 character
+		while end < len(data) and (data[end] & 0xC0) == 0x80:
+			end -= 1
+
+		parts.append(data[:end])
+		data = data[end:]
+
+	return parts
+
+
+def encode(text: str, compressed: bool = False) -> list:
+	'''
+	Return the (port number, payload) of each packet to send text in
+
+	:param text:       The text to send
+	:param compressed: Compress the text onto PORTNUM when that is fewer bytes on the air (only clients running this module can read it)
+	'''
+
+	plain = [(portnums_pb2.TEXT_MESSAGE_APP, part) for part in split(text, mesh_pb2.Constants.DATA_PAYLOAD_LEN)]
+
+	if not compressed:
+		return plain
+
+	data = compress(text)
+
+	if len(data) + 1 <= mesh_pb2.Constants.DATA_PAYLOAD_LEN:
+		packed = [(PORTNUM, bytes([FORMAT_SINGLE]) + data)]
+	else:
+		size  = mesh_pb2.Constants.DATA_PAYLOAD_LEN - CHUNK.size
+		parts = [data[offset:offset + size] for offset in range(0, len(data), size)]
+
+		if len(parts) > MAX_CHUNKS:
+			return plain
+
+		message = random.randint(0, 0xFFFF)
+		packed  = [(PORTNUM, CHUNK.pack(FORMAT_CHUNK, message, index << 4 | len(parts) - 1) + part) for index, part in enumerate(parts)]
+
+	if sum(on_air(*packet) for packet in packed) < sum(on_air(*packet) for packet in plain):
+		return packed
+
+	return plain
+
+
+class Reassembler(object):
+	def __init__(self, ttl: int = TTL, size: int = MAX_PENDING):
+		'''
+		Initialize the reassembly of compressed text messages received in chunks
+
+		:param ttl:  Seconds to wait for the missing chunks of a message
+		:param size: The most partially received messages remembered
+		'''
+
+		self.ttl     = ttl
+		self.size    = size
+		self.lock    = threading.Lock()
+		self.pending = {} # (sender, message id) -> [time first chunk arrived, chunk count, {index: data}]
+
+
+	def receive(self, sender: int, payload: bytes) -> str:
+		'''
+		Decode a PORTNUM payload, returning the text once the message is complete (None until then or if it can not be decoded)
+
+		:param sender:  The node number the payload is from
+		:param payload: The payload
+		'''
+
+		if not payload:
+			return None
+
+		try:
+			if payload[0] == FORMAT_SINGLE:
+				return decompress(payload[1:])
+
+			if payload[0] != FORMAT_CHUNK or len(payload) < CHUNK.size:
+				return None
+
+			_, message, position = CHUNK.unpack_from(payload)
+			index, count         = position >> 4, (position & 0x0F) + 1
+			now                  = time.monotonic()
+
+			if index >= count:
+				return None
+
+			with self.lock:
+				# Forget messages whose chunks never all arrived, and the oldest past the limit when this chunk starts a new message
+				for key in [key for key, (started, _, _) in self.pending.items() if now - started > self.ttl]:
+					del self.pending[key]
+				if (sender, message) not in self.pending:
+					while len(self.pending) >= self.size:
+						del self.pending[next(iter(self.pending))]
+
+				entry = self.pending.setdefault((sender, message), [now, count, {}])
+
+				# Chunks of one message all carry the same count
+				if count != entry[1]:
+					return None
+
+				entry[2][index] = payload[CHUNK.size:]
+
+				if len(entry[2]) < entry[1]:
+					return None
+
+				del self.pending[(sender, message)]
+
+			return decompress(b''.join(entry[2][index] for index in range(entry[1])))
+
+		except (KeyError, UnicodeDecodeError, zlib.error):
+			return None
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# Meshtastic Serial/TCP Interface Tests - Developed by acidvegas in Python (https://acid.vegas/meshtastic)
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from meshtastic import mesh_pb2, portnums_pb2
+
+from meshapi import HEADER, MAX_PACKET, START1, START2, AsyncMeshtasticClient
+
+
+def frame(message) -> bytes:
+	'''
+	Frame a protobuf message the way the radio does
+
+	:param message: The FromRadio or ToRadio message
+	'''
+
+	payload = message.SerializeToString()
+
+	return HEADER.pack(START1, START2, len(payload)) + payload
+
+
+class Radio(object):
+	def __init__(self):
+		'''Initialize the radio end of a pseudo terminal, the client opens the other end as its serial port'''
+
+		self.master, self.slave = os.openpty()
+		self.path               = os.ttyname(self.slave)
+		self.reader             = asyncio.StreamReader()
+
+		os.set_blocking(self.master, False)
+
+		asyncio.get_running_loop().add_reader(self.master, self.readable)
+
+
+	def readable(self):
+		'''Callback for the master end being readable'''
+
+		try:
+			self.reader.feed_data(os.read(self.master, 4096))
+		except OSError:
+			self.close()
+
+
+	def write(self, data: bytes):
+		'''
+		Write bytes to the client
+
+		:param data: The bytes to write
+		'''
+
+		os.write(self.master, data)
+
+
+	async def receive(self) -> mesh_pb2.ToRadio:
+		'''Return the next ToRadio frame from the client, skipping the wake up bytes in front of the first one'''
+
+		await self.reader.readuntil(bytes([START1]))
+
+		header = await self.reader.readexactly(3)
+
+		if header[0] != START2 or int.from_bytes(header[1:], 'big') > MAX_PACKET:
+			raise AssertionError(f'bad header from the client: {header!r}')
+
+		to_radio = mesh_pb2.ToRadio()
+		to_radio.ParseFromString(await self.reader.readexactly(int.from_bytes(header[1:], 'big')))
+
+		return to_radio
+
+
+	def close(self):
+		'''Close both ends of the pseudo terminal'''
+
+		if self.master is not None:
+			asyncio.get_running_loop().remove_reader(self.master)
+			os.close(self.master)
+			os.close(self.slave)
+			self.master = None
+
+
+class TestStreamProtocol(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.radio  = Radio()
+		self.client = AsyncMeshtasticClient()
+
+		await asyncio.wait_for(self.client.connect('serial', self.radio.path), 5)
+
+		# The handshake asks for the configuration, the radio answers with its node info and the same nonce
+		request = await asyncio.wait_for(self.radio.receive(), 5)
+
+		self.assertTrue(request.want_config_id)
+		self.assertEqual(request.want_config_id, self.client.config_id)
+
+		self.config_id = request.want_config_id
+
+
+	async def asyncTearDown(self):
+		await self.client.close()
+		self.radio.close()
+
+
+	async def next(self) -> mesh_pb2.FromRadio:
+		'''Return the next message the client reads'''
+
+		return await asyncio.wait_for(self.client.read(), 5)
+
+
+	async def test_handshake(self):
+		self.radio.write(frame(mesh_pb2.FromRadio(id=1, my_info=mesh_pb2.MyNodeInfo(my_node_num=0x12345678))))
+		self.radio.write(frame(mesh_pb2.FromRadio(id=2, config_complete_id=self.config_id)))
+
+		self.assertEqual((await self.next()).my_info.my_node_num, 0x12345678)
+		self.assertEqual((await self.next()).config_complete_id, self.config_id)
+		self.assertTrue(self.client.configured.is_set())
+		self.assertEqual(self.client.my_info.my_node_num, 0x12345678)
+
+
+	async def test_debug_console(self):
+		# Firmware log lines land between frames (and the log can contain the start byte itself)
+		self.radio.write(b'INFO  | 12:00:00 1 [Router] Received packet\r\n' + frame(mesh_pb2.FromRadio(id=1)))
+		self.radio.write(b'DEBUG | \x94 stray start byte in the log\r\n' + frame(mesh_pb2.FromRadio(id=2)))
+
+		self.assertEqual((await self.next()).id, 1)
+		self.assertEqual((await self.next()).id, 2)
+
+
+	async def test_resync_bad_header(self):
+		# A start byte followed by something other than the second start byte, the real frame starts right after it
+		self.radio.write(b'\x94' + frame(mesh_pb2.FromRadio(id=1)))
+
+		# Two start bytes in a row, only the first is dropped
+		self.radio.write(b'\x94\x94' + frame(mesh_pb2.FromRadio(id=2))[1:])
+
+		self.assertEqual((await self.next()).id, 1)
+		self.assertEqual((await self.next()).id, 2)
+		self.assertEqual(self.client.metrics.counters['framing_errors'], 2)
+
+
+	async def test_resync_oversized_length(self):
+		# A valid looking start with a length past MAX_PACKET, the real frame begins inside its length bytes
+		self.radio.write(b'\x94\xc3\x94' + frame(mesh_pb2.FromRadio(id=1))[1:])
+		self.radio.write(b'\x94\xc3\xff\xff' + frame(mesh_pb2.FromRadio(id=2)))
+
+		self.assertEqual((await self.next()).id, 1)
+		self.assertEqual((await self.next()).id, 2)
+
+
+	async def test_send_text(self):
+		ids = await self.client.send_text('hello mesh', destination=0x12345678, channel=1)
+
+		to_radio = await asyncio.wait_for(self.radio.receive(), 5)
+		packet   = to_radio.packet
+
+		self.assertEqual(ids, [packet.id])
+		self.assertEqual(packet.to, 0x12345678)
+		self.assertEqual(packet.channel, 1)
+		self.assertEqual(packet.decoded.portnum, portnums_pb2.TEXT_MESSAGE_APP)
+		self.assertEqual(packet.decoded.payload, b'hello mesh')
+
+		# The radio reports the packet back as sent, which the client reads like any other message
+		self.radio.write(frame(mesh_pb2.FromRadio(id=3, packet=packet)))
+
+		self.assertEqual((await self.next()).packet.decoded.payload, b'hello mesh')
+
+
+
+if __name__ == '__main__':
+	unittest.main()